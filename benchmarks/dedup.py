@@ -0,0 +1,89 @@
+# Dedup ratio and ingest throughput of the seeder chunk store (STORAGE_ENGINE=chunks).
+# Ingests a set of files made of identical copies and near duplicates (bytes inserted, overwritten
+# or appended), or the files of the given directories, and reports what the store keeps and what
+# replicating each file to a seeder that already holds the others would transfer.
+# Run from the repository root: python benchmarks/dedup.py [--size MiB] [directory ...]
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'seeder'))
+sys.path.insert(0, ROOT)
+
+from storage import ChunkStore, chunkFile
+
+def syntheticFiles(directory, size):
+    rng = random.Random(0)
+    base = rng.randbytes(size)
+
+    variants = {
+        'base.dat': base,
+        'copy.dat': base,
+        'inserted.dat': base[:size // 3] + rng.randbytes(100) + base[size // 3:],
+        'overwritten.dat': base[:size // 2] + rng.randbytes(4096) + base[size // 2 + 4096:],
+        'appended.dat': base + rng.randbytes(size // 10),
+        'unrelated.dat': rng.randbytes(size),
+    }
+
+    paths = []
+    for name, data in variants.items():
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=8, help='size of the synthetic files in MiB')
+    parser.add_argument('directories', nargs='*')
+    options = parser.parse_args()
+
+    workDirectory = tempfile.mkdtemp()
+    try:
+        if options.directories:
+            paths = [os.path.join(directory, name) for directory in options.directories for name in sorted(os.listdir(directory))
+                     if not name.startswith('.') and os.path.isfile(os.path.join(directory, name))]
+        else:
+            paths = syntheticFiles(workDirectory, options.size * 1024 * 1024)
+
+        store = ChunkStore(os.path.join(workDirectory, 'disk'))
+        totalBytes = 0
+        totalTime = 0
+
+        print(f"{'file':<24} {'size':>12} {'MiB/s':>8} {'chunks':>8} {'transfer':>12}")
+
+        for index, path in enumerate(paths):
+            size = os.path.getsize(path)
+
+            # Bytes a seeder holding the files ingested so far would fetch to replicate this one
+            transfer = sum(len(data) for data in chunkFile(path) if not store.hasChunk(hashlib.sha256(data).hexdigest()))
+
+            start = time.perf_counter()
+            # Identical files are ingested under their own key, so they count in the logical bytes
+            recipe = store.ingest(f'{index:05x}', path, os.path.basename(path), os.path.getmtime(path), None)
+            elapsed = time.perf_counter() - start
+
+            totalBytes += size
+            totalTime += elapsed
+
+            print(f"{os.path.basename(path)[:24]:<24} {size:>12} {size / elapsed / 2**20 if elapsed else 0:>8.1f} {len(recipe['chunks']):>8} {transfer:>12}")
+
+        stats = store.stats()
+        print()
+        print(f"ingest throughput  {totalBytes / totalTime / 2**20 if totalTime else 0:.1f} MiB/s")
+        print(f"logical bytes      {stats['logicalBytes']}")
+        print(f"stored bytes       {stats['storedBytes']}")
+        print(f"dedup ratio        {stats['dedupRatio']:.2f}")
+    finally:
+        shutil.rmtree(workDirectory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Placement strategies of the tracker (see tracker/placement.py) at scale.
+# Places the copies of synthetic files over many seeders and reports the placement cost, how evenly
+# the bytes are spread, whether capacity weights are honoured, and the churn when seeders leave or join:
+# the share of copies that would have to move, next to the share that has to move at the very least.
+# Run from the repository root: python benchmarks/placement.py [--seeders N] [--files N] [--replicas N] [--strategies ...]
+# Rendezvous scores every seeder on every placement: at 10k seeders run it with a few thousand files
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'tracker'))
+sys.path.insert(0, ROOT)
+
+from catalog import Catalog
+
+def placeAll(catalog, files, replicas):
+    placements = {}
+
+    for fileHash, size in files.items():
+        placements[fileHash] = catalog.place(fileHash, replicas)
+
+        # Least loaded placement follows the bytes stored so far
+        for address in placements[fileHash]:
+            catalog.reserve(address, size)
+
+    return placements
+
+def build(strategy, addresses, weights, vnodes):
+    catalog = Catalog(placement=strategy, vnodes=vnodes)
+
+    # The seeders join without files, the way a fresh deployment would
+    for address in addresses:
+        catalog.weights[address] = weights.get(address, 1.0)
+        catalog.placement.addSeeder(address, catalog.weights[address])
+        catalog.usage[address] = 0
+        catalog.pushUsage(address)
+
+    # The ring sorts the points of the new seeders on the first placement
+    catalog.place('')
+
+    return catalog
+
+def moved(before, after)->int:
+    return sum(len(set(after[fileHash]) - set(before[fileHash])) for fileHash in before)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeders', type=int, default=10000)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--vnodes', type=int, default=100)
+    parser.add_argument('--churn', type=float, default=0.01, help='share of the seeders leaving, then joining')
+    parser.add_argument('--strategies', nargs='*', default=['leastLoaded', 'ring', 'rendezvous'])
+    options = parser.parse_args()
+
+    rng = random.Random(0)
+    addresses = [f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(options.seeders)]
+    files = {f'{i:08x}': rng.randint(1, 1 << 30) for i in range(options.files)}
+
+    # A tenth of the seeders advertise twice the capacity
+    weights = {address: 2.0 for address in rng.sample(addresses, options.seeders // 10)}
+
+    changed = max(int(options.seeders * options.churn), 1)
+    leaving = set(rng.sample(addresses, changed))
+    joining = [f'11.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(changed)]
+
+    print(f'{options.seeders} seeders, {options.files} files, {options.replicas} replicas, {changed} seeders leaving then joining')
+    print(f"{'strategy':<12} {'build s':>8} {'us/place':>9} {'max/mean':>9} {'cv':>6} {'w2/w1':>6} {'leave':>7} {'min':>7} {'join':>7} {'min':>7}")
+
+    for strategy in options.strategies:
+        start = time.perf_counter()
+        catalog = build(strategy, addresses, weights, options.vnodes)
+        buildTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        placements = placeAll(catalog, files, options.replicas)
+        placeTime = (time.perf_counter() - start) / len(files)
+
+        load = {address: 0 for address in addresses}
+        for fileHash, placed in placements.items():
+            for address in placed:
+                load[address] += files[fileHash]
+
+        values = list(load.values())
+        mean = statistics.mean(values)
+        heavy = statistics.mean(load[address] for address in weights)
+        light = statistics.mean(load[address] for address in addresses if address not in weights)
+
+        # Leave: the copies on the leaving seeders have to move at least
+        survivors = [address for address in addresses if address not in leaving]
+        catalog = build(strategy, survivors, weights, options.vnodes)
+        afterLeave = placeAll(catalog, files, options.replicas)
+        leaveMinimum = sum(1 for placed in placements.values() for address in placed if address in leaving)
+
+        # Join: the new seeders should take their share of the copies and nothing else should move
+        catalog = build(strategy, survivors + joining, weights, options.vnodes)
+        afterJoin = placeAll(catalog, files, options.replicas)
+        joinMinimum = sum(1 for placed in afterJoin.values() for address in placed if address in joining)
+
+        total = len(files) * options.replicas
+        print(f"{strategy:<12} {buildTime:>8.2f} {placeTime * 1e6:>9.1f} {max(values) / mean:>9.2f} {statistics.pstdev(values) / mean:>6.2f} {heavy / light:>6.2f} "
+              f"{moved(placements, afterLeave) / total:>7.2%} {leaveMinimum / total:>7.2%} {moved(afterLeave, afterJoin) / total:>7.2%} {joinMinimum / total:>7.2%}")
+
+if __name__ == '__main__':
+    main()
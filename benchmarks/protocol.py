@@ -0,0 +1,74 @@
+# Compare the pickle based messages with the binary wire protocol.
+# Run from the repository root: python benchmarks/protocol.py
+import os
+import sys
+import time
+import pickle
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils import Response, File
+
+SIZES = [4 * 1024, 256 * 1024, 4 * 1024 * 1024]
+ROUNDS = 200
+
+def picklePath(message):
+    return pickle.loads(pickle.dumps({"status": 200, "message": message}))["message"]
+
+def binaryPath(message):
+    return Response.load(Response(status=200, message=message).export()).message
+
+def roundTrip(context, encode, decode, message):
+    sender = context.socket(zmq.PAIR)
+    receiver = context.socket(zmq.PAIR)
+    sender.bind('inproc://protocol-benchmark')
+    receiver.connect('inproc://protocol-benchmark')
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        sender.send_multipart(encode(message), copy=False)
+        decode(receiver.recv_multipart(copy=False))
+    elapsed = time.perf_counter() - start
+
+    sender.close()
+    receiver.close()
+    return elapsed
+
+def measure(function, message):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        function(message)
+    return time.perf_counter() - start
+
+def main():
+    context = zmq.Context()
+
+    print(f"{'payload':>10} {'pickle enc+dec':>16} {'binary enc+dec':>16} {'pickle inproc':>15} {'binary inproc':>15}")
+
+    for size in SIZES:
+        message = {"offset": 0, "count": size, "data": os.urandom(size)}
+
+        pickleTime = measure(picklePath, message)
+        binaryTime = measure(binaryPath, message)
+
+        pickleRoundTrip = roundTrip(context,
+                                    lambda m: [pickle.dumps({"status": 200, "message": m})],
+                                    lambda frames: pickle.loads(frames[0].bytes),
+                                    message)
+        binaryRoundTrip = roundTrip(context,
+                                    lambda m: Response(status=200, message=m).export(),
+                                    Response.load,
+                                    message)
+
+        print(f"{size:>10} {pickleTime / ROUNDS * 1e6:>13.1f} us {binaryTime / ROUNDS * 1e6:>13.1f} us "
+              f"{pickleRoundTrip / ROUNDS * 1e6:>12.1f} us {binaryRoundTrip / ROUNDS * 1e6:>12.1f} us")
+
+    # Metadata heavy message: a LIST answer with many files
+    files = {f'{i:05x}': File(name=f'file-{i}.dat', size=i * 1024, lastModified=time.time()) for i in range(10000)}
+    print(f"{'LIST 10k':>10} {measure(picklePath, files) / ROUNDS * 1e6:>13.1f} us {measure(binaryPath, files) / ROUNDS * 1e6:>13.1f} us")
+
+    context.term()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# Tracker request throughput at 1, 10 and 100 concurrent clients.
+# Starts a tracker on this machine, registers synthetic seeders and measures GET/LIST round trips.
+# Run from the repository root: python benchmarks/tracker.py [--workers N] [--directory PATH]
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import zmq
+import utils
+from utils import OperationRequest, Response, File, TRACKER_OPERATIONS, HEARTBEAT_PORT, HEARTBEAT_INTERVAL, getIpAddress
+
+SEEDERS = 100
+FILES_PER_SEEDER = 1000
+DURATION = 3
+CLIENTS = [1, 10, 100]
+
+def request(handler, operation, args):
+    req = OperationRequest(operation=operation, args=args)
+    handler.send(req.export())
+    return Response.load(handler.recv())
+
+def seederAddress(i):
+    return f'10.255.{i // 250}.{i % 250 + 1}'
+
+def populate(context):
+    handler = utils.TrackerHandler(context)
+    handler.setsockopt(zmq.RCVTIMEO, 10000)
+    fileHashes = []
+
+    for i in range(SEEDERS):
+        files = {}
+        for j in range(FILES_PER_SEEDER):
+            fileHash = f'{random.getrandbits(20):05x}'
+            files[fileHash] = File(name=f'file-{i}-{j}.dat', size=random.randint(1, 1 << 20), lastModified=time.time())
+            fileHashes.append(fileHash)
+
+        # Unroutable addresses, kept alive by heartbeat(). Replication jobs sent to them time out in the background
+        res = request(handler, TRACKER_OPERATIONS['SEEDER_REGISTER'], {"address": seederAddress(i), "files": files, "sequence": 0})
+        if res.status != 200:
+            raise Exception(res.message)
+
+    handler.close()
+    return fileHashes
+
+# Publish the heartbeats of the synthetic seeders, or the tracker drops them as offline during the run
+def heartbeat(context, stop):
+    sock = context.socket(zmq.PUB)
+    sock.connect(f"tcp://{utils.TRACKER_ADDRESS}:{HEARTBEAT_PORT}")
+
+    while not stop.is_set():
+        for i in range(SEEDERS):
+            req = OperationRequest(operation=TRACKER_OPERATIONS['HEARTBEAT'], args={"address": seederAddress(i), "stats": {}})
+            sock.send_multipart(req.export())
+
+        stop.wait(HEARTBEAT_INTERVAL)
+
+    sock.close(0)
+
+def client(context, fileHashes, deadline, latencies):
+    handler = utils.TrackerHandler(context)
+    handler.setsockopt(zmq.RCVTIMEO, 10000)
+
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        res = request(handler, TRACKER_OPERATIONS['GET'], {"fileHash": random.choice(fileHashes)})
+        latencies.append(time.perf_counter() - start)
+
+        # A failed lookup is not a measurement of the tracker serving files
+        assert res.status == 200, res.message
+
+    handler.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--directory', help='tracker data directory, a new temporary one by default')
+    options = parser.parse_args()
+
+    # A fresh directory, so the tracker does not start from the catalog of a previous run
+    directory = options.directory or tempfile.mkdtemp(prefix='tracker-benchmark-')
+
+    # tracker/utils.py is a placeholder for the shared utils.py mounted by docker compose, so put the real one first
+    environment = dict(os.environ, TRACKER_WORKERS=str(options.workers), TRACKER_DIRECTORY=directory)
+    bootstrap = f"import sys; sys.path[:0] = [{ROOT!r}, {os.path.join(ROOT, 'tracker')!r}]; import tracker; tracker.main()"
+    tracker = subprocess.Popen([sys.executable, '-c', bootstrap], env=environment, stdout=subprocess.DEVNULL)
+
+    stop = threading.Event()
+
+    try:
+        context = zmq.Context()
+        time.sleep(1)
+
+        threading.Thread(target=heartbeat, args=(context, stop), daemon=True).start()
+        fileHashes = populate(context)
+
+        print(f"workers={options.workers} seeders={SEEDERS} files={SEEDERS * FILES_PER_SEEDER}")
+        print(f"{'clients':>8} {'requests/s':>12} {'p50 ms':>8} {'p99 ms':>8}")
+
+        for clients in CLIENTS:
+            latencies = []
+            deadline = time.perf_counter() + DURATION
+            threads = [threading.Thread(target=client, args=(context, fileHashes, deadline, latencies)) for _ in range(clients)]
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            latencies.sort()
+            print(f"{clients:>8} {len(latencies) / DURATION:>12.0f} {latencies[len(latencies) // 2] * 1000:>8.2f} {latencies[int(len(latencies) * 0.99)] * 1000:>8.2f}")
+    finally:
+        stop.set()
+        tracker.kill()
+
+        if not options.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    # The tracker listens on the address of this machine
+    utils.TRACKER_ADDRESS = getIpAddress()
+    main()
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import shutil
+import threading
+from utils import getOutputFilepath, atomicWrite
+
+class DownloadCache:
+    """
+    Content addressed cache of the downloaded files, so getting or previewing a file again does not go
+    back to the cluster. Files are kept under their hash and handed out as hardlinks (copies across filesystems):
+        - <directory>/<fileHash>: file data
+        - <directory>/index.json: fileHash -> {"name", "size", "mtime", "merkleRoot", "lastAccess"}
+    At most "maxBytes" are kept, the least recently used files are evicted first.
+    A hardlinked copy shares its data with the cache, so an entry whose file changed ("size" or "mtime")
+    is dropped instead of being served.
+    Lookups only update "lastAccess" in memory: the index is written when files are added or evicted and on close,
+    so a hit costs no disk write. Access times lost in a crash only make the eviction order a little less exact
+    """
+    def __init__(self, directory, maxBytes):
+        self.lock = threading.Lock()
+
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.indexPath = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+
+        # Whether entries changed since the index was last written
+        self.dirty = False
+
+        self.entries = {}
+        if os.path.exists(self.indexPath):
+            try:
+                with open(self.indexPath, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                # A corrupted index only costs the cached files
+                self.entries = {}
+
+    def dataPath(self, fileHash):
+        return os.path.join(self.directory, fileHash)
+
+    # The entry of "fileHash" if its file is cached and unchanged
+    def lookup(self, fileHash):
+        with self.lock:
+            entry = self.entries.get(fileHash)
+
+            if entry and not self.validLocked(fileHash, entry):
+                self.dropLocked(fileHash)
+                self.dirty = True
+                entry = None
+
+            if not entry:
+                return None
+
+            entry['lastAccess'] = time.time()
+            self.dirty = True
+
+            return dict(entry)
+
+    # Put the cached file in "outputDirectory" and return its path, or None when it is not cached.
+    # A file of the same name already linked to the cached data is returned as is
+    def materialize(self, fileHash, outputDirectory='./'):
+        entry = self.lookup(fileHash)
+        if not entry:
+            return None
+
+        existing = os.path.join(outputDirectory, entry['name'])
+        if os.path.exists(existing) and os.path.samefile(existing, self.dataPath(fileHash)):
+            return existing
+
+        outputFilepath = getOutputFilepath(entry['name'], outputDirectory)
+
+        try:
+            os.link(self.dataPath(fileHash), outputFilepath)
+        except OSError:
+            shutil.copyfile(self.dataPath(fileHash), outputFilepath)
+
+        return outputFilepath
+
+    # (name, first "count" bytes) of a cached file, or None when it is not cached
+    def preview(self, fileHash, count):
+        entry = self.lookup(fileHash)
+        if not entry:
+            return None
+
+        with open(self.dataPath(fileHash), 'rb') as f:
+            return entry['name'], f.read(count)
+
+    # Add a downloaded (and verified) file. The file is linked into the cache, or copied when it cannot be
+    def add(self, fileHash, filePath, name, merkleRoot=None):
+        size = os.path.getsize(filePath)
+        if size > self.maxBytes:
+            return
+
+        path = self.dataPath(fileHash)
+
+        with self.lock:
+            if fileHash in self.entries:
+                self.dropLocked(fileHash)
+
+            try:
+                os.link(filePath, path)
+            except OSError:
+                shutil.copyfile(filePath, path + '.tmp')
+                os.replace(path + '.tmp', path)
+
+            self.entries[fileHash] = {"name": name, "size": size, "mtime": os.stat(path).st_mtime_ns, "merkleRoot": merkleRoot, "lastAccess": time.time()}
+
+            # Evict the least recently used files until the cache fits
+            total = sum(entry['size'] for entry in self.entries.values())
+            for oldest in sorted(self.entries, key=lambda key: self.entries[key]['lastAccess']):
+                if total <= self.maxBytes:
+                    break
+                total -= self.entries[oldest]['size']
+                self.dropLocked(oldest)
+
+            self.saveLocked()
+
+    # Write the access times of the lookups since the last save
+    def close(self):
+        with self.lock:
+            if self.dirty:
+                self.saveLocked()
+
+    def validLocked(self, fileHash, entry)->bool:
+        try:
+            stat = os.stat(self.dataPath(fileHash))
+        except OSError:
+            return False
+
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+    def dropLocked(self, fileHash):
+        self.entries.pop(fileHash, None)
+
+        if os.path.exists(self.dataPath(fileHash)):
+            os.remove(self.dataPath(fileHash))
+
+    def saveLocked(self):
+        atomicWrite(self.indexPath, json.dumps(self.entries))
+        self.dirty = False
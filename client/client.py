@@ -1,12 +1,21 @@
 import zmq
 import re
-import pickle
 import os
+import time
 import signal
 import heapq
 import readline
-import random
-from utils import OperationRequest, Response, TrackerHandler, SeederHandler, hash, File, TRACKER_OPERATIONS, SEEDER_OPERATIONS, getFileDistributedly
+import asyncio
+from utils import hash, File
+from cache import DownloadCache
+from offshore import OffshoreClient, OffshoreError
+
+PREVIEW_TIMEOUT = 5000
+PREVIEW_SIZE = 256
+
+# Downloaded files are kept in CACHE_DIRECTORY, CACHE_BYTES at most, so getting them again does not touch the cluster
+CACHE_DIRECTORY = os.environ.get('CACHE_DIRECTORY', '.cache')
+CACHE_BYTES = int(os.environ.get('CACHE_BYTES', 1024 * 1024 * 1024))
 
 class EmptyException(Exception):
     pass
@@ -62,20 +71,26 @@ class Client:
     def __init__(self):
         self.context = zmq.Context()
 
-        self.trackerHandler = TrackerHandler(self.context)
+        # Every command is a call of the client library (see offshore.py), run to completion on this loop
+        self.offshore = OffshoreClient(self.context, cache=DownloadCache(CACHE_DIRECTORY, CACHE_BYTES))
+        self.loop = asyncio.new_event_loop()
 
         self.COMMANDS = [
             Command(label=["help", "h"], regexes=[r"^help$", r"^h$"], description="Show this help message", handler=self.helpHandler),
             Command(label=["exit", "e"], regexes=[r"^exit$", r"^e$"], description="Exit the client", handler=self.exitHandler),
             Command(label=["ping"], regexes=[r"^ping$"], description="Ping the Tracker", handler=self.pingHandler),
-            Command(label=["list [-l]", "ls [-l]"], regexes=[r"^list(\s+-l)?$", r"^ls(\s+-l)?$"], description="List all files in the filesystem", handler=self.listHandler),
+            Command(label=["list [-l] [-r] [<prefix|glob>]", "ls [-l] [-r] [<prefix|glob>]"], regexes=[r"^list(\s+-l)?(\s+-r)?(?:\s+([^\s\-]\S*))?$", r"^ls(\s+-l)?(\s+-r)?(?:\s+([^\s\-]\S*))?$"], description="List the files in the filesystem by name (-r: in reverse)", handler=self.listHandler),
             Command(label=["get <fileHash>"], regexes=[r"^get\s+([a-f0-9]{5})$"], description="Download a file", handler=self.getHandler),
-            Command(label=["upload <filePath>"], regexes=[r"^upload\s+(\.?(/?[a-zA-Z0-9\-_]+)+(\.[a-zA-Z0-9]+)?)$"], description="Upload a file", handler=self.uploadHandler),
+            Command(label=["repair <fileHash> <filePath>"], regexes=[r"^repair\s+([a-f0-9]{5})\s+(\.?(/?[a-zA-Z0-9\-_]+)+(\.[a-zA-Z0-9]+)?)$"], description="Fetch again the corrupted chunks of a downloaded file", handler=self.repairHandler),
+            Command(label=["upload [--chain] [-r] <filePath>"], regexes=[r"^upload(\s+--chain)?(\s+-r)?\s+(\.?(/?[a-zA-Z0-9\-_]+)+(\.[a-zA-Z0-9]+)?/?)$"], description="Upload a file (--chain: to all its replicas at once, -r: every file in a directory)", handler=self.uploadHandler),
             Command(label=["clear"], regexes=[r"^clear$"], description="Clear the screen", handler=self.clearHandler),
             Command(label=["list-local [-l]", "ll [-l]"], regexes=[r"^list-local(\s+-l)?$", r"^ll(\s+-l)?$"], description="List files in the local filesystem", handler=self.listLocalHandler),
             Command(label=["preview [--hex] <fileHash>", "pv [--hex] <fileHash>"], regexes=[r"^preview(\s+--hex)?\s+([a-f0-9]{5})$", r"^pv(\s+--hex)?\s+([a-f0-9]{5})$"], description="Preview a file", handler=self.previewHandler),
         ]
 
+    def call(self, operation):
+        return self.loop.run_until_complete(operation)
+
     def run(self):
         comHandler = CommandHandler()
 
@@ -97,15 +112,14 @@ class Client:
 
     def exitHandler(self, commandString, commandRegex):
         print("Exiting...")
+        self.offshore.close()
         exit()
 
     def pingHandler(self, commandString, commandRegex):
-        req = OperationRequest(operation=TRACKER_OPERATIONS['PING'], args={"message": "Hello Tracker"})
-        self.trackerHandler.send(req.export())
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
-        if res.status == 200:
-            print(res.message)
+        try:
+            print(self.call(self.offshore.ping()))
+        except OffshoreError as e:
+            print(e.args[0])
 
     def clearHandler(self, commandString, commandRegex):
         os.system('clear')
@@ -115,23 +129,26 @@ class Client:
         match = re.search(commandRegex, commandString)
 
         longListing = True if match and match.group(1) else False
-        
-        req = OperationRequest(operation=TRACKER_OPERATIONS['LIST'], args={})
-        self.trackerHandler.send(req.export())
-
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
-
-        if res.status != 200:
-            print(res.message)
-
-        # Message is a dictionary of {filehash: File}. Print it nicely
-        if longListing:
-            for fileHash, file in res.message.items():
-                print(f"{file.size}\t{file.lastModified}\t{fileHash} {file.name}")
-        else:
-            for fileHash, file in res.message.items():
-                print(f"({fileHash}) {file.name} \t")
+        reverse = True if match and match.group(2) else False
+        nameFilter = match.group(3) or ''
+
+        # A glob matches whole names, anything else is a prefix
+        globbing = any(character in nameFilter for character in '*?[')
+        prefix = '' if globbing else nameFilter
+        pattern = nameFilter if globbing else None
+
+        # Files are printed a page at a time as they come from the tracker
+        async def printFiles():
+            async for fileHash, file in self.offshore.iterList(prefix=prefix, pattern=pattern, reverse=reverse):
+                if longListing:
+                    print(f"{file.size}\t{file.lastModified}\t{fileHash} {file.name}")
+                else:
+                    print(f"({fileHash}) {file.name} \t")
+
+        try:
+            self.call(printFiles())
+        except OffshoreError as e:
+            print(e.args[0])
 
     def listLocalHandler(self, commandString, commandRegex):
         # Using the re match to check if the -l flag is present
@@ -155,110 +172,106 @@ class Client:
         match = re.search(commandRegex, commandString)
         fileHash = match.group(1)
 
-        req = OperationRequest(operation=TRACKER_OPERATIONS['GET'], args={"fileHash": fileHash})
-        self.trackerHandler.send(req.export())
+        try:
+            outputFilename = self.call(self.offshore.get(fileHash))
+        except OffshoreError as e:
+            print(e.args[0])
+            return
 
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
+        print(f"Downloaded file {outputFilename}")
 
-        if res.status != 200:
-            print(res.message)
-            return
+    def repairHandler(self, commandString, commandRegex):
+        match = re.search(commandRegex, commandString)
+        fileHash = match.group(1)
+        filePath = match.group(2)
 
-        fileInformation = res.message
+        if not os.path.exists(filePath):
+            print(f"File {filePath} does not exist")
+            return
 
-        outputFilename = getFileDistributedly(self.context, fileInformation)
+        try:
+            outputFilename = self.call(self.offshore.repair(fileHash, filePath))
+        except OffshoreError as e:
+            print(e.args[0])
+            return
 
-        print(f"Downloaded file {outputFilename}")
+        print(f"Repaired file {outputFilename}")
 
     def uploadHandler(self, commandString, commandRegex):
         match = re.search(commandRegex, commandString)
-        filePath = match.group(1)
+        chain = True if match.group(1) else False
+        recursive = True if match.group(2) else False
+        filePath = match.group(3)
 
         if not os.path.exists(filePath):
             print(f"File {filePath} does not exist")
             return
-        
-        fileHash = hash(filePath)[:5]
-        fileSize = os.path.getsize(filePath)
-        fileLastModified = os.path.getmtime(filePath)
-
-        file = File(name=os.path.basename(filePath), size=fileSize, lastModified=fileLastModified)
 
-        req = OperationRequest(operation=TRACKER_OPERATIONS['UPLOAD'], args={"fileHash": fileHash, "fileSize": fileSize})
-        self.trackerHandler.send(req.export())
+        if recursive:
+            self.uploadTree(filePath, chain)
+            return
 
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
+        try:
+            _, replicas = self.call(self.offshore.put(filePath, chain=chain))
+        except OffshoreError as e:
+            print(e.args[0])
+            return
+        
+        print(f"Uploaded file {filePath} to {len(replicas)} seeder{'s' if len(replicas) > 1 else ''}")
 
-        if res.status != 200:
-            print(res.message)
+    def uploadTree(self, directory, chain):
+        if not os.path.isdir(directory):
+            print(f"{directory} is not a directory")
             return
 
-        seederAddress = res.message['address']
+        completed = []
+        failed = []
+        start = time.time()
 
-        with open(filePath, 'rb') as f:
-            fileData = f.read()
-            f.close()
+        def progress(filePath, result):
+            if isinstance(result, OffshoreError):
+                failed.append((filePath, result.args[0]))
+            else:
+                completed.append(filePath)
 
-        seederHandler = SeederHandler(self.context, seederAddress)
-        req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD'], args={"fileHash": fileHash, "file":file, "fileData": fileData})
-        seederHandler.send(req.export())
+            print(f"\rUploaded {len(completed)} files, {len(failed)} failed", end='', flush=True)
 
-        res = seederHandler.recv()
-        res = Response(**pickle.loads(res))
+        self.call(self.offshore.putTree(directory, chain=chain, progress=progress))
+        print()
 
-        if res.status != 200:
-            print(res.message)
-            return
-        
-        print(f"Uploaded file {filePath}")
+        for filePath, reason in failed:
+            print(f"{filePath}: {reason}")
+
+        print(f"Uploaded {len(completed)} files from {directory} in {time.time() - start:.1f}s")
 
     def previewHandler(self, commandString, commandRegex):
         match = re.search(commandRegex, commandString)
         hexPreview = True if match and match.group(1) else False
         fileHash = match.group(2)
 
-        req = OperationRequest(operation=TRACKER_OPERATIONS['GET'], args={"fileHash": fileHash})
-        self.trackerHandler.send(req.export())
-
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
-
-        if res.status != 200:
-            print(res.message)
+        # Only the first block of the file is fetched
+        try:
+            fileName, fileData = self.call(self.offshore.preview(fileHash, PREVIEW_SIZE, timeout=PREVIEW_TIMEOUT))
+        except OffshoreError as e:
+            print(e.args[0])
             return
 
-        # fileInformation = {'fileHash', 'fileName', 'size', 'seeders'}
-        fileInformation = res.message
-        fileHash = fileInformation['fileHash']
-        fileName = fileInformation['fileName']
-        fileSize = fileInformation['size']
-        seeder = random.choice(fileInformation['seeders'])
+        printPreview(fileName, fileHash, fileData, hexPreview)
 
-        seederHandler = SeederHandler(self.context, seeder)
-        req = OperationRequest(operation=SEEDER_OPERATIONS['GET'], args={"fileHash": fileHash, "offset": 0, "count": 256})
-        seederHandler.send(req.export())
-
-        res = seederHandler.recv()
-        res = Response(**pickle.loads(res))
-
-        if res.status != 200:
-            print(res.message)
-            return
-        
-        fileData = res.message['data']
-
-        if hexPreview:
-            print(f"Preview of {fileName} ({fileHash})")
+#
+# Print the first bytes of a file, as text when they decode
+#
+def printPreview(fileName, fileHash, fileData, hexPreview):
+    if hexPreview:
+        print(f"Preview of {fileName} ({fileHash})")
+        printHex(fileData)
+    else:
+        print(f"Preview of {fileName} ({fileHash})")
+        try:
+            print(fileData.decode())
+        except:
+            print("Unable to decode file")
             printHex(fileData)
-        else:
-            print(f"Preview of {fileName} ({fileHash})")
-            try:
-                print(fileData.decode())
-            except:
-                print("Unable to decode file")
-                printHex(fileData)
 
 #
 # Print Hexdump of data
@@ -0,0 +1 @@
+../erasure.py
\ No newline at end of file
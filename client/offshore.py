@@ -0,0 +1,374 @@
+import os
+import asyncio
+import functools
+import threading
+import zmq
+from concurrent.futures import ThreadPoolExecutor
+from utils import OperationRequest, Response, TrackerHandler, ShardMap, File, hash, TRACKER_OPERATIONS, TRACKER_ADDRESS, MISDIRECTED_STATUS, getFileDistributedly, uploadFile, connectionPool
+from erasure import getFileFromShards
+from remotefile import OffshoreFile
+
+TRACKER_TIMEOUT = 10000
+
+# Operations of an OffshoreClient running at the same time
+CLIENT_CONCURRENCY = int(os.environ.get('CLIENT_CONCURRENCY', 8))
+
+# Directory uploads hash files on HASH_WORKERS threads, place them UPLOAD_BATCH_SIZE at a time with
+# a single tracker request and keep at most UPLOAD_SEEDER_STREAMS uploads in flight per seeder
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 4))
+UPLOAD_BATCH_SIZE = int(os.environ.get('UPLOAD_BATCH_SIZE', 1000))
+UPLOAD_SEEDER_STREAMS = int(os.environ.get('UPLOAD_SEEDER_STREAMS', 2))
+
+# Files asked for per LIST page
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 1000))
+
+class OffshoreError(Exception):
+    """
+    Failed operation. "status" is the status the tracker answered with, when it answered
+    """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class OffshoreClient:
+    """
+    Asynchronous client library of the filesystem, for programs moving many files:
+
+        async with OffshoreClient() as offshore:
+            files = await offshore.list()
+            paths = await offshore.getMany(files, outputDirectory='./data')
+
+    Tracker requests and transfers are blocking, so they run on a pool of "concurrency" threads: at most
+    "concurrency" of them are in progress at once and the rest wait for a thread. Connections to the tracker
+    and the seeders are shared by every call through the connection pool of "context".
+    The batch calls start every operation at once and return their results in order, an OffshoreError in
+    place of the ones that failed. With a "cache" (see cache.DownloadCache) files are looked up there first.
+    Requests about a file go to the tracker shard owning it, from the shard map the tracker at "trackerAddress"
+    gives on first use (see utils.ShardMap). Listings merge the listings of every shard
+    """
+    def __init__(self, context=None, concurrency=CLIENT_CONCURRENCY, cache=None, trackerAddress=TRACKER_ADDRESS):
+        self.context = context or zmq.Context.instance()
+        self.pool = connectionPool(self.context)
+        self.cache = cache
+        self.trackerAddress = trackerAddress
+
+        # Asked for again when a shard answers that another one owns the file
+        self.shardMap = None
+        self.shardLock = threading.Lock()
+
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exception):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+        if self.cache:
+            self.cache.close()
+
+    async def ping(self, message='Hello Tracker'):
+        return await self.call(self.request, TRACKER_OPERATIONS['PING'], {"message": message})
+
+    # fileHash -> File of the files in the filesystem, in name order (see iterList)
+    async def list(self, prefix='', pattern=None, reverse=False)->dict:
+        return {fileHash: file async for fileHash, file in self.iterList(prefix, pattern, reverse)}
+
+    # (fileHash, File) of the files whose name starts with "prefix" and matches the "pattern" glob, in name order.
+    # They are fetched from the tracker a page of "pageSize" files at a time, the next page while this one is read:
+    #
+    #     async for fileHash, file in offshore.iterList(prefix='logs-'):
+    #         ...
+    async def iterList(self, prefix='', pattern=None, reverse=False, pageSize=LIST_PAGE_SIZE):
+        args = {"limit": pageSize, "prefix": prefix, "pattern": pattern, "reverse": reverse}
+
+        shardMap = await self.call(self.getShardMap)
+        streams = [self.iterShard(address, args) for address in shardMap.shards]
+
+        async def nextItem(stream):
+            async for item in stream:
+                return item
+            return None
+
+        # Every shard lists its own files in name order, so the next file is the first of their next ones
+        try:
+            heads = dict(enumerate(await asyncio.gather(*(nextItem(stream) for stream in streams))))
+
+            while True:
+                heads = {index: item for index, item in heads.items() if item}
+                if not heads:
+                    break
+
+                index = (max if reverse else min)(heads, key=lambda index: (heads[index][1].name, heads[index][0]))
+                yield heads[index]
+
+                heads[index] = await nextItem(streams[index])
+        finally:
+            for stream in streams:
+                await stream.aclose()
+
+    # (fileHash, File) of the files listed by the tracker shard at "address", the next page fetched while this one is read
+    async def iterShard(self, address, args):
+        page = asyncio.ensure_future(self.call(self.request, TRACKER_OPERATIONS['LIST'], args, address))
+
+        try:
+            while page:
+                message = await page
+
+                cursor = message['next']
+                page = asyncio.ensure_future(self.call(self.request, TRACKER_OPERATIONS['LIST'], dict(args, cursor=cursor), address)) if cursor else None
+
+                for item in message['files'].items():
+                    yield item
+        finally:
+            # The caller stopped before the end
+            if page:
+                page.cancel()
+
+    # What the tracker knows about a file: {'fileHash', 'fileName', 'size', 'seeders', 'merkleRoot', ...}
+    async def stat(self, fileHash)->dict:
+        return await self.call(self.requestOwner, fileHash, TRACKER_OPERATIONS['GET'], {"fileHash": fileHash})
+
+    # Download a file to "outputDirectory". Returns its path
+    async def get(self, fileHash, outputDirectory='./')->str:
+        if self.cache:
+            outputFilepath = await self.call(self.cache.materialize, fileHash, outputDirectory)
+            if outputFilepath:
+                return outputFilepath
+
+        fileInformation = await self.stat(fileHash)
+        return await self.call(self.download, fileInformation, outputDirectory)
+
+    # Upload a file. Returns (fileHash, seeders holding it). With "chain" it is replicated as it is sent
+    async def put(self, filePath, chain=False):
+        return await self.call(self.upload, filePath, chain)
+
+    # Upload every file under "directory". Returns filePath -> (fileHash, seeders holding it), or an OffshoreError
+    # for the files that failed or were already in the filesystem. "progress" is called with (filePath, result)
+    # as every file completes.
+    # Hashing and placing the next batch overlaps the uploads of the current one. A seeder answers one request
+    # at a time, so uploads are spread over the seeders instead of queueing up behind the busiest one
+    async def putTree(self, directory, chain=False, progress=None)->dict:
+        filePaths = await self.call(listTree, directory)
+        results = {}
+        streams = {}
+
+        loop = asyncio.get_running_loop()
+        hasher = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+
+        def complete(filePaths, result):
+            for filePath in filePaths:
+                results[filePath] = result
+                if progress:
+                    progress(filePath, result)
+
+        async def send(fileHash, filePaths, file, placement):
+            stream = streams.setdefault(placement['address'], asyncio.Semaphore(UPLOAD_SEEDER_STREAMS))
+
+            async with stream:
+                try:
+                    result = fileHash, await self.call(self.send, filePaths[0], fileHash, file, placement)
+                except OffshoreError as e:
+                    result = e
+
+            complete(filePaths, result)
+
+        try:
+            uploads = []
+
+            for start in range(0, len(filePaths), UPLOAD_BATCH_SIZE):
+                batch = filePaths[start:start + UPLOAD_BATCH_SIZE]
+                described = await asyncio.gather(*(loop.run_in_executor(hasher, describe, filePath) for filePath in batch), return_exceptions=True)
+
+                # Files with the same content are sent once
+                files = {}
+                for filePath, description in zip(batch, described):
+                    if isinstance(description, Exception):
+                        complete([filePath], OffshoreError(f'Unable to read {filePath}: {description}'))
+                        continue
+
+                    fileHash, file = description
+                    files.setdefault(fileHash, (file, []))[1].append(filePath)
+
+                if not files:
+                    continue
+
+                # One placement request per tracker shard, all at once
+                shardMap = await loop.run_in_executor(hasher, self.getShardMap)
+                parts = shardMap.split(files)
+                answers = await asyncio.gather(*(loop.run_in_executor(hasher, self.request, TRACKER_OPERATIONS['UPLOAD_BATCH'], {
+                    "files": [{"fileHash": fileHash, "fileSize": file.size} for fileHash, (file, _) in part.items()],
+                    "chain": chain,
+                }, shardMap.shards[shard]) for shard, part in parts.items()), return_exceptions=True)
+
+                placements = {}
+                for part, answer in zip(parts.values(), answers):
+                    if isinstance(answer, Exception):
+                        for _, paths in part.values():
+                            complete(paths, answer if isinstance(answer, OffshoreError) else OffshoreError(str(answer)))
+                        continue
+
+                    for fileHash, reason in answer['rejected'].items():
+                        complete(files[fileHash][1], OffshoreError(reason, 400))
+
+                    placements.update(answer['placements'])
+
+                # The previous batch is done before this one starts, so batches do not pile up on the executor
+                await asyncio.gather(*uploads)
+                uploads = [asyncio.ensure_future(send(fileHash, files[fileHash][1], files[fileHash][0], placement)) for fileHash, placement in placements.items()]
+
+            await asyncio.gather(*uploads)
+        finally:
+            hasher.shutdown(wait=False)
+
+        return results
+
+    # Fetch again the chunks of a downloaded file that do not match their hash
+    async def repair(self, fileHash, filePath)->str:
+        fileInformation = await self.stat(fileHash)
+
+        outputFilepath = await self.call(getFileDistributedly, self.context, fileInformation, repairFilepath=filePath)
+        if not outputFilepath:
+            raise OffshoreError(f'Unable to repair {filePath}')
+
+        return outputFilepath
+
+    # Seekable file object reading the file from the seeders as it is read (see remotefile.OffshoreFile).
+    # Its reads are blocking: call them from a thread (e.g. asyncio.to_thread) when the event loop has other work
+    async def open(self, fileHash, **options)->OffshoreFile:
+        fileInformation = await self.stat(fileHash)
+        return OffshoreFile(self.context, fileInformation, **options)
+
+    # (name, first "count" bytes) of a file
+    async def preview(self, fileHash, count, timeout=None):
+        if self.cache:
+            cached = await self.call(self.cache.preview, fileHash, count)
+            if cached:
+                return cached
+
+        fileInformation = await self.stat(fileHash)
+        options = {"timeout": timeout} if timeout else {}
+
+        def read():
+            with OffshoreFile(self.context, fileInformation, **options) as remoteFile:
+                return remoteFile.read(count)
+
+        try:
+            return fileInformation['fileName'], await self.call(read)
+        except OSError as e:
+            raise OffshoreError(e.args[0])
+
+    async def getMany(self, fileHashes, outputDirectory='./')->list:
+        return await self.gather(self.get(fileHash, outputDirectory) for fileHash in fileHashes)
+
+    async def putMany(self, filePaths, chain=False)->list:
+        return await self.gather(self.put(filePath, chain) for filePath in filePaths)
+
+    async def statMany(self, fileHashes)->list:
+        return await self.gather(self.stat(fileHash) for fileHash in fileHashes)
+
+    async def gather(self, operations)->list:
+        results = await asyncio.gather(*operations, return_exceptions=True)
+        return [result if not isinstance(result, Exception) or isinstance(result, OffshoreError) else OffshoreError(str(result)) for result in results]
+
+    async def call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    # Blocking calls, run on the executor
+
+    # Request to the tracker at "address", the one at "trackerAddress" by default
+    def request(self, operation, args, address=None):
+        req = OperationRequest(operation=operation, args=args)
+
+        try:
+            with self.pool.connection(TrackerHandler, address or self.trackerAddress, timeout=TRACKER_TIMEOUT) as trackerHandler:
+                trackerHandler.send(req.export())
+                res = Response.load(trackerHandler.recv())
+        except zmq.error.Again:
+            raise OffshoreError('Tracker timed out')
+
+        # The shards changed since the map was fetched. The answer carries the current map
+        if res.status == MISDIRECTED_STATUS:
+            with self.shardLock:
+                self.shardMap = ShardMap.load(res.message)
+            raise OffshoreError('Asked the wrong tracker shard', res.status)
+
+        if res.status != 200:
+            raise OffshoreError(res.message, res.status)
+
+        return res.message
+
+    # Request about "key" to the tracker shard owning it, asked again once if the map was outdated
+    def requestOwner(self, key, operation, args):
+        for attempt in range(2):
+            try:
+                return self.request(operation, args, self.getShardMap().owner(key))
+            except OffshoreError as e:
+                if e.status != MISDIRECTED_STATUS or attempt:
+                    raise
+
+    def getShardMap(self)->ShardMap:
+        with self.shardLock:
+            if self.shardMap is None:
+                try:
+                    self.shardMap = ShardMap.load(self.request(TRACKER_OPERATIONS['SHARD_MAP'], {}))
+                except OffshoreError as e:
+                    # A tracker that answers without knowing the operation is not sharded
+                    if e.status is None:
+                        raise
+                    self.shardMap = ShardMap([self.trackerAddress])
+
+            return self.shardMap
+
+    def download(self, fileInformation, outputDirectory)->str:
+        # Erasure coded files come with shard sources instead of seeders holding whole copies
+        if fileInformation.get('sources'):
+            outputFilepath = getFileFromShards(self.context, fileInformation, outputDirectory)
+        else:
+            outputFilepath = getFileDistributedly(self.context, fileInformation, outputDirectory)
+
+        if not outputFilepath:
+            raise OffshoreError(f'Unable to download {fileInformation["fileName"]}')
+
+        if self.cache:
+            self.cache.add(fileInformation['fileHash'], outputFilepath, fileInformation['fileName'], fileInformation.get('merkleRoot'))
+
+        return outputFilepath
+
+    def upload(self, filePath, chain):
+        if not os.path.isfile(filePath):
+            raise OffshoreError(f'File {filePath} does not exist')
+
+        fileHash, file = describe(filePath)
+
+        placement = self.requestOwner(fileHash, TRACKER_OPERATIONS['UPLOAD'], {"fileHash": fileHash, "fileSize": file.size, "chain": chain})
+
+        return fileHash, self.send(filePath, fileHash, file, placement)
+
+    # Send a placed file to its seeders. Returns the seeders holding it
+    def send(self, filePath, fileHash, file, placement)->list:
+        try:
+            return uploadFile(self.context, placement['address'], filePath, fileHash, file, chain=placement.get('chain', []))
+        except Exception as e:
+            raise OffshoreError(e.args[0] if e.args else str(e))
+
+# (fileHash, File) of a local file
+def describe(filePath):
+    fileHash = hash(filePath)[:5]
+    file = File(name=os.path.basename(filePath), size=os.path.getsize(filePath), lastModified=os.path.getmtime(filePath))
+
+    return fileHash, file
+
+# Paths of the files under "directory", in a stable order
+def listTree(directory)->list:
+    filePaths = []
+
+    for root, directories, fileNames in os.walk(directory):
+        directories.sort()
+        filePaths.extend(os.path.join(root, fileName) for fileName in sorted(fileNames) if os.path.isfile(os.path.join(root, fileName)))
+
+    return filePaths
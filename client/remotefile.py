@@ -0,0 +1,263 @@
+import io
+import random
+import zmq
+from collections import OrderedDict
+from utils import SeederStreamHandler, connectionPool, getChunkHashes, chunkDigest, STREAM_CHUNK_SIZE, STREAM_TIMEOUT, MERKLE_DIGEST_SIZE
+
+# Blocks kept in memory by an OffshoreFile, and the most blocks read ahead at once
+REMOTE_CACHE_BLOCKS = 64
+REMOTE_READAHEAD_BLOCKS = 32
+
+class OffshoreFile(io.RawIOBase):
+    """
+    Read only, seekable file object over a file stored in the filesystem. Only the ranges that are read
+    are fetched from the seeders, in blocks of STREAM_CHUNK_SIZE bytes kept in a small LRU cache:
+        - blocks: block index -> bytes, "cacheBlocks" at most
+        - readahead: blocks fetched on the next miss. It doubles (up to "maxReadahead") while the file is
+          read sequentially and falls back to one block on a random access, so scanning a file streams it
+          and reading a footer fetches just the footer
+    Blocks of whole copies are verified against the Merkle leaves of the file when it has a root, and reading
+    fails when no seeder sends leaves matching it. Whole copies are read from any of their seeders, erasure
+    coded files from their data shards. Shard reads are not verified: the shard seeders keep no chunk digests,
+    only a whole file rebuilt by getFileFromShards is checked against its hash.
+    fileInformation is the answer of the tracker to GET ({'fileHash', 'fileName', 'size', 'seeders', 'merkleRoot', 'sources'...})
+    """
+    def __init__(self, context, fileInformation, cacheBlocks=REMOTE_CACHE_BLOCKS, maxReadahead=REMOTE_READAHEAD_BLOCKS, timeout=STREAM_TIMEOUT):
+        super().__init__()
+
+        self.context = context
+        self.pool = connectionPool(context)
+        self.timeout = timeout
+
+        self.fileHash = fileInformation['fileHash']
+        self.name = fileInformation['fileName']
+        self.size = fileInformation['size']
+        self.root = fileInformation.get('merkleRoot')
+        self.seeders = list(fileInformation.get('seeders') or [])
+        random.shuffle(self.seeders)
+
+        # Data shard sources by shard index, for files only kept as shards
+        self.shardLength = None
+        self.shardSources = {}
+        if not self.seeders and fileInformation.get('sources'):
+            self.shardLength = -(-self.size // fileInformation['dataShards'])
+            for source in fileInformation['sources']:
+                if source[0] < fileInformation['dataShards']:
+                    self.shardSources.setdefault(source[0], []).append(source)
+
+        self.blockSize = STREAM_CHUNK_SIZE
+        self.blockCount = -(-self.size // self.blockSize)
+        self.blocks = OrderedDict()
+        self.cacheBlocks = max(cacheBlocks, maxReadahead)
+        self.maxReadahead = maxReadahead
+        self.readahead = 1
+        self.lastBlock = None
+
+        # Fetched with the first block of a file that has a root
+        self.leaves = None
+
+        self.position = 0
+
+    def readable(self)->bool:
+        return True
+
+    def seekable(self)->bool:
+        return True
+
+    def tell(self)->int:
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET)->int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+
+        if position < 0:
+            raise ValueError('Negative seek position')
+
+        self.position = position
+        return position
+
+    def readinto(self, buffer)->int:
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+        if self.position >= self.size:
+            return 0
+
+        index = self.position // self.blockSize
+        block = self.block(index)
+
+        start = self.position - index * self.blockSize
+        count = min(len(buffer), len(block) - start)
+        buffer[:count] = block[start:start + count]
+
+        self.position += count
+        return count
+
+    # Unlike a raw read, reads "size" bytes unless the end of the file comes first
+    def read(self, size=-1)->bytes:
+        if size is None or size < 0:
+            size = max(self.size - self.position, 0)
+
+        data = bytearray(size)
+        view = memoryview(data)
+        count = 0
+
+        while count < size:
+            read = self.readinto(view[count:])
+            if not read:
+                break
+            count += read
+
+        return bytes(data[:count])
+
+    def readall(self)->bytes:
+        return self.read()
+
+    # Lines are looked for in the cached blocks, instead of the byte by byte default of raw files
+    def readline(self, size=-1)->bytes:
+        line = bytearray()
+
+        while (size is None or size < 0 or len(line) < size) and self.position < self.size:
+            index = self.position // self.blockSize
+            block = self.block(index)
+            start = self.position - index * self.blockSize
+
+            newline = block.find(b'\n', start)
+            end = newline + 1 if newline >= 0 else len(block)
+            if size is not None and size >= 0:
+                end = min(end, start + size - len(line))
+
+            line += block[start:end]
+            self.position += end - start
+
+            if newline >= 0 and end == newline + 1:
+                break
+
+        return bytes(line)
+
+    def block(self, index)->bytes:
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            self.lastBlock = index
+            return self.blocks[index]
+
+        # A miss right after the previous block means a sequential reader: read further ahead every time
+        if self.lastBlock is not None and index == self.lastBlock + 1:
+            self.readahead = min(self.readahead * 2, self.maxReadahead)
+        else:
+            self.readahead = 1
+
+        # Up to the next block already cached
+        count = 1
+        while count < self.readahead and index + count < self.blockCount and index + count not in self.blocks:
+            count += 1
+
+        start = index * self.blockSize
+        data = self.fetch(start, min(start + count * self.blockSize, self.size))
+
+        for i in range(count):
+            self.blocks[index + i] = data[i * self.blockSize:(i + 1) * self.blockSize]
+
+        while len(self.blocks) > self.cacheBlocks:
+            self.blocks.popitem(last=False)
+
+        self.lastBlock = index
+        return self.blocks[index]
+
+    # Bytes [start, end) of the file, verified block by block
+    def fetch(self, start, end)->bytes:
+        if self.shardLength is None:
+            return self.fetchFromSeeders(start, end)
+
+        data = bytearray()
+        position = start
+
+        # A range may span several data shards
+        while position < end:
+            index = position // self.shardLength
+            shardOffset = position - index * self.shardLength
+            count = min(end - position, self.shardLength - shardOffset)
+
+            data += self.fetchFromShard(index, shardOffset, count)
+            position += count
+
+        return bytes(data)
+
+    def fetchFromSeeders(self, start, end)->bytes:
+        if self.root and self.leaves is None:
+            self.leaves = getChunkHashes(self.context, self.fileHash, self.root, self.seeders)
+
+            # Like getFileDistributedly: data that cannot be checked is not handed out
+            if self.leaves is None:
+                raise OSError(f'No seeder sent chunk hashes matching {self.name}')
+
+        for seeder in list(self.seeders):
+            try:
+                data = self.streamFrom(seeder, self.fileHash, start, end - start)
+                self.verify(start, data)
+                return data
+            except zmq.error.Again:
+                print(f'Seeder {seeder}: timed out', flush=True)
+            except Exception as e:
+                print(f'Seeder {seeder}: {e.args[0] if e.args else e}', flush=True)
+
+            # Not asked again for this file
+            self.seeders.remove(seeder)
+
+        raise OSError(f'No seeder left to read {self.name}')
+
+    def fetchFromShard(self, index, offset, count)->bytes:
+        for source in list(self.shardSources.get(index, [])):
+            _, address, key, sourceOffset, length = source
+
+            try:
+                data = self.streamFrom(address, key, sourceOffset + offset, max(min(count, length - offset), 0))
+                # Past the end of a source the shard is zero padding
+                return data + bytes(count - len(data))
+            except zmq.error.Again:
+                print(f'Seeder {address}: timed out', flush=True)
+            except Exception as e:
+                print(f'Seeder {address}: {e.args[0] if e.args else e}', flush=True)
+
+            self.shardSources[index].remove(source)
+
+        raise OSError(f'Data shard {index} of {self.name} is unavailable, the file has to be rebuilt with get')
+
+    def streamFrom(self, address, key, offset, count)->bytes:
+        if count <= 0:
+            return b''
+
+        handler = self.pool.acquire(SeederStreamHandler, address, timeout=self.timeout)
+        completed = False
+
+        try:
+            data = bytearray()
+            for _, frame in handler.streamRange(key, offset, count, chunkSize=self.blockSize):
+                data += frame
+
+            if len(data) != count:
+                raise Exception('short read')
+
+            completed = True
+            return bytes(data)
+        finally:
+            # A stream left half read still has replies in flight
+            self.pool.release(handler, healthy=completed)
+
+    def verify(self, start, data):
+        if self.leaves is None:
+            return
+
+        for i, blockStart in enumerate(range(0, len(data), self.blockSize)):
+            index = start // self.blockSize + i
+            leaf = self.leaves[index * MERKLE_DIGEST_SIZE:(index + 1) * MERKLE_DIGEST_SIZE]
+
+            if chunkDigest(data[blockStart:blockStart + self.blockSize]) != leaf:
+                raise Exception(f'block {index} does not match its hash')
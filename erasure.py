@@ -0,0 +1,252 @@
+import os
+import math
+import numpy as np
+from utils import SeederStreamHandler, connectionPool, getOutputFilepath, hashChunks, merkleRoot, STREAM_CHUNK_SIZE, STREAM_TIMEOUT
+
+# Reed-Solomon erasure coding over GF(256).
+# A file of "size" bytes is cut in k data shards of shardSize(size, k) bytes (the last one zero padded)
+# and m parity shards of the same size. The code is systematic: data shard i is the file range
+# [i * shardSize, (i + 1) * shardSize). Parity rows come from a Cauchy matrix, so the file can be
+# rebuilt from any k of the k + m shards.
+#
+# A shard source is [index, address, key, offset, length]: shard "index" is read from the seeder at
+# "address" as the range [offset, offset + length) of its "key", and is zero past "length".
+# A whole copy of the file is a source of every data shard (key fileHash, offset index * shardSize),
+# a stored shard is its own source (key "fileHash#index", offset 0).
+
+GF_POLYNOMIAL = 0x11d
+
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+
+value = 1
+for power in range(255):
+    GF_EXP[power] = value
+    GF_LOG[value] = power
+    value <<= 1
+    if value & 0x100:
+        value ^= GF_POLYNOMIAL
+for power in range(255, 512):
+    GF_EXP[power] = GF_EXP[power - 255]
+del value, power
+
+def gfMul(a, b)->int:
+    if not a or not b:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gfInv(a)->int:
+    if not a:
+        raise ZeroDivisionError('0 has no inverse in GF(256)')
+    return GF_EXP[255 - GF_LOG[a]]
+
+# GF_MUL_TABLE[c] maps every byte to its product by c, so a whole block is multiplied with one lookup
+GF_MUL_TABLE = np.array([[gfMul(c, x) for x in range(256)] for c in range(256)], dtype=np.uint8)
+
+def shardSize(size, dataShards)->int:
+    return math.ceil(size / dataShards)
+
+# Row "index" of the k + m by k generator matrix: the identity for data shards, a Cauchy row for parity shards
+def generatorRow(dataShards, index)->list:
+    if index < dataShards:
+        return [1 if column == index else 0 for column in range(dataShards)]
+
+    return [gfInv(index ^ column) for column in range(dataShards)]
+
+def invertMatrix(matrix)->list:
+    size = len(matrix)
+    rows = [list(row) + [1 if column == i else 0 for column in range(size)] for i, row in enumerate(matrix)]
+
+    for column in range(size):
+        pivot = next(row for row in range(column, size) if rows[row][column])
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+
+        scale = gfInv(rows[column][column])
+        rows[column] = [gfMul(scale, x) for x in rows[column]]
+
+        for row in range(size):
+            factor = rows[row][column]
+            if row != column and factor:
+                rows[row] = [x ^ gfMul(factor, y) for x, y in zip(rows[row], rows[column])]
+
+    return [row[size:] for row in rows]
+
+# Coefficients giving shard "target" as a combination of the shards "indexes" (k distinct indexes)
+def rebuildCoefficients(dataShards, indexes, target)->list:
+    if target in indexes:
+        return [1 if index == target else 0 for index in indexes]
+
+    inverse = invertMatrix([generatorRow(dataShards, index) for index in indexes])
+    row = generatorRow(dataShards, target)
+
+    coefficients = []
+    for column in range(dataShards):
+        coefficient = 0
+        for i in range(dataShards):
+            coefficient ^= gfMul(row[i], inverse[i][column])
+        coefficients.append(coefficient)
+
+    return coefficients
+
+def combineBlocks(blocks, coefficients)->np.ndarray:
+    result = np.zeros(len(blocks[0]), dtype=np.uint8)
+
+    for block, coefficient in zip(blocks, coefficients):
+        if coefficient == 1:
+            result ^= block
+        elif coefficient:
+            result ^= GF_MUL_TABLE[coefficient][block]
+
+    return result
+
+class StripeReader:
+    """
+    Reads k shards side by side in blocks of "blockSize" bytes.
+    Every source streams its shard over its own connection with requests pipelined ahead, so the
+    k seeders transfer in parallel. When a source fails the next unused source of another shard
+    takes over from the current block.
+    """
+    def __init__(self, context, sources, dataShards, shardLength, blockSize=STREAM_CHUNK_SIZE):
+        self.pool = connectionPool(context)
+        self.dataShards = dataShards
+        self.shardLength = shardLength
+        self.blockSize = blockSize
+
+        # Data shards first, so an intact file needs no decoding
+        self.spare = sorted(sources, key=lambda source: source[0])
+        self.active = {}
+
+    # Start streaming shard "source" from "position" on
+    def open(self, source, position):
+        index, address, key, offset, length = source
+        count = max(min(length, self.shardLength) - position, 0)
+
+        handler = self.pool.acquire(SeederStreamHandler, address, timeout=STREAM_TIMEOUT) if count else None
+        stream = handler.streamRange(key, offset + position, count, chunkSize=self.blockSize) if count else iter(())
+        self.active[index] = (source, handler, stream, position + count)
+
+    def close(self, index, healthy):
+        _, handler, stream, _ = self.active.pop(index)
+        stream.close()
+        if handler:
+            self.pool.release(handler, healthy=healthy)
+
+    def replace(self, index, position):
+        self.close(index, healthy=False)
+
+        while self.spare:
+            source = self.spare.pop(0)
+            if source[0] not in self.active:
+                self.open(source, position)
+                return
+
+        raise Exception('not enough shards left to rebuild the file')
+
+    def nextBlock(self, index, position, count):
+        _, _, stream, end = self.active[index]
+        if position >= end:
+            return np.zeros(count, dtype=np.uint8)
+
+        _, data = next(stream)
+        block = np.frombuffer(data, dtype=np.uint8)
+
+        # Past the end of a source the shard is zero padding
+        if len(block) < count:
+            block = np.concatenate([block, np.zeros(count - len(block), dtype=np.uint8)])
+        return block
+
+    # Generator of (position, {index: block}) over the whole shard length
+    def read(self):
+        while len(self.active) < self.dataShards and self.spare:
+            source = self.spare.pop(0)
+            if source[0] not in self.active:
+                self.open(source, 0)
+
+        if len(self.active) < self.dataShards:
+            raise Exception('not enough shards to rebuild the file')
+
+        completed = False
+        try:
+            for position in range(0, self.shardLength, self.blockSize):
+                count = min(self.blockSize, self.shardLength - position)
+                blocks = {}
+
+                while len(blocks) < self.dataShards:
+                    index = next(index for index in self.active if index not in blocks)
+
+                    try:
+                        blocks[index] = self.nextBlock(index, position, count)
+                    except Exception as e:
+                        print(f'Shard {index} from {self.active[index][0][1]}: {e.args[0] if e.args else "timed out"}', flush=True)
+                        self.replace(index, position)
+
+                yield position, blocks
+
+            completed = True
+        finally:
+            # Streams that were read to the end have nothing left in flight
+            for index in list(self.active):
+                self.close(index, healthy=completed)
+
+# Build shard "index" from "sources" and write it to "outputPath" (used by seeders on REQUEST_SHARD)
+# "bucket" (a TokenBucket) caps the rate the sources are read at
+def buildShard(context, sources, dataShards, size, index, outputPath, bucket=None):
+    length = shardSize(size, dataShards)
+    reader = StripeReader(context, sources, dataShards, length)
+    coefficients = None
+
+    with open(outputPath, 'wb') as f:
+        for _, blocks in reader.read():
+            if bucket:
+                bucket.consume(sum(len(block) for block in blocks.values()))
+
+            indexes = sorted(blocks)
+            if coefficients is None or coefficients[0] != indexes:
+                coefficients = (indexes, rebuildCoefficients(dataShards, indexes, index))
+
+            f.write(combineBlocks([blocks[i] for i in indexes], coefficients[1]).tobytes())
+
+# fileInformation = {'fileHash', 'fileName', 'size', 'merkleRoot', 'dataShards', 'parityShards', 'sources'}
+def getFileFromShards(context, fileInformation, outputDirectory='./'):
+    size = fileInformation['size']
+    dataShards = fileInformation['dataShards']
+    length = shardSize(size, dataShards)
+
+    outputFilepath = getOutputFilepath(fileInformation['fileName'], outputDirectory)
+    reader = StripeReader(context, fileInformation['sources'], dataShards, length)
+
+    fd = os.open(outputFilepath, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        coefficients = {}
+        for position, blocks in reader.read():
+            indexes = sorted(blocks)
+
+            for target in range(dataShards):
+                offset = target * length + position
+                if offset >= size:
+                    break
+
+                if (tuple(indexes), target) not in coefficients:
+                    coefficients[(tuple(indexes), target)] = rebuildCoefficients(dataShards, indexes, target)
+
+                block = combineBlocks([blocks[i] for i in indexes], coefficients[(tuple(indexes), target)])
+                os.pwrite(fd, block[:size - offset].tobytes(), offset)
+    except Exception as e:
+        os.close(fd)
+        os.remove(outputFilepath)
+        print(f'Unable to download {fileInformation["fileName"]}: {e.args[0] if e.args else e}')
+        return
+
+    os.close(fd)
+
+    # The shards carry no chunk digests, so the rebuilt file is checked as a whole
+    fullHash, leaves = hashChunks(outputFilepath)
+    root = fileInformation.get('merkleRoot')
+    if fullHash[:len(fileInformation['fileHash'])] != fileInformation['fileHash'] or (root and merkleRoot(leaves) != root):
+        os.remove(outputFilepath)
+        print(f'Unable to download {fileInformation["fileName"]}: rebuilt file does not match its hash')
+        return
+
+    return outputFilepath
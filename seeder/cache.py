@@ -0,0 +1,129 @@
+import os
+import mmap
+import threading
+from collections import OrderedDict
+
+class ReadCache:
+    """
+    Read path cache of the seeder, in front of the files it serves:
+        - maps: key -> mmap of the file, for the "maxFiles" files read last. A popular file is opened once
+          and read straight from the page cache instead of being opened, sought and read for every range
+        - blocks: (key, index) -> bytes of block "index" ([index * blockSize, (index + 1) * blockSize) of the file),
+          for the blocks read last, "maxBytes" at most. Downloads ask for whole stream chunks, so a block
+          read for one client is served from memory to the next ones
+    Keys are file hashes, so a cached block is always the content of its key. Entries are dropped with
+    invalidate when the file goes away, so its disk space is not held by a mapping.
+    Mappings are never closed explicitly: a reader still slicing an evicted one keeps it alive until it is done
+    """
+    def __init__(self, maxFiles, maxBytes, blockSize):
+        self.lock = threading.Lock()
+
+        self.maxFiles = maxFiles
+        self.maxBytes = maxBytes
+        self.blockSize = blockSize
+
+        self.maps = OrderedDict()
+        self.blocks = OrderedDict()
+        self.cachedBytes = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytesSaved = 0
+        self.mapHits = 0
+        self.mapMisses = 0
+
+    # Bytes [offset, offset + count) of "key", read from the file at "path" or with reader(offset, count)
+    def read(self, key, offset, count, path=None, reader=None)->bytes:
+        if count <= 0:
+            return b''
+
+        first = offset // self.blockSize
+        last = (offset + count - 1) // self.blockSize
+
+        data = []
+        for index in range(first, last + 1):
+            block = self.block(key, index, path, reader)
+
+            start = max(offset - index * self.blockSize, 0)
+            end = min(offset + count - index * self.blockSize, self.blockSize)
+            data.append(block[start:end] if start or end < len(block) else block)
+
+        return data[0] if len(data) == 1 else b''.join(data)
+
+    def block(self, key, index, path, reader)->bytes:
+        with self.lock:
+            block = self.blocks.get((key, index))
+            if block is not None:
+                self.blocks.move_to_end((key, index))
+                self.hits += 1
+                self.bytesSaved += len(block)
+                return block
+
+            self.misses += 1
+
+        if path:
+            block = self.mapped(key, path)[index * self.blockSize:(index + 1) * self.blockSize]
+        else:
+            block = reader(index * self.blockSize, self.blockSize)
+
+        # Blocks bigger than the whole cache are not kept
+        if len(block) > self.maxBytes:
+            return block
+
+        with self.lock:
+            # Another reader may have loaded it meanwhile
+            if (key, index) not in self.blocks:
+                self.blocks[(key, index)] = block
+                self.cachedBytes += len(block)
+
+            while self.cachedBytes > self.maxBytes:
+                _, evicted = self.blocks.popitem(last=False)
+                self.cachedBytes -= len(evicted)
+                self.evictions += 1
+
+        return block
+
+    def mapped(self, key, path):
+        with self.lock:
+            mapping = self.maps.get(key)
+            if mapping is not None:
+                self.maps.move_to_end(key)
+                self.mapHits += 1
+                return mapping
+
+            self.mapMisses += 1
+
+        with open(path, 'rb') as f:
+            # Empty files cannot be mapped, and have nothing to read anyway
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+        with self.lock:
+            self.maps[key] = mapping
+            while len(self.maps) > self.maxFiles:
+                self.maps.popitem(last=False)
+
+        return mapping
+
+    def invalidate(self, key):
+        with self.lock:
+            self.maps.pop(key, None)
+
+            for entry in [entry for entry in self.blocks if entry[0] == key]:
+                self.cachedBytes -= len(self.blocks.pop(entry))
+
+    def stats(self)->dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+                "bytesSaved": self.bytesSaved,
+                "evictions": self.evictions,
+                "cachedBytes": self.cachedBytes,
+                "cachedBlocks": len(self.blocks),
+                "mappedFiles": len(self.maps),
+                "mapHits": self.mapHits,
+                "mapMisses": self.mapMisses,
+            }
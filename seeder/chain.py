@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+import zmq
+from utils import OperationRequest, Response, SeederHandler, SEEDER_OPERATIONS, UPLOAD_TIMEOUT, connectionPool, waitUploadStatus
+
+class ChainForwarder:
+    """
+    Forwards an upload to the next seeder of its replica chain while the chunks are written locally.
+    The chunks are read back from the local part file as soon as they are written (advance), so the
+    next seeder receives the file at the pace of the upload, and it forwards it down the rest of the
+    chain the same way. Once every chunk is sent the upload is committed downstream, and the forwarder
+    follows the UPLOAD_STATUS of the next seeder until the rest of the chain is done.
+    Nothing waits on it on the operation socket: the seeder answers UPLOAD_STATUS from "replicas" and "done".
+    A failed forwarder only costs the copies down the chain, which the routine checks make later.
+    - replicas: seeders down the chain holding the file durably
+    - done: whether the chain finished, committed or not
+    - finished: monotonic time the chain finished at
+    """
+    def __init__(self, context, fileHash, file, chain, partPath):
+        self.condition = threading.Condition()
+
+        self.pool = connectionPool(context)
+        self.fileHash = fileHash
+        self.file = file
+        self.chain = chain
+
+        # Opened right away: a small upload may be committed, and its part file moved, before the forwarder reads it
+        self.fd = os.open(partPath, os.O_RDONLY)
+
+        # Chunks written locally, and whether the local upload was abandoned
+        self.available = 0
+        self.stopped = False
+
+        self.replicas = []
+        self.done = False
+        self.finished = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # The local upload has written every chunk before "nextChunk"
+    def advance(self, nextChunk):
+        with self.condition:
+            self.available = nextChunk
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    # Wait until chunk "index" is written locally. False if the upload was abandoned or stalled
+    def waitChunk(self, index)->bool:
+        with self.condition:
+            while self.available <= index and not self.stopped:
+                if not self.condition.wait(UPLOAD_TIMEOUT / 1000):
+                    return False
+            return not self.stopped
+
+    def run(self):
+        try:
+            self.forward()
+        except zmq.error.Again:
+            print(f'Chain replication of {self.fileHash} to {self.chain[0]}: timed out', flush=True)
+        except Exception as e:
+            print(f'Chain replication of {self.fileHash} to {self.chain[0]}: {e.args[0] if e.args else e}', flush=True)
+        finally:
+            os.close(self.fd)
+
+            self.finished = time.monotonic()
+            self.done = True
+
+    def forward(self):
+        with self.pool.connection(SeederHandler, self.chain[0], timeout=UPLOAD_TIMEOUT) as seederHandler:
+            req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD_OPEN'], args={"fileHash": self.fileHash, "file": self.file, "chain": self.chain[1:]})
+            seederHandler.send(req.export())
+
+            res = Response.load(seederHandler.recv())
+            if res.status != 200:
+                raise Exception(res.message)
+
+            # The next seeder already has the file
+            if res.message['nextChunk'] is None:
+                self.replicas = waitUploadStatus(seederHandler, self.fileHash)
+                return
+
+            index = res.message['nextChunk']
+            chunkSize = res.message['chunkSize']
+
+            while index * chunkSize < self.file.size:
+                if not self.waitChunk(index):
+                    raise Exception('upload abandoned')
+
+                req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD_CHUNK'], args={"fileHash": self.fileHash, "index": index, "data": os.pread(self.fd, chunkSize, index * chunkSize)})
+                seederHandler.send(req.export())
+
+                res = Response.load(seederHandler.recv())
+
+                # The next seeder is behind (e.g. it restarted), continue from where it is
+                if res.status == 409:
+                    index = res.message['nextChunk']
+                    continue
+
+                if res.status != 200:
+                    raise Exception(res.message)
+
+                index += 1
+
+            req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD_COMMIT'], args={"fileHash": self.fileHash})
+            seederHandler.send(req.export())
+
+            res = Response.load(seederHandler.recv())
+            if res.status != 200:
+                raise Exception(res.message)
+
+            # The copy of the next seeder is durable, the rest of the chain may still be committing
+            self.replicas = res.message['replicas']
+            if not res.message['done']:
+                self.replicas = waitUploadStatus(seederHandler, self.fileHash)
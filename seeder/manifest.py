@@ -0,0 +1,127 @@
+import os
+import json
+import threading
+from utils import atomicWrite
+
+# The journal is rewritten with only the current entries once it holds more than JOURNAL_COMPACT_MIN records
+# and more than JOURNAL_COMPACT_RATIO times the number of entries
+JOURNAL_COMPACT_MIN = 1024
+JOURNAL_COMPACT_RATIO = 2
+
+class Manifest:
+    """
+    Hashes of the files on the seeder disk, persisted next to them so a restart does not rehash the whole disk.
+    Entries are keyed by (inode, size, mtime): a file that was replaced, rewritten or touched gets a new key
+    and is hashed again, anything else keeps the hash computed by a previous run.
+        - entries: "inode:size:mtime" -> {"name", "hash", "root"} ("root" is the Merkle root of the file chunks)
+    The file at "path" is a journal: a first line with every entry (the whole manifest of older versions), then one
+    ["record", key, entry] or ["forget", key] line per change. Changes are appended as they are made and reach the
+    disk on save, so storing a file costs one line however many files the seeder has. The journal is compacted back
+    to a single line once most of its lines are outdated. A damaged line is skipped: it only costs a rehash.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+
+        self.path = path
+        self.entries = {}
+
+        self.journal = None
+        self.restore()
+
+        with self.lock:
+            self.compactLocked()
+
+    def restore(self):
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+
+        for number, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+
+                if number == 0 and type(record) == dict:
+                    self.entries = record
+                elif record[0] == 'record':
+                    self.entries[record[1]] = record[2]
+                elif record[0] == 'forget':
+                    self.entries.pop(record[1], None)
+            except (ValueError, LookupError, TypeError):
+                # e.g. the last line written before a crash
+                print(f'Manifest: skipping damaged record {number + 1}', flush=True)
+
+    @staticmethod
+    def key(stat)->str:
+        return f'{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    # Split the files of "directory" in the ones with a known hash and the ones that need hashing.
+    # Returns ({name: (entry, stat)}, {name: stat}). Entries of files that are gone are dropped
+    def scan(self, directory):
+        known = {}
+        pending = {}
+        entries = {}
+
+        for entry in os.scandir(directory):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+
+            stat = entry.stat()
+            key = self.key(stat)
+
+            with self.lock:
+                cached = self.entries.get(key)
+
+            if cached and cached['name'] == entry.name:
+                known[entry.name] = (cached, stat)
+                entries[key] = cached
+            else:
+                pending[entry.name] = stat
+
+        with self.lock:
+            self.entries = entries
+            self.compactLocked()
+
+        return known, pending
+
+    def record(self, name, stat, fileHash, root):
+        with self.lock:
+            key = self.key(stat)
+            self.entries[key] = {"name": name, "hash": fileHash, "root": root}
+            self.logLocked(['record', key, self.entries[key]])
+
+    def forget(self, stat):
+        with self.lock:
+            key = self.key(stat)
+            if self.entries.pop(key, None) is not None:
+                self.logLocked(['forget', key])
+
+    # Make the changes recorded so far durable
+    def save(self):
+        with self.lock:
+            self.journal.flush()
+            fd = os.dup(self.journal.fileno())
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def logLocked(self, record):
+        self.journal.write(json.dumps(record) + '\n')
+        self.records += 1
+
+        if self.records > max(JOURNAL_COMPACT_MIN, JOURNAL_COMPACT_RATIO * len(self.entries)):
+            self.compactLocked()
+
+    # Rewrite the journal as a single line with the current entries. Each compaction follows at least
+    # as many changes as there are entries, so the rewrites cost a constant time per change
+    def compactLocked(self):
+        if self.journal:
+            self.journal.close()
+
+        atomicWrite(self.path, json.dumps(self.entries) + '\n')
+
+        self.journal = open(self.path, 'a')
+        self.records = 0
@@ -1,153 +1,811 @@
 import zmq
-import pickle
 import os
+import json
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from utils import OperationHandler, Operation, Response, TrackerHandler, getIpAddress, OperationRequest, File, hash, TRACKER_OPERATIONS, SEEDER_OPERATIONS, getFileDistributedly
+from manifest import Manifest
+from storage import ChunkStore
+from chain import ChainForwarder
+from cache import ReadCache
+from erasure import buildShard
+from utils import DeferredOperationHandler, Operation, Response, TrackerHandler, SeederHandler, getIpAddress, OperationRequest, File, hashChunks, merkleRoot, STREAM_TIMEOUT, TRACKER_OPERATIONS, SEEDER_OPERATIONS, STREAM_PORT, STREAM_CHUNK_SIZE, UPLOAD_CHUNK_SIZE, HEARTBEAT_PORT, HEARTBEAT_INTERVAL, getFileDistributedly, getOutputFilepath, atomicWrite, connectionPool, getShardMap, TokenBucket, STREAM_WINDOW
 
 HASH_SIZE = 5
 
+# Processes hashing new or changed files at startup
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 1))
+# Hashed files are announced to the tracker in batches of at most HASH_BATCH files, at least every HASH_FLUSH_INTERVAL seconds
+HASH_BATCH = 64
+HASH_FLUSH_INTERVAL = 1
+
+# "files" keeps every file as a plain file in the disk directory.
+# "chunks" splits them in content defined chunks stored once each (see storage.ChunkStore)
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'files')
+
+# Read cache: the READ_CACHE_FILES files read last stay mapped, and READ_CACHE_BYTES of the stream chunks read last stay in memory
+READ_CACHE_FILES = int(os.environ.get('READ_CACHE_FILES', 128))
+READ_CACHE_BYTES = int(os.environ.get('READ_CACHE_BYTES', 64 * 1024 * 1024))
+
+# The chain of a committed upload is answered to UPLOAD_STATUS for CHAIN_STATUS_TTL seconds after it finished
+CHAIN_STATUS_TTL = 600
+
+# Every TRACKER_SYNC_INTERVAL seconds the tracker shards are sent an empty change, so a shard that dropped
+# this seeder or lost track of its table (see updateTracker) gets it back even when no file changes
+TRACKER_SYNC_INTERVAL = 30
+
+# Capacity weight advertised to the tracker: a seeder of weight 2 is given about twice the data of a seeder of weight 1
+SEEDER_WEIGHT = float(os.environ.get('SEEDER_WEIGHT', 1.0))
+
 class Seeder:
     def __init__(self):
         self.context = zmq.Context()
 
-        self.opHandler = OperationHandler(self.context)
+        # Replication transfers answer from their own thread (see replicateInBackground)
+        self.opHandler = DeferredOperationHandler(self.context)
 
-        self.trackerHandler = TrackerHandler(self.context)
+        # The tracker shards and a socket to each of them (see utils.ShardMap). Every shard is told about the files it owns
+        self.shardMap = getShardMap(self.context)
+        self.trackerHandlers = [TrackerHandler(self.context, address) for address in self.shardMap.shards]
 
         self.OPERATIONS = [
             Operation(operation='PING', args=["message"], handler=self.pingHandler),
             Operation(operation='GET', args=["fileHash", "offset", "count"], handler=self.getHandler),
-            Operation(operation='UPLOAD', args=["fileHash", "file", "fileData"], handler=self.uploadHandler),
+            Operation(operation='UPLOAD_OPEN', args=["fileHash", "file"], handler=self.uploadOpenHandler),
+            Operation(operation='UPLOAD_CHUNK', args=["fileHash", "index", "data"], handler=self.uploadChunkHandler),
+            Operation(operation='UPLOAD_COMMIT', args=["fileHash"], handler=self.uploadCommitHandler),
+            Operation(operation='UPLOAD_STATUS', args=["fileHash"], handler=self.uploadStatusHandler),
             Operation(operation='REQUEST_GET', args=["fileHash", "fileName", "size", "seeders"], handler=self.requestGetHandler),
+            Operation(operation='CHUNK_HASHES', args=["fileHash"], handler=self.chunkHashesHandler),
+            Operation(operation='GET_RECIPE', args=["fileHash"], handler=self.getRecipeHandler),
+            Operation(operation='REQUEST_SHARD', args=["fileHash", "index", "dataShards", "parityShards", "fileName", "size", "sources"], handler=self.requestShardHandler),
+            Operation(operation='REQUEST_REMOVE', args=["fileHash"], handler=self.requestRemoveHandler),
         ]
 
         self.diskDirectory = '/disk'
 
+        # Partial uploads are kept here until committed, so they survive a dropped connection or a restart
+        self.uploadDirectory = os.path.join(self.diskDirectory, '.uploads')
+        os.makedirs(self.uploadDirectory, exist_ok=True)
+
+        # Merkle leaves (chunk digests) of every local file, one file per fileHash
+        self.merkleDirectory = os.path.join(self.diskDirectory, '.merkle')
+        os.makedirs(self.merkleDirectory, exist_ok=True)
+
+        # Erasure coded shards, as "<fileHash>.<index>" next to their "<fileHash>.<index>.json" description
+        self.shardDirectory = os.path.join(self.diskDirectory, '.shards')
+        os.makedirs(self.shardDirectory, exist_ok=True)
+
         self.localFiles = {}
 
+        # fileHash -> {"name", "size", "nextChunk"}
+        self.uploads = {}
+
+        # fileHash -> ChainForwarder of the uploads that are replicated down a chain of seeders
+        self.forwarders = {}
+
+        # fileHash -> ChainForwarder of the committed uploads, still sending them down their chain or finished lately
+        self.chains = {}
+
+        # Hashes of the files on disk from previous runs, so only new or changed files are hashed
+        self.manifest = Manifest(os.path.join(self.diskDirectory, '.manifest.json'))
+
+        self.chunkStore = ChunkStore(self.diskDirectory) if STORAGE_ENGINE == 'chunks' else None
+
+        # (fileHash, path, stat, Merkle root) of the plain files waiting to move to the chunk store (see convertFile).
+        # The lock keeps a file from being discarded while it is switched over
+        self.conversions = queue.Queue()
+        self.conversionLock = threading.Lock()
+
+        # Shared by the operation and the stream threads
+        self.readCache = ReadCache(READ_CACHE_FILES, READ_CACHE_BYTES, STREAM_CHUNK_SIZE)
+
+        # The tracker sockets and the sequence numbers are shared with the hashing thread
+        self.trackerLock = threading.Lock()
+
+        # Bandwidth cap shared by every replication transfer into this seeder (see replicationBucket).
+        # Its byte count goes with the heartbeats, so the tracker sees the transfers progress
+        self.bucket = TokenBucket(None, burst=STREAM_CHUNK_SIZE * STREAM_WINDOW)
+        self.bucketLock = threading.Lock()
+
+        # Key of every replication transfer running -> answers of the requests waiting for it
+        self.replications = {}
+        self.replicationLock = threading.Lock()
+
         self.registerToTracker()
 
+        # Files missing from the manifest are hashed after the registration and announced as they are done
+        self.hashThread = threading.Thread(target=self.hashPendingFiles, daemon=True)
+        self.hashThread.start()
+
+        # Ranges are streamed on a separate ROUTER socket so downloads do not wait behind other operations
+        self.streamThread = threading.Thread(target=self.streamServer, daemon=True)
+        self.streamThread.start()
+
+        self.heartbeatThread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeatThread.start()
+
+        self.syncThread = threading.Thread(target=self.syncTracker, daemon=True)
+        self.syncThread.start()
+
+        if self.chunkStore:
+            self.conversionThread = threading.Thread(target=self.convertFiles, daemon=True)
+            self.conversionThread.start()
+
+            self.migrateToChunkStore()
+
     def __del__(self):
         req = OperationRequest(operation=TRACKER_OPERATIONS['SEEDER_SIGNOUT'], args={"address": getIpAddress()})
-        self.trackerHandler.send(req.export())
 
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
+        for trackerHandler in self.trackerHandlers:
+            trackerHandler.send(req.export())
 
+            res = trackerHandler.recv()
+            res = Response.load(res)
+
+    # Register with the files whose hash and chunk digests are already known. The rest is left in "pendingFiles"
     def registerToTracker(self):        
+        known, self.pendingFiles = self.manifest.scan(self.diskDirectory)
+
+        self.localFiles = {}
+        for filename, (entry, stat) in known.items():
+            fileHash = entry['hash'][:HASH_SIZE]
+
+            if not entry.get('root') or not os.path.exists(self.leavesPath(fileHash)):
+                self.pendingFiles[filename] = stat
+                continue
+
+            self.localFiles[fileHash] = File(name=filename, size=stat.st_size, lastModified=stat.st_mtime, merkleRoot=entry['root'])
+
+        # Shards are announced under "fileHash#index"
+        for filename in os.listdir(self.shardDirectory):
+            if not filename.endswith('.json'):
+                continue
+
+            with open(os.path.join(self.shardDirectory, filename), 'r') as f:
+                shard = json.load(f)
+
+            shardPath = self.shardPath(shard['fileHash'], shard['index'])
+            if os.path.exists(shardPath):
+                self.localFiles[f"{shard['fileHash']}#{shard['index']}"] = File(name=os.path.basename(shardPath), size=os.path.getsize(shardPath), lastModified=shard['lastModified'], shard=shard)
+
+        # Plain files left from the "files" engine are still served and move to the chunk store once hashing is done
+        if self.chunkStore:
+            for fileHash, recipe in self.chunkStore.listRecipes().items():
+                self.localFiles[fileHash] = File(name=recipe['name'], size=recipe['size'], lastModified=recipe['lastModified'], merkleRoot=recipe['root'])
         
-        self.localFiles = {
-            hash(os.path.join(self.diskDirectory, filename))[:HASH_SIZE]: File(name=filename, 
-                                                                   size=os.path.getsize(os.path.join(self.diskDirectory, filename)), 
-                                                                   lastModified=os.path.getmtime(os.path.join(self.diskDirectory, filename)))
-            for filename in os.listdir(self.diskDirectory)}
-        
-        req = OperationRequest(operation=TRACKER_OPERATIONS['SEEDER_REGISTER'], args={"address": getIpAddress(), "files": self.localFiles})
-        self.trackerHandler.send(req.export())
-        
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
+        # Changes are numbered per shard
+        self.sequences = [0] * len(self.shardMap)
+        parts = self.shardMap.split(self.localFiles)
+
+        # Every shard knows every seeder, even one without files it owns, so all of them can place files on it
+        for shard, trackerHandler in enumerate(self.trackerHandlers):
+            req = OperationRequest(operation=TRACKER_OPERATIONS['SEEDER_REGISTER'], args={"address": getIpAddress(), "files": parts.get(shard, {}), "sequence": self.sequences[shard]})
+            trackerHandler.send(req.export())
+            
+            res = trackerHandler.recv()
+            res = Response.load(res)
+
+            if res.status != 200:
+                exit()
+
+    # Hash the files left out of the registration in a process pool and send them to the tracker in batches
+    def hashPendingFiles(self):
+        if not self.pendingFiles:
+            return
+
+        print(f'Hashing {len(self.pendingFiles)} new or changed files', flush=True)
+
+        added = {}
+        lastFlush = time.monotonic()
+
+        with ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(hashChunks, os.path.join(self.diskDirectory, filename)): (filename, stat)
+                       for filename, stat in self.pendingFiles.items()}
+
+            for future in as_completed(futures):
+                filename, stat = futures.pop(future)
+
+                try:
+                    fileHash, leaves = future.result()
+                    current = os.stat(os.path.join(self.diskDirectory, filename))
+                except Exception as e:
+                    print(f'Unable to hash {filename}: {e}', flush=True)
+                    continue
+
+                # Changed while it was hashed. It will be hashed again on the next start
+                if Manifest.key(current) != Manifest.key(stat):
+                    print(f'{filename} changed while being hashed, skipping it', flush=True)
+                    continue
+
+                added[fileHash[:HASH_SIZE]] = self.storeFile(fileHash[:HASH_SIZE], os.path.join(self.diskDirectory, filename), fileHash, leaves)
+
+                if len(added) >= HASH_BATCH or time.monotonic() - lastFlush >= HASH_FLUSH_INTERVAL:
+                    self.announceHashedFiles(added)
+                    added = {}
+                    lastFlush = time.monotonic()
+
+        self.announceHashedFiles(added)
+        self.pendingFiles = {}
+
+    # Queue the plain files known from the manifest, e.g. left by the "files" engine or by a restart, for the chunk store
+    def migrateToChunkStore(self):
+        for fileHash, file in list(self.localFiles.items()):
+            filePath = os.path.join(self.diskDirectory, file.name)
+
+            if getattr(file, 'shard', None) or self.chunkStore.getRecipe(fileHash) or not os.path.isfile(filePath):
+                continue
+
+            self.conversions.put((fileHash, filePath, os.stat(filePath), file.merkleRoot))
+
+    # Chunking runs here rather than in the operation handlers, so a big upload is acknowledged as soon as it is stored
+    def convertFiles(self):
+        while True:
+            fileHash, filePath, stat, root = self.conversions.get()
+
+            try:
+                self.convertFile(fileHash, filePath, stat, root)
+            except Exception as e:
+                print(f'Unable to move {os.path.basename(filePath)} to the chunk store: {e}', flush=True)
+
+    # Move a plain file to the chunk store. It keeps its hash, so the tracker is not told.
+    # The plain file is served until its recipe is stored, and is then removed unless it was discarded or replaced meanwhile
+    def convertFile(self, fileHash, filePath, stat, root):
+        # Already moved, e.g. queued twice
+        with self.conversionLock:
+            if self.chunkStore.getRecipe(fileHash) or not self.isSameFile(filePath, stat):
+                return
+
+        self.chunkStore.ingest(fileHash, filePath, os.path.basename(filePath), stat.st_mtime, root)
+
+        with self.conversionLock:
+            if not self.isSameFile(filePath, stat):
+                self.chunkStore.remove(fileHash)
+                return
+
+            self.manifest.forget(stat)
+            self.manifest.save()
+            os.remove(filePath)
+
+        self.readCache.invalidate(fileHash)
+
+    def announceHashedFiles(self, added):
+        if not added:
+            return
+
+        self.localFiles.update(added)
+        self.manifest.save()
+
+        if not self.updateTracker(added=added):
+            print(f'Unable to announce {len(added)} files to the tracker', flush=True)
+
+    def leavesPath(self, fileHash):
+        return os.path.join(self.merkleDirectory, fileHash)
+
+    # Store the chunk digests of a file and return their Merkle root
+    def saveLeaves(self, fileHash, leaves)->str:
+        atomicWrite(self.leavesPath(fileHash), leaves)
+
+        return merkleRoot(leaves)
+
+    def removeLeaves(self, fileHash):
+        try:
+            os.remove(self.leavesPath(fileHash))
+        except FileNotFoundError:
+            pass
+
+    # Keep a complete file that landed in the disk directory. Its chunk digests are stored and it is recorded in
+    # the manifest. With the "chunks" engine it is then moved to the chunk store in the background (see convertFile).
+    # The manifest is saved by the caller
+    def storeFile(self, fileHash, filePath, fullHash, leaves)->File:
+        root = self.saveLeaves(fileHash, leaves)
+        stat = os.stat(filePath)
+
+        file = File(name=os.path.basename(filePath), size=stat.st_size, lastModified=stat.st_mtime, merkleRoot=root)
+        self.manifest.record(file.name, stat, fullHash, root)
+
+        if self.chunkStore:
+            self.conversions.put((fileHash, filePath, stat, root))
+
+        return file
+
+    # Whether the file at "path" is still the one "stat" was taken from
+    def isSameFile(self, path, stat)->bool:
+        try:
+            return Manifest.key(os.stat(path)) == Manifest.key(stat)
+        except FileNotFoundError:
+            return False
+
+    def discardFile(self, fileHash, file):
+        self.removeLeaves(fileHash)
+        self.chains.pop(fileHash, None)
+        self.readCache.invalidate(fileHash)
+
+        with self.conversionLock:
+            if self.chunkStore and self.chunkStore.getRecipe(fileHash):
+                self.chunkStore.remove(fileHash)
+            else:
+                filePath = os.path.join(self.diskDirectory, file.name)
+
+                # A file already gone (e.g. deleted by hand) counts as removed
+                try:
+                    self.manifest.forget(os.stat(filePath))
+                    os.remove(filePath)
+                except FileNotFoundError:
+                    pass
 
-        if res.status != 200:
-            exit()
+        self.manifest.save()
+
+    def loadStats(self)->dict:
+        disk = os.statvfs(self.diskDirectory)
+
+        stats = {
+            "files": len(self.localFiles),
+            "bytes": sum(file.size for file in list(self.localFiles.values())),
+            "freeBytes": disk.f_bavail * disk.f_frsize,
+            "load": os.getloadavg()[0],
+            "weight": SEEDER_WEIGHT,
+            "readCache": self.readCache.stats(),
+            "connections": connectionPool(self.context).stats(),
+            "replicatedBytes": self.bucket.consumed,
+        }
+
+        if self.chunkStore:
+            stats["storage"] = self.chunkStore.stats()
+
+        return stats
+
+    # Push a heartbeat with the load statistics to the tracker every HEARTBEAT_INTERVAL seconds
+    def heartbeat(self):
+        # Every shard keeps track of every seeder
+        sock = self.context.socket(zmq.PUB)
+        for address in self.shardMap.shards:
+            sock.connect(f"tcp://{address}:{HEARTBEAT_PORT}")
+
+        while True:
+            req = OperationRequest(operation=TRACKER_OPERATIONS['HEARTBEAT'], args={"address": getIpAddress(), "stats": self.loadStats()})
+            sock.send_multipart(req.export(), copy=False)
+
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    # Check in with every tracker shard on its own thread, so a slow shard never delays the heartbeats
+    def syncTracker(self):
+        while True:
+            time.sleep(TRACKER_SYNC_INTERVAL)
+
+            try:
+                if not self.updateTracker(shards=range(len(self.shardMap))):
+                    print(f'Unable to sync with the tracker', flush=True)
+            except Exception as e:
+                print(f'Unable to sync with the tracker: {e}', flush=True)
+
+    # Send a change of the file table to the tracker shards owning the files, as a numbered delta per shard.
+    # If a shard missed a previous change it answers 409 and gets its whole part of the table instead.
+    # If it dropped this seeder (404) the seeder registers there again. "shards" are sent a delta even when empty
+    def updateTracker(self, added={}, removed=[], shards=())->bool:
+        addedParts = self.shardMap.split(added)
+        removedParts = self.shardMap.split(dict.fromkeys(removed))
+        updated = True
+
+        with self.trackerLock:
+            for shard in sorted(set(addedParts) | set(removedParts) | set(shards)):
+                trackerHandler = self.trackerHandlers[shard]
+                self.sequences[shard] += 1
+
+                req = OperationRequest(operation=TRACKER_OPERATIONS['SEEDER_UPDATE'], args={"address": getIpAddress(), "sequence": self.sequences[shard], "added": addedParts.get(shard, {}), "removed": list(removedParts.get(shard, {}))})
+                trackerHandler.send(req.export())
+
+                res = trackerHandler.recv()
+                res = Response.load(res)
+
+                if res.status == 409:
+                    files = self.shardMap.split(self.localFiles).get(shard, {})
+
+                    req = OperationRequest(operation=TRACKER_OPERATIONS['SEEDER_UPDATE'], args={"address": getIpAddress(), "sequence": self.sequences[shard], "files": files})
+                    trackerHandler.send(req.export())
+
+                    res = trackerHandler.recv()
+                    res = Response.load(res)
+
+                if res.status == 404:
+                    files = self.shardMap.split(self.localFiles).get(shard, {})
+
+                    req = OperationRequest(operation=TRACKER_OPERATIONS['SEEDER_REGISTER'], args={"address": getIpAddress(), "files": files, "sequence": self.sequences[shard]})
+                    trackerHandler.send(req.export())
+
+                    res = trackerHandler.recv()
+                    res = Response.load(res)
+
+                updated = updated and res.status == 200
+
+        return updated
+
+    # Number a change the tracker applies itself (see requestGetHandler), in the sequence of the shard owning "key"
+    def nextSequence(self, key)->int:
+        with self.trackerLock:
+            shard = self.shardMap.shardOf(key)
+            self.sequences[shard] += 1
+            return self.sequences[shard]
 
     def run(self):
         while True:
             operation = self.opHandler.getNextOperation(self.OPERATIONS)
-            operation.object.callHandler(operation.args)
+
+            try:
+                operation.object.callHandler(operation.args)
+            except Exception as e:
+                print(f"{operation.object.operation} failed: {e}", flush=True)
+
+                # The handler may have failed before answering. Answer it, or the REP socket stays stuck
+                try:
+                    self.opHandler.send(Response(status=500, message=str(e)).export())
+                except zmq.error.ZMQError:
+                    pass
 
     def pingHandler(self, args):
         res = Response(status=200, message=f'Received message: {args.get("message")}')
         self.opHandler.send(res.export())
 
-    def getHandler(self, args):
+    # Validate a range request. Returns (status, message, file, count)
+    def parseRangeRequest(self, args):
         fileHash = args.get('fileHash')
         offset = args.get('offset')
         count = args.get('count')
 
         if type(offset) != int or type(count) != int:
-            res = Response(status=400, message=f'Invalid offset or count type')
-            self.opHandler.send(res.export())
-            return
+            return 400, f'Invalid offset or count type', None, None
+
+        if offset < 0 or count < 0:
+            return 400, f'Invalid offset or count', None, None
 
         if fileHash not in self.localFiles:
-            res = Response(status=404, message=f'File not found')
-            self.opHandler.send(res.export())
-            return
-        
+            return 404, f'File not found', None, None
+
         file = self.localFiles[fileHash]
 
         if offset > file.size:
-            res = Response(status=400, message=f'Invalid offset')
+            return 400, f'Invalid offset', None, None
+
+        # A single reply never carries more than one stream chunk
+        count = min(count, STREAM_CHUNK_SIZE, file.size - offset)
+
+        return 200, None, file, count
+
+    def readRange(self, fileHash, offset, count):
+        if self.chunkStore and self.chunkStore.getRecipe(fileHash):
+            return self.readCache.read(fileHash, offset, count, reader=lambda offset, count: self.chunkStore.read(fileHash, offset, count))
+
+        file = self.localFiles[fileHash]
+        directory = self.shardDirectory if getattr(file, 'shard', None) else self.diskDirectory
+
+        try:
+            return self.readCache.read(fileHash, offset, count, path=os.path.join(directory, file.name))
+        except FileNotFoundError:
+            # Moved to the chunk store since the recipe was looked up
+            if not self.chunkStore or not self.chunkStore.getRecipe(fileHash):
+                raise
+
+            return self.readCache.read(fileHash, offset, count, reader=lambda offset, count: self.chunkStore.read(fileHash, offset, count))
+
+    def getHandler(self, args):
+        status, message, file, count = self.parseRangeRequest(args)
+
+        if status != 200:
+            res = Response(status=status, message=message)
             self.opHandler.send(res.export())
             return
-        
-        if offset + count > file.size:
-            count = file.size - offset
 
-        with open(os.path.join(self.diskDirectory, file.name), 'rb') as f:
-            f.seek(offset)
-            data = f.read(count)
+        try:
+            data = self.readRange(args.get('fileHash'), args.get('offset'), count)
+        except FileNotFoundError:
+            # Removed between the check and the read
+            res = Response(status=404, message=f'File not found')
+            self.opHandler.send(res.export())
+            return
+
+        res = Response(status=200, message={
+            "count": count,
+            "data": data
+        })
+        self.opHandler.send(res.export())
+
+    # Serve GET frames on the stream socket. Every request is answered with a single
+    # [header, args, data] message, so only one chunk is in memory at a time
+    def streamServer(self):
+        sock = self.context.socket(zmq.ROUTER)
+        sock.bind(f"tcp://{getIpAddress()}:{STREAM_PORT}")
+
+        while True:
+            identity, *frames = sock.recv_multipart(copy=False)
+
+            try:
+                operationRequest = OperationRequest.load(frames)
+                if operationRequest.operation != SEEDER_OPERATIONS['GET']:
+                    raise Exception('Operation not found or invalid arguments')
+
+                args = operationRequest.args
+                status, message, file, count = self.parseRangeRequest(args)
+
+                # The file may be removed between the check and the read
+                if status == 200:
+                    data = self.readRange(args.get('fileHash'), args.get('offset'), count)
+            except Exception as e:
+                status, message = 500, str(e)
+
+            if status != 200:
+                res = Response(status=status, message=message)
+                sock.send_multipart([identity, *res.export()], copy=False)
+                continue
+
             res = Response(status=200, message={
-                "count": count,
+                "offset": args.get('offset'),
+                "count": len(data),
                 "data": data
             })
-            self.opHandler.send(res.export())
+            sock.send_multipart([identity, *res.export()], copy=False)
+
+    def uploadPaths(self, fileHash):
+        return os.path.join(self.uploadDirectory, f'{fileHash}.part'), os.path.join(self.uploadDirectory, f'{fileHash}.json')
+
+    def loadUpload(self, fileHash):
+        if fileHash in self.uploads:
+            return self.uploads[fileHash]
+
+        _, statePath = self.uploadPaths(fileHash)
+        if not os.path.exists(statePath):
+            return None
+
+        with open(statePath, 'r') as f:
+            self.uploads[fileHash] = json.load(f)
+
+        return self.uploads[fileHash]
+
+    def saveUpload(self, fileHash, upload):
+        _, statePath = self.uploadPaths(fileHash)
 
-    def uploadHandler(self, args):
+        atomicWrite(statePath, json.dumps(upload))
+
+        self.uploads[fileHash] = upload
+
+    def removeUpload(self, fileHash):
+        for path in self.uploadPaths(fileHash):
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.uploads.pop(fileHash, None)
+
+        forwarder = self.forwarders.pop(fileHash, None)
+        if forwarder:
+            forwarder.stop()
+
+    # Open (or resume) an upload session. Answers with the next chunk the seeder expects.
+    # With a "chain" of seeders the upload is forwarded to them as it is written (see chain.ChainForwarder)
+    def uploadOpenHandler(self, args):
         fileHash = args.get('fileHash')
         file = args.get('file')
-        fileData = args.get('fileData')
+        chain = args.get('chain') or []
+
+        if type(fileHash) != str or len(fileHash) != HASH_SIZE:
+            res = Response(status=400, message=f'Invalid file hash')
+            self.opHandler.send(res.export())
+            return
+
+        if type(file) != File or type(file.size) != int or file.size < 0:
+            res = Response(status=400, message=f'Invalid file type')
+            self.opHandler.send(res.export())
+            return
+
+        if type(chain) != list or not all(type(address) == str for address in chain):
+            res = Response(status=400, message=f'Invalid replica chain')
+            self.opHandler.send(res.export())
+            return
 
         if fileHash in self.localFiles:
-            res = Response(status=200, message=f'File already exists')
+            res = Response(status=200, message={"nextChunk": None, "chunkSize": UPLOAD_CHUNK_SIZE})
             self.opHandler.send(res.export())
             return
 
-        if type(fileData) != bytes:
-            res = Response(status=400, message=f'Invalid file data type')
+        upload = self.loadUpload(fileHash)
+
+        # A session for a different file under the same hash is discarded
+        if upload and (upload['name'] != file.name or upload['size'] != file.size):
+            self.removeUpload(fileHash)
+            upload = None
+
+        if not upload:
+            partPath, _ = self.uploadPaths(fileHash)
+            with open(partPath, 'wb') as f:
+                f.truncate(file.size)
+
+            upload = {"name": os.path.basename(file.name), "size": file.size, "nextChunk": 0}
+            self.saveUpload(fileHash, upload)
+
+        # A resumed upload restarts its forwarder, which picks up from where the next seeder is
+        forwarder = self.forwarders.pop(fileHash, None)
+        if forwarder:
+            forwarder.stop()
+
+        if chain:
+            partPath, _ = self.uploadPaths(fileHash)
+            forwarder = ChainForwarder(self.context, fileHash, file, chain, partPath)
+            forwarder.advance(upload['nextChunk'])
+            self.forwarders[fileHash] = forwarder
+
+        res = Response(status=200, message={"nextChunk": upload['nextChunk'], "chunkSize": UPLOAD_CHUNK_SIZE})
+        self.opHandler.send(res.export())
+
+    def uploadChunkHandler(self, args):
+        fileHash = args.get('fileHash')
+        index = args.get('index')
+        data = args.get('data')
+
+        if type(index) != int or not isinstance(data, (bytes, memoryview)):
+            res = Response(status=400, message=f'Invalid chunk index or data type')
             self.opHandler.send(res.export())
             return
-        
-        if type(file) != File:
-            res = Response(status=400, message=f'Invalid file type')
+
+        upload = self.loadUpload(fileHash)
+        if not upload:
+            res = Response(status=404, message=f'Upload session not found')
             self.opHandler.send(res.export())
             return
 
-        if len(fileData) != file.size:
-            res = Response(status=400, message=f'Invalid file size')
+        # Chunks must arrive in order. Repeated chunks are acknowledged again without being written
+        if index > upload['nextChunk']:
+            res = Response(status=409, message={"nextChunk": upload['nextChunk']})
             self.opHandler.send(res.export())
             return
 
+        if index == upload['nextChunk']:
+            offset = index * UPLOAD_CHUNK_SIZE
+            if offset + len(data) > upload['size'] or (len(data) != UPLOAD_CHUNK_SIZE and offset + len(data) != upload['size']):
+                res = Response(status=400, message=f'Invalid chunk size')
+                self.opHandler.send(res.export())
+                return
+
+            partPath, _ = self.uploadPaths(fileHash)
+            fd = os.open(partPath, os.O_WRONLY)
+            try:
+                os.pwrite(fd, data, offset)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            upload['nextChunk'] = index + 1
+            self.saveUpload(fileHash, upload)
+
+            if fileHash in self.forwarders:
+                self.forwarders[fileHash].advance(upload['nextChunk'])
+
+        res = Response(status=200, message={"nextChunk": upload['nextChunk']})
+        self.opHandler.send(res.export())
+
+    def uploadCommitHandler(self, args):
+        fileHash = args.get('fileHash')
+
+        upload = self.loadUpload(fileHash)
+        if not upload:
+            res = Response(status=404, message=f'Upload session not found')
+            self.opHandler.send(res.export())
+            return
+
+        partPath, _ = self.uploadPaths(fileHash)
+
+        complete = upload['nextChunk'] * UPLOAD_CHUNK_SIZE >= upload['size']
+        fullHash, leaves = hashChunks(partPath) if complete else (None, None)
+
+        if not complete or fullHash[:HASH_SIZE] != fileHash:
+            self.removeUpload(fileHash)
+
+            res = Response(status=400, message=f'Invalid file data')
+            self.opHandler.send(res.export())
+            return
+
+        # The forwarder holds the part file open, so it can still read it once moved
+        forwarder = self.forwarders.pop(fileHash, None)
+
         # Save the data to disk
-        with open(os.path.join(self.diskDirectory, file.name), 'wb') as f:
-            f.write(fileData)
-            f.close()
+        filePath = getOutputFilepath(upload['name'], self.diskDirectory)
+        os.replace(partPath, filePath)
+        self.removeUpload(fileHash)
 
-        file.setLastModified(datetime.now().timestamp())
+        file = self.storeFile(fileHash, filePath, fullHash, leaves)
+        self.manifest.save()
 
         self.localFiles[fileHash] = file
 
         # Update seeder on the Tracker
-        req = OperationRequest(operation=TRACKER_OPERATIONS['SEEDER_UPDATE'], args={"address": getIpAddress(), "files": self.localFiles})
-        self.trackerHandler.send(req.export())
-
-        res = self.trackerHandler.recv()
-        res = Response(**pickle.loads(res))
+        updated = self.updateTracker(added={fileHash: file})
 
         # There is no much to doo actually. Could raise an error though
-        if res.status != 200:
-            os.remove(os.path.join(self.diskDirectory, file.name))
-            
+        if not updated:
             del self.localFiles[fileHash]
 
+            self.discardFile(fileHash, file)
+
+            if forwarder:
+                forwarder.stop()
+
             res = Response(status=400, message=f'File not uploaded')
             self.opHandler.send(res.export())
             return
-        
-        res = Response(status=200, message=f'File uploaded')
+
+        # Answered once the local copy is durable. The forwarder finishes sending the file down the chain on its
+        # own thread, and the client follows it with UPLOAD_STATUS instead of holding this socket
+        if forwarder:
+            self.pruneChains()
+            self.chains[fileHash] = forwarder
+
+        res = Response(status=200, message=self.uploadStatus(fileHash))
+        self.opHandler.send(res.export())
+
+    # {"replicas": seeders holding the local file durably, "done": whether its chain finished}
+    def uploadStatus(self, fileHash)->dict:
+        forwarder = self.chains.get(fileHash)
+        if not forwarder:
+            return {"replicas": [getIpAddress()], "done": True}
+
+        return {"replicas": [getIpAddress(), *forwarder.replicas], "done": forwarder.done}
+
+    def pruneChains(self):
+        now = time.monotonic()
+
+        for fileHash, forwarder in list(self.chains.items()):
+            if forwarder.done and now - forwarder.finished > CHAIN_STATUS_TTL:
+                del self.chains[fileHash]
+
+    def uploadStatusHandler(self, args):
+        fileHash = args.get('fileHash')
+
+        if fileHash not in self.localFiles:
+            res = Response(status=404, message=f'File not found')
+            self.opHandler.send(res.export())
+            return
+
+        res = Response(status=200, message=self.uploadStatus(fileHash))
         self.opHandler.send(res.export())
 
+    # The token bucket of the replication transfers into this seeder, capped at "rateLimit" unless it is no cap.
+    # Copies, chunk copies and shard builds all draw from it, so the cap holds however many of them run
+    def replicationBucket(self, rateLimit):
+        rate = rateLimit if type(rateLimit) == int and rateLimit > 0 else None
+
+        with self.bucketLock:
+            if self.bucket.rate != rate:
+                self.bucket.rate = rate
+
+            return self.bucket
+
+    # Run a replication transfer on its own thread and answer the request with the Response "transfer" returns,
+    # so the seeder keeps serving meanwhile. A request for a transfer already running waits for that one
+    def replicateInBackground(self, key, transfer):
+        answer = self.opHandler.defer()
+
+        with self.replicationLock:
+            if key in self.replications:
+                self.replications[key].append(answer)
+                return
+
+            self.replications[key] = [answer]
+
+        threading.Thread(target=self.runReplication, args=(key, transfer), daemon=True).start()
+
+    def runReplication(self, key, transfer):
+        try:
+            res = transfer()
+        except Exception as e:
+            print(f'Replication of {key} failed: {e}', flush=True)
+            res = Response(status=500, message=str(e))
+
+        with self.replicationLock:
+            answers = self.replications.pop(key)
+
+        for answer in answers:
+            answer(res.export())
+
     def requestGetHandler(self, args):
         fileHash = args.get('fileHash')
         fileName = args.get('fileName')
@@ -160,7 +818,7 @@ class Seeder:
             return
         
         if fileHash in self.localFiles:
-            res = Response(status=200, message=f'File already exists')
+            res = Response(status=200, message={"file": self.localFiles[fileHash], "sequence": self.sequences[self.shardMap.shardOf(fileHash)]})
             self.opHandler.send(res.export())
             return
         
@@ -168,18 +826,247 @@ class Seeder:
             'fileHash': fileHash,
             'fileName': fileName,
             'size': size,
-            'seeders': seeders
+            'seeders': seeders,
+            'merkleRoot': args.get('merkleRoot')
         }
-        
-        getFileDistributedly(self.context, fileInformation, outputDirectory=self.diskDirectory)
 
-        self.localFiles[fileHash] = File(name=fileName, size=size, lastModified=datetime.now().timestamp())
+        bucket = self.replicationBucket(args.get('rateLimit'))
+
+        self.replicateInBackground(fileHash, lambda: self.copyFile(fileInformation, bucket))
+
+    # Copy a whole file from the seeders holding it. Returns the answer to REQUEST_GET
+    def copyFile(self, fileInformation, bucket)->Response:
+        fileHash = fileInformation['fileHash']
+
+        # With the chunk store only the chunks missing here are copied, from a seeder using it too
+        file = self.replicateChunks(fileInformation, bucket) if self.chunkStore else None
+
+        if not file:
+            outputFilepath = getFileDistributedly(self.context, fileInformation, outputDirectory=self.diskDirectory, bucket=bucket)
+
+            if not outputFilepath:
+                return Response(status=500, message=f'File not downloaded')
+
+            # Chunks were checked against the tracker Merkle root while downloading when it had one.
+            # Hashing the copy again also checks files without one and gives the leaves to serve
+            fullHash, leaves = hashChunks(outputFilepath)
+            if fullHash[:HASH_SIZE] != fileHash:
+                os.remove(outputFilepath)
+
+                return Response(status=500, message=f'Downloaded file does not match its hash')
+
+            file = self.storeFile(fileHash, outputFilepath, fullHash, leaves)
+            self.manifest.save()
+
+        self.localFiles[fileHash] = file
 
         # ...
         # Is there a way to call the tracker SEEDER_UPDATE operation without dead-locking the tracker?
-        # I guess not. So update the files manually inside the Tracker
+        # I guess not. So the tracker applies the change itself, numbered with the sequence sent back
+        sequence = self.nextSequence(fileHash)
+
+        return Response(status=200, message={"file": file, "sequence": sequence})
+
+    # Copy a file from the recipe of another seeder, fetching only the chunks this seeder does not have.
+    # Returns the new File, or None if no seeder could provide it
+    def replicateChunks(self, fileInformation, bucket=None):
+        fileHash = fileInformation['fileHash']
+        pool = connectionPool(self.context)
+        req = OperationRequest(operation=SEEDER_OPERATIONS['GET_RECIPE'], args={"fileHash": fileHash})
+
+        for seeder in fileInformation['seeders']:
+            # The chunks of the recipe are pinned: the ones this seeder has are kept while the missing ones are fetched,
+            # and the fetched ones are deleted again if the file does not check out
+            digests = []
+
+            try:
+                with pool.connection(SeederHandler, seeder, timeout=STREAM_TIMEOUT) as seederHandler:
+                    seederHandler.send(req.export())
+                    res = Response.load(seederHandler.recv())
+
+                    if res.status != 200:
+                        continue
+
+                    recipe = res.message
+                    digests = [digest for digest, _ in recipe['chunks']]
+                    self.chunkStore.pin(digests)
+
+                    self.fetchChunks(seederHandler, fileHash, recipe['chunks'], bucket)
+
+                fullHash, leaves = self.chunkStore.hashRecipe(recipe['chunks'])
+                if fullHash[:HASH_SIZE] != fileHash:
+                    print(f'Seeder {seeder}: recipe does not match the file', flush=True)
+                    continue
+
+                root = self.saveLeaves(fileHash, leaves)
+                lastModified = datetime.now().timestamp()
+                self.chunkStore.addRecipe(fileHash, {"name": recipe['name'], "size": recipe['size'], "lastModified": lastModified, "root": root, "chunks": recipe['chunks']})
+
+                return File(name=recipe['name'], size=recipe['size'], lastModified=lastModified, merkleRoot=root)
+            except zmq.error.Again:
+                print(f'Seeder {seeder}: timed out', flush=True)
+            except Exception as e:
+                print(f'Seeder {seeder}: {e.args[0] if e.args else e}', flush=True)
+            finally:
+                self.chunkStore.release(digests)
+
+        return None
+
+    # Fetch the missing "chunks" of a file with range GETs, merging neighbouring chunks up to STREAM_CHUNK_SIZE bytes per request
+    def fetchChunks(self, seederHandler, fileHash, chunks, bucket=None):
+        ranges = []
+        offset = 0
+
+        for digest, size in chunks:
+            if not self.chunkStore.hasChunk(digest):
+                if ranges and ranges[-1][0] + ranges[-1][1] == offset and ranges[-1][1] + size <= STREAM_CHUNK_SIZE:
+                    ranges[-1][1] += size
+                    ranges[-1][2].append((digest, size))
+                else:
+                    ranges.append([offset, size, [(digest, size)]])
+            offset += size
+
+        for offset, count, rangeChunks in ranges:
+            if bucket:
+                bucket.consume(count)
+
+            req = OperationRequest(operation=SEEDER_OPERATIONS['GET'], args={"fileHash": fileHash, "offset": offset, "count": count})
+            seederHandler.send(req.export())
+
+            res = Response.load(seederHandler.recv())
+            if res.status != 200 or res.message['count'] != count:
+                raise Exception(f'unable to get range at offset {offset}')
+
+            data = memoryview(res.message['data'])
+            position = 0
+            for digest, size in rangeChunks:
+                self.chunkStore.putChunk(data[position:position + size], expected=digest, pin=False)
+                position += size
+
+    def getRecipeHandler(self, args):
+        fileHash = args.get('fileHash')
+
+        recipe = self.chunkStore.getRecipe(fileHash) if self.chunkStore else None
+        if not recipe:
+            res = Response(status=404, message=f'File not found')
+            self.opHandler.send(res.export())
+            return
+
+        res = Response(status=200, message={"name": recipe['name'], "size": recipe['size'], "chunks": recipe['chunks']})
+        self.opHandler.send(res.export())
+
+    def shardPath(self, fileHash, index):
+        return os.path.join(self.shardDirectory, f'{fileHash}.{index}')
+
+    # Build and keep shard "index" of a file from the "sources" given by the tracker (see erasure.py)
+    def requestShardHandler(self, args):
+        fileHash = args.get('fileHash')
+        index = args.get('index')
+        dataShards = args.get('dataShards')
+        parityShards = args.get('parityShards')
+        fileName = args.get('fileName')
+        size = args.get('size')
+        sources = args.get('sources')
+
+        if type(fileHash) != str or len(fileHash) != HASH_SIZE or type(fileName) != str or type(size) != int or type(sources) != list:
+            res = Response(status=400, message=f'Invalid file hash, file name, size or sources')
+            self.opHandler.send(res.export())
+            return
+
+        if type(dataShards) != int or type(parityShards) != int or type(index) != int or not 0 <= index < dataShards + parityShards:
+            res = Response(status=400, message=f'Invalid shard layout')
+            self.opHandler.send(res.export())
+            return
+
+        key = f'{fileHash}#{index}'
+
+        if key in self.localFiles:
+            res = Response(status=200, message={"key": key, "file": self.localFiles[key], "sequence": self.nextSequence(key)})
+            self.opHandler.send(res.export())
+            return
+
+        bucket = self.replicationBucket(args.get('rateLimit'))
+
+        self.replicateInBackground(key, lambda: self.makeShard(key, args, bucket))
+
+    # Build a shard from its sources. Returns the answer to REQUEST_SHARD
+    def makeShard(self, key, args, bucket)->Response:
+        fileHash = args['fileHash']
+        index = args['index']
+        shardPath = self.shardPath(fileHash, index)
+
+        try:
+            buildShard(self.context, args['sources'], args['dataShards'], args['size'], index, shardPath + '.tmp', bucket=bucket)
+        except Exception as e:
+            if os.path.exists(shardPath + '.tmp'):
+                os.remove(shardPath + '.tmp')
+
+            return Response(status=500, message=f'Shard not built: {e.args[0] if e.args else e}')
+
+        os.replace(shardPath + '.tmp', shardPath)
+
+        lastModified = datetime.now().timestamp()
+        shard = {"fileHash": fileHash, "index": index, "dataShards": args['dataShards'], "parityShards": args['parityShards'],
+                 "fileName": args['fileName'], "fileSize": args['size'], "lastModified": lastModified, "merkleRoot": args.get('merkleRoot')}
+
+        atomicWrite(shardPath + '.json', json.dumps(shard))
+
+        file = File(name=os.path.basename(shardPath), size=os.path.getsize(shardPath), lastModified=lastModified, shard=shard)
+        self.localFiles[key] = file
+
+        # Applied by the tracker itself, like REQUEST_GET
+        sequence = self.nextSequence(key)
+
+        return Response(status=200, message={"key": key, "file": file, "sequence": sequence})
+
+    # Drop a whole copy or a shard on request of the tracker
+    def requestRemoveHandler(self, args):
+        fileHash = args.get('fileHash')
+
+        file = self.localFiles.pop(fileHash, None)
+        if not file:
+            res = Response(status=404, message=f'File not found')
+            self.opHandler.send(res.export())
+            return
+
+        shard = getattr(file, 'shard', None)
+        if shard:
+            shardPath = self.shardPath(shard['fileHash'], shard['index'])
+
+            # A shard or sidecar already gone counts as removed
+            for path in (shardPath + '.json', shardPath):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+            self.readCache.invalidate(fileHash)
+        else:
+            self.discardFile(fileHash, file)
+
+        sequence = self.nextSequence(fileHash)
+
+        res = Response(status=200, message={"sequence": sequence})
+        self.opHandler.send(res.export())
+
+    def chunkHashesHandler(self, args):
+        fileHash = args.get('fileHash')
+
+        if fileHash not in self.localFiles:
+            res = Response(status=404, message=f'File not found')
+            self.opHandler.send(res.export())
+            return
+
+        # Files hashed before leaves were kept have none
+        try:
+            with open(self.leavesPath(fileHash), 'rb') as f:
+                leaves = f.read()
+        except FileNotFoundError:
+            res = Response(status=404, message=f'File not found')
+            self.opHandler.send(res.export())
+            return
 
-        res = Response(status=200, message=f'File downloaded')
+        res = Response(status=200, message={"root": self.localFiles[fileHash].merkleRoot, "leaves": leaves})
         self.opHandler.send(res.export())
 
 
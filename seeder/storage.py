@@ -0,0 +1,375 @@
+import os
+import json
+import bisect
+import hashlib
+import threading
+import numpy as np
+from utils import MERKLE_CHUNK_SIZE, chunkDigest, atomicWrite
+
+# Content-defined chunking parameters (FastCDC style). Chunks are never smaller than CDC_MIN_SIZE
+# nor bigger than CDC_MAX_SIZE and are CDC_AVERAGE_SIZE long on average. Before the average size a
+# stricter mask is used and after it a looser one, which keeps chunk sizes close to the average
+CDC_MIN_SIZE = 2 * 1024
+CDC_AVERAGE_SIZE = 8 * 1024
+CDC_MAX_SIZE = 64 * 1024
+
+# The hash is kept to GEAR_BITS bits so it stays a small int, and the mask bits are spread over
+# them so a cut depends on the last GEAR_BITS bytes rather than on the last few only
+GEAR_BITS = 30
+GEAR_MASK = (1 << GEAR_BITS) - 1
+
+def spreadMask(bits)->int:
+    return sum(1 << (position * (GEAR_BITS - 1) // (bits - 1)) for position in range(bits))
+
+CDC_MASK_STRICT = spreadMask(15)
+CDC_MASK_LOOSE = spreadMask(11)
+
+# Files are read in blocks of CDC_READ_SIZE bytes while being chunked
+CDC_READ_SIZE = 4 * 1024 * 1024
+
+# Gear table: one pseudo random value per byte value, derived from SHA-256 so every seeder cuts the same way
+GEAR = [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:4], 'big') & GEAR_MASK for value in range(256)]
+GEAR_ARRAY = np.array(GEAR, dtype=np.uint32)
+
+# Length of the chunk starting at "start" in "data" (rolling Gear hash).
+# The first CDC_MIN_SIZE bytes are never a cut point, so they are not even hashed.
+# Reference version of the cut points of CutPoints, which finds the same ones on a whole buffer at once
+def cutPoint(data, start, end)->int:
+    size = end - start
+    if size <= CDC_MIN_SIZE:
+        return size
+
+    normalEnd = start + min(size, CDC_AVERAGE_SIZE)
+    stop = start + min(size, CDC_MAX_SIZE)
+
+    gear = GEAR
+    h = 0
+    i = start + CDC_MIN_SIZE
+
+    for byte in data[i:normalEnd]:
+        h = ((h << 1) + gear[byte]) & GEAR_MASK
+        i += 1
+        if not h & CDC_MASK_STRICT:
+            return i - start
+
+    for byte in data[normalEnd:stop]:
+        h = ((h << 1) + gear[byte]) & GEAR_MASK
+        i += 1
+        if not h & CDC_MASK_LOOSE:
+            return i - start
+
+    return stop - start
+
+class CutPoints:
+    """
+    Cut points of a buffer, as cutPoint finds them but without a Python step per byte.
+    The Gear hash keeps GEAR_BITS bits and shifts one bit per byte, so once GEAR_BITS bytes are hashed it only
+    depends on the last GEAR_BITS of them: it is the same "window" hash at every position of the buffer. That hash
+    is computed for the whole buffer with numpy, by doubling windows, and a chunk is cut at the first position where
+    it matches the mask. Only the first GEAR_BITS - 1 bytes hashed for every chunk are hashed one by one.
+        - strict, loose: positions (of the last byte of a chunk) where the window hash matches each mask
+    """
+    def __init__(self, data):
+        self.data = data
+
+        # 32 bit arithmetic wraps around, which keeps the low GEAR_BITS bits right
+        window = GEAR_ARRAY[np.frombuffer(data, dtype=np.uint8)]
+        span = 1
+        while span < GEAR_BITS:
+            window[span:] += window[:-span] << np.uint32(span)
+            span *= 2
+
+        self.strict = np.flatnonzero((window & np.uint32(CDC_MASK_STRICT)) == 0)
+        self.loose = np.flatnonzero((window & np.uint32(CDC_MASK_LOOSE)) == 0)
+
+    # Length of the chunk starting at "start", as cutPoint(data, start, end)
+    def cut(self, start, end)->int:
+        size = end - start
+        if size <= CDC_MIN_SIZE:
+            return size
+
+        normalEnd = start + min(size, CDC_AVERAGE_SIZE)
+        stop = start + min(size, CDC_MAX_SIZE)
+
+        # The hash of the first bytes of the chunk covers less than a whole window
+        gear = GEAR
+        h = 0
+        i = start + CDC_MIN_SIZE
+        windowStart = min(i + GEAR_BITS - 1, stop)
+
+        for byte in self.data[i:windowStart]:
+            h = ((h << 1) + gear[byte]) & GEAR_MASK
+            i += 1
+            if not h & (CDC_MASK_STRICT if i <= normalEnd else CDC_MASK_LOOSE):
+                return i - start
+
+        for positions, low, high in ((self.strict, windowStart, normalEnd), (self.loose, max(windowStart, normalEnd), stop)):
+            index = np.searchsorted(positions, low)
+            if index < len(positions) and positions[index] < high:
+                return int(positions[index]) + 1 - start
+
+        return stop - start
+
+# Split the file at "path" in content defined chunks. Yields the chunks as bytes
+def chunkFile(path):
+    with open(path, 'rb') as f:
+        buffer = b''
+
+        while True:
+            block = f.read(CDC_READ_SIZE)
+            buffer = buffer + block if buffer else block
+
+            # Keep at least one maximum chunk buffered so cut points do not depend on the read size
+            pos = 0
+            cutPoints = CutPoints(buffer)
+            while len(buffer) - pos >= CDC_MAX_SIZE or (not block and pos < len(buffer)):
+                length = cutPoints.cut(pos, len(buffer))
+                yield buffer[pos:pos + length]
+                pos += length
+
+            buffer = buffer[pos:]
+
+            if not block:
+                return
+
+class ChunkStore:
+    """
+    Deduplicated storage engine. Files are split in content defined chunks, every distinct chunk is
+    stored once under its SHA-256 and a file is kept as its recipe, the ordered list of its chunks:
+        - /disk/.chunks/<digest[:2]>/<digest>: chunk data
+        - /disk/.recipes/<fileHash>.json: {"name", "size", "lastModified", "root", "chunks": [[digest, size], ...]}
+    Chunks are reference counted over the recipes and removed with the last file using them.
+    A chunk written for a recipe that is not stored yet is pinned until the recipe is stored or given up,
+    so removing another file meanwhile does not delete it. Chunks are not synced one by one: a single sync
+    before a recipe is written makes every chunk written so far durable, so a recipe never outlives its chunks.
+    """
+    def __init__(self, directory):
+        self.lock = threading.Lock()
+
+        self.chunkDirectory = os.path.join(directory, '.chunks')
+        self.recipeDirectory = os.path.join(directory, '.recipes')
+        os.makedirs(self.chunkDirectory, exist_ok=True)
+        os.makedirs(self.recipeDirectory, exist_ok=True)
+
+        # fileHash -> recipe
+        self.recipes = {}
+        # fileHash -> offset of every chunk, to find the chunks of a range by bisection
+        self.offsets = {}
+        # digest -> number of recipe entries using the chunk
+        self.references = {}
+        # digest -> number of recipes being stored with the chunk
+        self.pins = {}
+
+        # Bytes of the distinct chunks in use
+        self.storedBytes = 0
+
+        # Whether chunks were written since the last sync
+        self.unsynced = False
+
+        for filename in os.listdir(self.recipeDirectory):
+            if not filename.endswith('.json'):
+                continue
+
+            with open(os.path.join(self.recipeDirectory, filename), 'r') as f:
+                self.addRecipeLocked(filename[:-len('.json')], json.load(f))
+
+    def chunkPath(self, digest):
+        return os.path.join(self.chunkDirectory, digest[:2], digest)
+
+    def recipePath(self, fileHash):
+        return os.path.join(self.recipeDirectory, f'{fileHash}.json')
+
+    def hasChunk(self, digest)->bool:
+        with self.lock:
+            return digest in self.references or os.path.exists(self.chunkPath(digest))
+
+    # Store a chunk and return its digest. When the "expected" digest is given, a chunk that does not match it is refused.
+    # The chunk is pinned unless "pin" is False (it already is): the caller stores its recipe or releases it
+    def putChunk(self, data, expected=None, pin=True)->str:
+        digest = hashlib.sha256(data).hexdigest()
+        if expected is not None and digest != expected:
+            raise Exception('Chunk does not match its digest')
+
+        path = self.chunkPath(digest)
+
+        # Pinned before looking for it, so a chunk found here is not deleted before its recipe is stored
+        with self.lock:
+            if pin:
+                self.pins[digest] = self.pins.get(digest, 0) + 1
+            exists = os.path.exists(path)
+
+        if not exists:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write and rename, a chunk is either complete or absent. Threads storing the same chunk write their own copy
+            temporaryPath = f'{path}.{threading.get_ident()}.tmp'
+            with open(temporaryPath, 'wb') as f:
+                f.write(data)
+            os.replace(temporaryPath, path)
+
+            self.unsynced = True
+
+        return digest
+
+    def readChunk(self, digest):
+        with open(self.chunkPath(digest), 'rb') as f:
+            return f.read()
+
+    # Keep the chunks of "digests" until they are released, whether recipes use them or not
+    def pin(self, digests):
+        with self.lock:
+            for digest in digests:
+                self.pins[digest] = self.pins.get(digest, 0) + 1
+
+    # Drop the pins of "digests". The chunks no recipe uses are deleted, e.g. the ones of a file that failed its hash check
+    def release(self, digests):
+        with self.lock:
+            for digest in digests:
+                self.pins[digest] -= 1
+                if not self.pins[digest]:
+                    del self.pins[digest]
+                    self.deleteChunkLocked(digest)
+
+    # Chunk the file at "path" into the store. The file itself is left untouched
+    def ingest(self, fileHash, path, name, lastModified, root):
+        chunks = []
+
+        try:
+            for data in chunkFile(path):
+                chunks.append([self.putChunk(data), len(data)])
+
+            return self.addRecipe(fileHash, {"name": name, "size": sum(size for _, size in chunks), "lastModified": lastModified, "root": root, "chunks": chunks})
+        finally:
+            self.release(digest for digest, _ in chunks)
+
+    # Store a recipe whose chunks are all in the store already, and pinned
+    def addRecipe(self, fileHash, recipe):
+        # Cleared first: a chunk written during the sync may not be in it, and is synced with the next recipe
+        if self.unsynced:
+            self.unsynced = False
+            os.sync()
+
+        atomicWrite(self.recipePath(fileHash), json.dumps(recipe))
+
+        with self.lock:
+            unused = self.removeRecipeLocked(fileHash) if fileHash in self.recipes else []
+            self.addRecipeLocked(fileHash, recipe)
+
+            # Chunks of the previous version of the file the new one does not use
+            for digest in unused:
+                self.deleteChunkLocked(digest)
+
+        return recipe
+
+    def remove(self, fileHash):
+        with self.lock:
+            if fileHash not in self.recipes:
+                return
+
+            # The recipe goes first: a crash in between leaves unused chunks behind, never a recipe missing some
+            try:
+                os.remove(self.recipePath(fileHash))
+            except FileNotFoundError:
+                pass
+
+            for digest in self.removeRecipeLocked(fileHash):
+                self.deleteChunkLocked(digest)
+
+    def getRecipe(self, fileHash):
+        with self.lock:
+            return self.recipes.get(fileHash)
+
+    def listRecipes(self)->dict:
+        with self.lock:
+            return dict(self.recipes)
+
+    def read(self, fileHash, offset, count)->bytes:
+        with self.lock:
+            recipe = self.recipes[fileHash]
+            offsets = self.offsets[fileHash]
+
+        data = bytearray()
+        index = max(bisect.bisect_right(offsets, offset) - 1, 0)
+
+        while len(data) < count and index < len(recipe['chunks']):
+            digest, size = recipe['chunks'][index]
+            chunk = self.readChunk(digest)
+
+            start = max(offset + len(data) - offsets[index], 0)
+            data += chunk[start:start + count - len(data)]
+            index += 1
+
+        return bytes(data)
+
+    # Whole file MD5 and Merkle leaves of the file made of "chunks", like utils.hashChunks for a plain file
+    def hashRecipe(self, chunks):
+        hasher = hashlib.md5()
+        leaves = bytearray()
+        block = bytearray()
+
+        for digest, _ in chunks:
+            data = self.readChunk(digest)
+            hasher.update(data)
+            block += data
+
+            while len(block) >= MERKLE_CHUNK_SIZE:
+                leaves += chunkDigest(block[:MERKLE_CHUNK_SIZE])
+                del block[:MERKLE_CHUNK_SIZE]
+
+        if block:
+            leaves += chunkDigest(block)
+
+        return hasher.hexdigest(), bytes(leaves)
+
+    def stats(self)->dict:
+        with self.lock:
+            logicalBytes = sum(recipe['size'] for recipe in self.recipes.values())
+
+            return {
+                "files": len(self.recipes),
+                "chunks": len(self.references),
+                "logicalBytes": logicalBytes,
+                "storedBytes": self.storedBytes,
+                "dedupRatio": logicalBytes / self.storedBytes if self.storedBytes else 1.0,
+            }
+
+    def addRecipeLocked(self, fileHash, recipe):
+        self.recipes[fileHash] = recipe
+
+        offsets = []
+        position = 0
+        for digest, size in recipe['chunks']:
+            offsets.append(position)
+            position += size
+
+            if digest not in self.references:
+                self.references[digest] = 0
+                self.storedBytes += size
+            self.references[digest] += 1
+
+        self.offsets[fileHash] = offsets
+
+    # Delete a chunk unless a recipe uses it or it is pinned
+    def deleteChunkLocked(self, digest):
+        if digest in self.references or digest in self.pins:
+            return
+
+        try:
+            os.remove(self.chunkPath(digest))
+        except FileNotFoundError:
+            pass
+
+    # Drop a recipe and return the chunks no other recipe uses
+    def removeRecipeLocked(self, fileHash):
+        recipe = self.recipes.pop(fileHash)
+        del self.offsets[fileHash]
+
+        unused = []
+        for digest, size in recipe['chunks']:
+            self.references[digest] -= 1
+            if not self.references[digest]:
+                del self.references[digest]
+                self.storedBytes -= size
+                unused.append(digest)
+
+        return unused
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The services import their modules as top level ones, as in their containers where utils.py is mounted next to them.
+# The repository root goes first: seeder/utils.py and tracker/utils.py are only placeholders for that mount
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for directory in ('tracker', 'seeder', ''):
+    sys.path.insert(0, os.path.join(ROOT, directory))
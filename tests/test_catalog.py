@@ -0,0 +1,96 @@
+import sys
+import fnmatch
+import pytest
+from random import Random
+from catalog import Catalog
+from tracker import Seeder
+from utils import File
+
+def makeCatalog(names):
+    catalog = Catalog()
+    files = {f'hash{index}': File(name=name, size=1, lastModified=0) for index, name in enumerate(names)}
+    catalog.addSeeder(Seeder('10.0.0.1', files=files))
+    return catalog
+
+def pageNames(catalog, **kwargs):
+    files, _ = catalog.listPage(**kwargs)
+    return [file.name for _, file in files]
+
+def testPrefixEndingInTheLastCodePoint():
+    last = chr(sys.maxunicode)
+    catalog = makeCatalog(['a', 'a' + last, 'a' + last + 'x', 'b', last, last + last, last + 'z'])
+
+    for reverse in (False, True):
+        order = (lambda names: names[::-1]) if reverse else list
+        assert pageNames(catalog, prefix='a' + last, reverse=reverse) == order(['a' + last, 'a' + last + 'x'])
+        assert pageNames(catalog, prefix=last, reverse=reverse) == order([last, last + 'z', last + last])
+        assert pageNames(catalog, prefix=last + last, reverse=reverse) == [last + last]
+
+# What listPage should page through: every listed file, in (name, fileHash) order
+def bruteForce(catalog, prefix='', pattern=None, reverse=False):
+    entries = sorted((file.name, fileHash) for fileHash, file in catalog.listFiles().items())
+    entries = [entry for entry in entries if entry[0].startswith(prefix) and (not pattern or fnmatch.fnmatchcase(entry[0], pattern))]
+    return [fileHash for _, fileHash in (entries[::-1] if reverse else entries)]
+
+def pageThrough(catalog, limit, **kwargs):
+    listed = []
+    cursor = None
+
+    while True:
+        files, cursor = catalog.listPage(cursor=cursor, limit=limit, **kwargs)
+        assert len(files) <= limit
+        listed += [fileHash for fileHash, _ in files]
+
+        if cursor is None:
+            return listed
+
+# A catalog of two seeders that went through adds, renames and removals, past the point the name index is rebuilt
+def churnedCatalog(seed):
+    random = Random(seed)
+    catalog = Catalog()
+    addresses = ['10.0.0.1', '10.0.0.2']
+    for address in addresses:
+        catalog.addSeeder(Seeder(address, files={}))
+
+    words = ['a', 'ab', 'abc', 'b', 'ba', 'log-', 'log-2024', 'é', 'z']
+    for _ in range(3000):
+        address = random.choice(addresses)
+        fileHash = f'hash{random.randrange(800)}'
+        if random.random() < 0.2:
+            catalog.removeFile(address, fileHash)
+        else:
+            name = random.choice(words) + random.choice(words) + str(random.randrange(5))
+            catalog.addFile(address, fileHash, File(name=name, size=random.randrange(100), lastModified=0))
+
+    return catalog
+
+@pytest.mark.parametrize("seed", [1, 2])
+@pytest.mark.parametrize("limit", [1, 7, 1000])
+@pytest.mark.parametrize("reverse", [False, True])
+@pytest.mark.parametrize("prefix, pattern", [('', None), ('a', None), ('log-', None), ('ab', '*[0-2]'), ('', '*z*'), ('q', None)])
+def testPagesMatchABruteForceListing(seed, limit, reverse, prefix, pattern):
+    catalog = churnedCatalog(seed)
+    expected = bruteForce(catalog, prefix, pattern, reverse)
+
+    assert pageThrough(catalog, limit, prefix=prefix, pattern=pattern, reverse=reverse) == expected
+    assert pageThrough(catalog, limit, prefix=prefix, pattern=pattern, reverse=reverse, scanLimit=5) == expected
+
+def testListingFollowsChangesBetweenPages():
+    catalog = makeCatalog([f'file{index:03}' for index in range(100)])
+
+    files, cursor = catalog.listPage(limit=10)
+    assert [file.name for _, file in files] == [f'file{index:03}' for index in range(10)]
+
+    # Renamed behind the cursor, removed ahead of it, added ahead of it
+    catalog.addFile('10.0.0.1', 'hash0', File(name='file999', size=1, lastModified=0))
+    catalog.removeFile('10.0.0.1', 'hash50')
+    catalog.addFile('10.0.0.1', 'new', File(name='file050b', size=1, lastModified=0))
+
+    listed = []
+    while cursor:
+        files, cursor = catalog.listPage(cursor=cursor, limit=10)
+        listed += [file.name for _, file in files]
+
+    expected = [f'file{index:03}' for index in range(10, 100) if index != 50]
+    expected.insert(expected.index('file051'), 'file050b')
+    assert listed == expected + ['file999']
@@ -0,0 +1,145 @@
+import os
+import time
+import pytest
+import utils
+from utils import ChunkScheduler, chunkDigest, MERKLE_MAX_BAD_CHUNKS
+
+CHUNK_SIZE = 1024
+DATA = os.urandom(20 * CHUNK_SIZE + 100)
+LEAVES = b''.join(chunkDigest(DATA[offset:offset + CHUNK_SIZE]) for offset in range(0, len(DATA), CHUNK_SIZE))
+
+@pytest.fixture(autouse=True)
+def fastHedging(monkeypatch):
+    monkeypatch.setattr(utils, 'HEDGE_MIN_DELAY', 0.01)
+
+# Chunk data as sent by a seeder, a corrupted one flips its first byte
+def sendChunk(scheduler, index, corrupted=False):
+    offset, count = scheduler.chunkRange(index)
+    data = bytearray(DATA[offset:offset + count])
+    if corrupted:
+        data[0] ^= 0xff
+    return bytes(data)
+
+# Drive "seeders" (address -> behaviour) through the scheduler the way getChunksFromSeeder does, one chunk per turn.
+# Behaviours: "good" sends the right data, "corrupt" flips a byte, "dead" fails every chunk it claimed,
+# "slow" claims chunks and never answers. Returns the assembled file and the seeders that were given up on
+def download(scheduler, seeders, turns=1000):
+    output = bytearray(len(DATA))
+    dropped = set()
+    claimed = {address: [] for address in seeders}
+
+    for _ in range(turns):
+        if scheduler.finished():
+            break
+
+        for address, behaviour in seeders.items():
+            if address in dropped:
+                continue
+
+            index = scheduler.claim(address)
+            if index is None:
+                continue
+
+            claimed[address].append(index)
+
+            if behaviour == 'slow':
+                continue
+            if behaviour == 'dead':
+                scheduler.fail(address, claimed[address])
+                dropped.add(address)
+                continue
+
+            data = sendChunk(scheduler, index, corrupted=behaviour == 'corrupt')
+            if not scheduler.verify(index, data):
+                if scheduler.reject(address, index) > MERKLE_MAX_BAD_CHUNKS:
+                    scheduler.fail(address, claimed[address])
+                    dropped.add(address)
+                continue
+
+            offset, _ = scheduler.chunkRange(index)
+            if scheduler.complete(address, index, len(data), 0.001):
+                output[offset:offset + len(data)] = data
+
+        time.sleep(0.001)
+
+    return bytes(output), dropped
+
+def makeScheduler(seeders, leaves=LEAVES):
+    return ChunkScheduler(len(DATA), CHUNK_SIZE, list(seeders), leaves=leaves)
+
+def testChunkRanges():
+    scheduler = makeScheduler(['a'])
+
+    assert scheduler.chunkCount == 21
+    assert scheduler.chunkRange(0) == (0, CHUNK_SIZE)
+    assert scheduler.chunkRange(20) == (20 * CHUNK_SIZE, 100)
+
+def testHealthySeedersShareTheChunks():
+    seeders = {'a': 'good', 'b': 'good'}
+    scheduler = makeScheduler(seeders)
+    output, dropped = download(scheduler, seeders)
+
+    assert output == DATA
+    assert not dropped
+
+def testCorruptedChunksAreFetchedAgainFromAnotherSeeder():
+    seeders = {'bad': 'corrupt', 'good': 'good'}
+    scheduler = makeScheduler(seeders)
+    output, dropped = download(scheduler, seeders)
+
+    assert output == DATA
+    assert dropped == {'bad'}
+    assert scheduler.badChunks == {'bad': MERKLE_MAX_BAD_CHUNKS + 1, 'good': 0}
+
+def testCorruptedChunksAreAcceptedWithoutLeaves():
+    scheduler = makeScheduler(['a'], leaves=None)
+    assert scheduler.verify(0, sendChunk(scheduler, 0, corrupted=True))
+
+def testChunksOfADeadSeederGoBackToTheOthers():
+    seeders = {'dead': 'dead', 'good': 'good'}
+    scheduler = makeScheduler(seeders)
+    output, dropped = download(scheduler, seeders)
+
+    assert output == DATA
+    assert dropped == {'dead'}
+
+def testChunksLateOnASlowSeederAreHedged():
+    seeders = {'slow': 'slow', 'fast': 'good'}
+    scheduler = makeScheduler(seeders)
+    output, _ = download(scheduler, seeders)
+
+    assert output == DATA
+
+    # The slow copy answering last loses
+    assert not scheduler.complete('slow', 0, CHUNK_SIZE, 10)
+
+def testChunksAreNotHedgedBeforeTheyAreLate(monkeypatch):
+    monkeypatch.setattr(utils, 'HEDGE_MIN_DELAY', 60)
+    scheduler = makeScheduler(['slow', 'fast'])
+
+    assert scheduler.claim('slow') == 0
+    for index in range(1, scheduler.chunkCount):
+        assert scheduler.claim('fast') == index
+        scheduler.complete('fast', index, CHUNK_SIZE, 0.001)
+
+    assert scheduler.claim('fast') is None
+    assert not scheduler.finished()
+
+def testMarkedChunksAreNotHandedOut():
+    scheduler = makeScheduler(['a'])
+    scheduler.markDone(range(1, scheduler.chunkCount))
+
+    assert scheduler.claim('a') == 0
+    assert scheduler.claim('a') is None
+    assert scheduler.complete('a', 0, CHUNK_SIZE, 0.001)
+    assert scheduler.finished()
+
+def testWindowGrowsWithThroughput():
+    scheduler = makeScheduler(['a', 'b'])
+    first = scheduler.window('a')
+
+    scheduler.complete('a', scheduler.claim('a'), CHUNK_SIZE, 1e-6)
+    scheduler.complete('b', scheduler.claim('b'), CHUNK_SIZE, 10)
+
+    assert scheduler.window('a') > first
+    assert scheduler.window('b') == 2
@@ -0,0 +1,57 @@
+import os
+import itertools
+import numpy as np
+import pytest
+from erasure import combineBlocks, generatorRow, gfInv, gfMul, invertMatrix, rebuildCoefficients, shardSize
+
+# Data shards of "data" (the last one zero padded) followed by the parity shards
+def encode(data, dataShards, parityShards):
+    length = shardSize(len(data), dataShards)
+    padded = np.frombuffer(data.ljust(length * dataShards, b'\x00'), dtype=np.uint8)
+
+    shards = [padded[index * length:(index + 1) * length] for index in range(dataShards)]
+    shards += [combineBlocks(shards, generatorRow(dataShards, index)) for index in range(dataShards, dataShards + parityShards)]
+    return shards
+
+def testFieldArithmetic():
+    for a in range(1, 256):
+        assert gfMul(a, gfInv(a)) == 1
+        assert gfMul(a, 1) == a
+        assert gfMul(a, 0) == 0
+
+    with pytest.raises(ZeroDivisionError):
+        gfInv(0)
+
+def testMatrixInverse():
+    matrix = [generatorRow(3, index) for index in (1, 3, 4)]
+    inverse = invertMatrix(matrix)
+
+    for row in range(3):
+        for column in range(3):
+            product = 0
+            for i in range(3):
+                product ^= gfMul(matrix[row][i], inverse[i][column])
+            assert product == (row == column)
+
+@pytest.mark.parametrize("dataShards, parityShards, size", [(2, 1, 1000), (4, 2, 4099), (3, 3, 1), (5, 3, 12345)])
+def testEveryShardIsRebuiltFromAnyDataShardsCount(dataShards, parityShards, size):
+    data = os.urandom(size)
+    shards = encode(data, dataShards, parityShards)
+
+    for indexes in itertools.combinations(range(dataShards + parityShards), dataShards):
+        for target in range(dataShards + parityShards):
+            coefficients = rebuildCoefficients(dataShards, list(indexes), target)
+            rebuilt = combineBlocks([shards[index] for index in indexes], coefficients)
+
+            assert np.array_equal(rebuilt, shards[target])
+
+def testFileIsRebuiltFromParityOnly():
+    data = os.urandom(10000)
+    shards = encode(data, 2, 2)
+    indexes = [2, 3]
+
+    rebuilt = b''.join(combineBlocks([shards[index] for index in indexes], rebuildCoefficients(2, indexes, target)).tobytes() for target in range(2))
+    assert rebuilt[:len(data)] == data
+
+def testShardOfItsOwnIsCopied():
+    assert rebuildCoefficients(3, [0, 2, 4], 2) == [0, 1, 0]
@@ -0,0 +1,89 @@
+import os
+import pytest
+from catalog import Catalog
+from journal import CatalogJournal
+from tracker import Seeder
+from utils import File
+
+def makeFiles(*names):
+    return {f'hash-{name}': File(name=name, size=len(name), lastModified=0) for name in names}
+
+def names(restored):
+    return {address: (sorted(file.name for file in files.values()), sequence) for address, (files, sequence) in restored.items()}
+
+def logChanges(journal):
+    journal.register('10.0.0.1', makeFiles('a', 'b'), 1)
+    journal.register('10.0.0.2', makeFiles('c'), 1)
+    journal.update('10.0.0.1', 2, added=makeFiles('d'), removed=['hash-a'])
+    journal.remove('10.0.0.2')
+
+def lastSegment(directory):
+    segments = sorted(name for name in os.listdir(directory) if name.endswith('.wal'))
+    return os.path.join(directory, segments[-1])
+
+def testRestoreReplaysTheLog(tmp_path):
+    logChanges(CatalogJournal(str(tmp_path)))
+
+    restored = CatalogJournal(str(tmp_path)).restore()
+    assert names(restored) == {'10.0.0.1': (['b', 'd'], 2)}
+    assert vars(restored['10.0.0.1'][0]['hash-d']) == vars(makeFiles('d')['hash-d'])
+
+@pytest.mark.parametrize("cut", [1, 5, 9, 20])
+def testRestoreStopsAtATornTail(tmp_path, cut):
+    journal = CatalogJournal(str(tmp_path))
+    logChanges(journal)
+    path = lastSegment(str(tmp_path))
+    size = os.path.getsize(path)
+
+    journal.register('10.0.0.3', makeFiles('torn'), 1)
+    os.truncate(path, os.path.getsize(path) - cut)
+
+    assert os.path.getsize(path) > size
+    assert names(CatalogJournal(str(tmp_path)).restore()) == {'10.0.0.1': (['b', 'd'], 2)}
+
+def testRestoreStopsAtACorruptedRecord(tmp_path):
+    journal = CatalogJournal(str(tmp_path))
+    journal.register('10.0.0.1', makeFiles('a'), 1)
+    path = lastSegment(str(tmp_path))
+    size = os.path.getsize(path)
+    journal.register('10.0.0.2', makeFiles('b'), 1)
+    journal.register('10.0.0.3', makeFiles('c'), 1)
+
+    with open(path, 'r+b') as f:
+        f.seek(size + 10)
+        byte = f.read(1)
+        f.seek(size + 10)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+    assert names(CatalogJournal(str(tmp_path)).restore()) == {'10.0.0.1': (['a'], 1)}
+
+def testLoggingGoesOnAfterATornTail(tmp_path):
+    journal = CatalogJournal(str(tmp_path))
+    journal.register('10.0.0.1', makeFiles('a'), 1)
+    path = lastSegment(str(tmp_path))
+    journal.register('10.0.0.2', makeFiles('b'), 1)
+    os.truncate(path, os.path.getsize(path) - 3)
+
+    # A restarted tracker appends to a new segment, after the torn one
+    restarted = CatalogJournal(str(tmp_path))
+    assert names(restarted.restore()) == {'10.0.0.1': (['a'], 1)}
+    restarted.register('10.0.0.3', makeFiles('c'), 1)
+
+    assert names(CatalogJournal(str(tmp_path)).restore()) == {'10.0.0.1': (['a'], 1), '10.0.0.3': (['c'], 1)}
+
+def testSnapshotReplacesTheSegmentsItCovers(tmp_path):
+    journal = CatalogJournal(str(tmp_path))
+    catalog = Catalog()
+
+    for address, files in [('10.0.0.1', makeFiles('a', 'b')), ('10.0.0.2', makeFiles('c'))]:
+        catalog.addSeeder(Seeder(address, files=files, sequence=1))
+        journal.register(address, files, 1)
+
+    journal.snapshot(catalog)
+    journal.update('10.0.0.2', 2, added=makeFiles('e'))
+    path = lastSegment(str(tmp_path))
+    journal.remove('10.0.0.1')
+    os.truncate(path, os.path.getsize(path) - 1)
+
+    assert len([name for name in os.listdir(str(tmp_path)) if name.endswith('.wal')]) == 1
+    assert names(CatalogJournal(str(tmp_path)).restore()) == {'10.0.0.1': (['a', 'b'], 1), '10.0.0.2': (['c', 'e'], 2)}
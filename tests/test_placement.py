@@ -0,0 +1,98 @@
+import pytest
+from catalog import Catalog
+from placement import HashRingPlacement, RendezvousPlacement, createPlacement
+from tracker import Seeder
+
+SEEDERS = [f'10.0.0.{index}' for index in range(1, 11)]
+KEYS = [f'key{index}' for index in range(2000)]
+
+def makePlacement(strategy, seeders=SEEDERS, weights=None):
+    placement = HashRingPlacement(vnodes=100) if strategy == 'ring' else RendezvousPlacement()
+    for address in seeders:
+        placement.addSeeder(address, (weights or {}).get(address, 1.0))
+    return placement
+
+def placeAll(placement, count=2):
+    return {key: placement.place(key, count) for key in KEYS}
+
+@pytest.fixture(params=['ring', 'rendezvous'])
+def strategy(request):
+    return request.param
+
+def testPlacementsAreDistinctAndStable(strategy):
+    placement = makePlacement(strategy)
+    first = placeAll(placement, 3)
+
+    assert all(len(set(seeders)) == 3 for seeders in first.values())
+    assert placeAll(makePlacement(strategy, SEEDERS[::-1]), 3) == first
+
+def testOnlyTheKeysOfALeavingSeederMove(strategy):
+    placement = makePlacement(strategy)
+    before = placeAll(placement)
+
+    placement.removeSeeder(SEEDERS[0])
+    after = placeAll(placement)
+
+    for key in KEYS:
+        if SEEDERS[0] in before[key]:
+            # The copy on the other seeder stays where it is
+            assert SEEDERS[0] not in after[key]
+            assert set(before[key]) - {SEEDERS[0]} <= set(after[key])
+        else:
+            assert after[key] == before[key]
+
+    # Coming back restores every placement
+    placement.addSeeder(SEEDERS[0])
+    assert placeAll(placement) == before
+
+def testAJoiningSeederTakesItsShareOnly(strategy):
+    placement = makePlacement(strategy)
+    before = placeAll(placement, 1)
+
+    placement.addSeeder('10.0.0.99')
+    after = placeAll(placement, 1)
+
+    moved = [key for key in KEYS if after[key] != before[key]]
+    assert all(after[key] == ['10.0.0.99'] for key in moved)
+    assert 0 < len(moved) < 2 * len(KEYS) / (len(SEEDERS) + 1)
+
+def testKeysSpreadByWeight(strategy):
+    placement = makePlacement(strategy, weights={SEEDERS[0]: 3.0})
+    counts = {address: 0 for address in SEEDERS}
+    for seeders in placeAll(placement, 1).values():
+        counts[seeders[0]] += 1
+
+    others = sum(counts[address] for address in SEEDERS[1:]) / (len(SEEDERS) - 1)
+    assert 2 * others < counts[SEEDERS[0]] < 4.5 * others
+
+def testExcludedAndMissingSeeders(strategy):
+    placement = makePlacement(strategy, SEEDERS[:3])
+
+    assert SEEDERS[0] not in placement.place('key', 2, exclude=[SEEDERS[0]])
+    assert sorted(placement.place('key', 5)) == SEEDERS[:3]
+    assert placement.place('key', 2, exclude=SEEDERS[:3]) == []
+    assert makePlacement(strategy, []).place('key', 2) == []
+
+def testChurnThroughTheCatalog():
+    catalog = Catalog(placement='ring')
+    for address in SEEDERS:
+        catalog.addSeeder(Seeder(address, files={}))
+    before = {key: catalog.place(key, 2) for key in KEYS}
+
+    # Seeders leaving and coming back, with a weight kept across the absence
+    catalog.setWeight(SEEDERS[1], 2.0)
+    weighted = {key: catalog.place(key, 2) for key in KEYS}
+    for address in SEEDERS[:4]:
+        catalog.removeSeeder(address)
+    assert all(not set(catalog.place(key, 2)) & set(SEEDERS[:4]) for key in KEYS)
+
+    for address in SEEDERS[:4]:
+        catalog.addSeeder(Seeder(address, files={}))
+    assert {key: catalog.place(key, 2) for key in KEYS} == weighted
+
+    catalog.setWeight(SEEDERS[1], 1.0)
+    assert {key: catalog.place(key, 2) for key in KEYS} == before
+
+def testUnknownStrategy():
+    with pytest.raises(Exception):
+        createPlacement('random', None)
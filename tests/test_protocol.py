@@ -0,0 +1,159 @@
+import struct
+import pytest
+from utils import File, InvalidMessage, exportMessage, loadMessage, MESSAGE_RESPONSE, OPERATION_CODES, PAYLOAD_THRESHOLD, MAX_NESTING
+
+SHARD = {"fileHash": "abcde", "index": 1, "dataShards": 2, "parityShards": 1, "fileName": "a.bin", "fileSize": 3, "lastModified": "10:00", "merkleRoot": None}
+
+def roundTrip(value):
+    kind, code, decoded = loadMessage(exportMessage(MESSAGE_RESPONSE, 200, value))
+
+    assert (kind, code) == (MESSAGE_RESPONSE, 200)
+    return decoded
+
+def makeFiles(count):
+    files = {}
+    for index in range(count):
+        file = File(name=f'file-{index}.txt', size=index * 1000, lastModified=0, merkleRoot=f'{index:064x}' if index % 2 else None)
+        file.shard = dict(SHARD, index=index) if index % 3 == 0 else None
+        files[f'hash{index}'] = file
+    return files
+
+def assertSameFiles(decoded, files):
+    assert list(decoded) == list(files)
+    for fileHash, file in files.items():
+        assert type(decoded[fileHash]) == File
+        assert vars(decoded[fileHash]) == vars(file)
+
+# A message frame built by hand, after a valid header
+def rawMessage(args):
+    return [exportMessage(MESSAGE_RESPONSE, 200, None)[0], args]
+
+@pytest.mark.parametrize("value", [
+    None, True, False, 0, -1, 2**63 - 1, -2**63, 1.5, '', 'héllo', b'', b'\x00\x01',
+    [1, 'a', None, [2, [3]]], {'a': 1, 'nested': {'b': [True, False]}, 3: 'integer key'},
+])
+def testPlainValuesRoundTrip(value):
+    assert roundTrip(value) == value
+
+def testTuplesAndSetsComeBackAsLists():
+    assert roundTrip((1, 2)) == [1, 2]
+    assert roundTrip({3}) == [3]
+
+def testLargeBytesTravelAsPayloadFrames():
+    data = bytes(range(256)) * (PAYLOAD_THRESHOLD // 256 + 1)
+    frames = exportMessage(MESSAGE_RESPONSE, 200, {"data": data, "small": b'abc'})
+
+    assert len(frames) == 3
+    _, _, decoded = loadMessage(frames)
+    assert bytes(decoded["data"]) == data
+    assert decoded["small"] == b'abc'
+
+def testFileRoundTrip():
+    file = File(name='a.txt', size=10, lastModified=0, merkleRoot='ff', shard=dict(SHARD))
+    assert vars(roundTrip(file)) == vars(file)
+
+@pytest.mark.parametrize("count", [1, 15, 16, 500])
+def testFileMapsRoundTrip(count):
+    files = makeFiles(count)
+    assertSameFiles(roundTrip({"files": files})["files"], files)
+
+def testFileMapsThatAColumnCannotHoldRoundTrip():
+    files = makeFiles(20)
+    files['hash\x00'] = File(name='zero\x00byte', size=1, lastModified=0)
+    files['hash-empty-root'] = File(name='b', size=1, lastModified=0, merkleRoot='')
+
+    assertSameFiles(roundTrip(files), files)
+
+def testRequestHeaderRoundTrip():
+    kind, code, value = loadMessage(exportMessage(0, OPERATION_CODES['PING'], {"message": "Hello"}))
+    assert (kind, code, value) == (0, OPERATION_CODES['PING'], {"message": "Hello"})
+
+def testUnsupportedTypesAreNotEncoded():
+    with pytest.raises(Exception):
+        exportMessage(MESSAGE_RESPONSE, 200, object())
+
+@pytest.mark.parametrize("frames", [
+    [],
+    [b'header only'],
+    [b'XX\x01\x01\x00\x00', b'N'],
+    [b'\x00', b'N'],
+])
+def testInvalidHeadersAreRejected(frames):
+    with pytest.raises(InvalidMessage):
+        loadMessage(frames)
+
+@pytest.mark.parametrize("args", [
+    b'',
+    b'Z',
+    b'i\x00\x00',
+    b's\x00\x00\x10\x00short',
+    b'b\x00\x00\x10\x00short',
+    b'l\xff\xff\xff\xff',
+    b'm\x00\x00\x00\x01sNN',
+    b'p\x00\x00\x00\x00',
+    b's\x00\x00\x00\x02\xff\xfe',
+    b'm\x00\x00\x00\x01l\x00\x00\x00\x00N',
+])
+def testMalformedValuesAreRejected(args):
+    with pytest.raises(InvalidMessage):
+        loadMessage(rawMessage(args))
+
+def testDeepNestingIsRejected():
+    assert roundTrip([[[]]]) == [[[]]]
+
+    nested = b'l\x00\x00\x00\x01' * (MAX_NESTING + 1) + b'N'
+    with pytest.raises(InvalidMessage):
+        loadMessage(rawMessage(nested))
+
+    # Far past the interpreter recursion limit
+    with pytest.raises(InvalidMessage):
+        loadMessage(rawMessage(b'l\x00\x00\x00\x01' * 100000 + b'N'))
+
+def fileArgs(attributes):
+    frames = exportMessage(MESSAGE_RESPONSE, 200, attributes)
+    return b'o' + frames[1]
+
+@pytest.mark.parametrize("changes", [
+    {"size": -1},
+    {"size": True},
+    {"size": "10"},
+    {"name": None},
+    {"merkleRoot": 5},
+    {"shard": "abc"},
+    {"shard": dict(SHARD, fileHash=5)},
+    {"shard": dict(SHARD, index="1")},
+    {"extra": 1},
+])
+def testInvalidFilesAreRejected(changes):
+    attributes = dict(name='a.txt', size=1, lastModified='10:00', merkleRoot=None, shard=None)
+    attributes.update(changes)
+
+    with pytest.raises(InvalidMessage):
+        loadMessage(rawMessage(fileArgs(attributes)))
+
+def fileTable(count, columns, sizes, shards):
+    args = bytearray(b'O' + struct.pack('!I', count))
+    for column in columns:
+        text = '\0'.join(column).encode()
+        args += struct.pack('!I', len(text)) + text
+    args += struct.pack(f'!{len(sizes)}q', *sizes)
+    args += exportMessage(MESSAGE_RESPONSE, 200, shards)[1]
+    return bytes(args)
+
+def testFileTableByHand():
+    columns = [['h1', 'h2'], ['a', 'b'], ['10:00', '11:00'], ['', 'ff']]
+
+    _, _, files = loadMessage(rawMessage(fileTable(2, columns, [1, 2], [None, dict(SHARD)])))
+    assert files['h1'].name == 'a' and files['h1'].merkleRoot is None
+    assert files['h2'].size == 2 and files['h2'].shard == SHARD
+
+@pytest.mark.parametrize("count, columns, sizes, shards", [
+    (3, [['h1', 'h2'], ['a', 'b'], ['', ''], ['', '']], [1, 2], [None, None]),
+    (2, [['h1', 'h2'], ['a', 'b'], ['', ''], ['', '']], [1, -2], [None, None]),
+    (2, [['h1', 'h2'], ['a', 'b'], ['', ''], ['', '']], [1, 2], [None]),
+    (2, [['h1', 'h2'], ['a', 'b'], ['', ''], ['', '']], [1, 2], [None, {"fileHash": 1}]),
+    (2, [['h1', 'h2'], ['a', 'b'], ['', ''], ['', '']], [1], [None, None]),
+])
+def testInvalidFileTablesAreRejected(count, columns, sizes, shards):
+    with pytest.raises(InvalidMessage):
+        loadMessage(rawMessage(fileTable(count, columns, sizes, shards)))
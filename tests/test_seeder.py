@@ -0,0 +1,46 @@
+import pytest
+from seeder import Seeder
+from utils import File, STREAM_CHUNK_SIZE
+
+# A seeder with a file table only, without its sockets and threads
+def makeSeeder(files):
+    seeder = Seeder.__new__(Seeder)
+    seeder.localFiles = files
+
+    # Nothing to sign out from when it is collected
+    seeder.trackerHandlers = []
+    return seeder
+
+@pytest.fixture
+def seeder():
+    return makeSeeder({"abcde": File(name="file.txt", size=1000, lastModified=0)})
+
+def testRangeWithinTheFile(seeder):
+    status, _, file, count = seeder.parseRangeRequest({"fileHash": "abcde", "offset": 10, "count": 100})
+
+    assert status == 200
+    assert file.name == "file.txt"
+    assert count == 100
+
+def testRangeIsClampedToTheFileAndToAStreamChunk(seeder):
+    assert seeder.parseRangeRequest({"fileHash": "abcde", "offset": 900, "count": 500})[3] == 100
+
+    big = makeSeeder({"abcde": File(name="big.bin", size=4 * STREAM_CHUNK_SIZE, lastModified=0)})
+    assert big.parseRangeRequest({"fileHash": "abcde", "offset": 0, "count": 2 * STREAM_CHUNK_SIZE})[3] == STREAM_CHUNK_SIZE
+
+@pytest.mark.parametrize("offset, count", [(-10, 100), (0, -1), (-1, -1)])
+def testNegativeRangeIsRejected(seeder, offset, count):
+    status, _, file, _ = seeder.parseRangeRequest({"fileHash": "abcde", "offset": offset, "count": count})
+
+    assert status == 400
+    assert file is None
+
+@pytest.mark.parametrize("offset, count", [("0", 10), (0, 1.5), (None, 10), (True, 10)])
+def testInvalidRangeTypesAreRejected(seeder, offset, count):
+    assert seeder.parseRangeRequest({"fileHash": "abcde", "offset": offset, "count": count})[0] == 400
+
+def testOffsetPastTheEndIsRejected(seeder):
+    assert seeder.parseRangeRequest({"fileHash": "abcde", "offset": 1001, "count": 1})[0] == 400
+
+def testUnknownFile(seeder):
+    assert seeder.parseRangeRequest({"fileHash": "zzzzz", "offset": 0, "count": 1})[0] == 404
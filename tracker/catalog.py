@@ -0,0 +1,385 @@
+import sys
+import heapq
+import bisect
+import fnmatch
+import threading
+from functools import wraps
+from placement import createPlacement
+from utils import File
+
+def synchronized(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+class Catalog:
+    """
+    Indexed view of every seeder and the files they hold.
+    It is updated incrementally when seeders register, update or sign out, so lookups
+    never scan the seeders:
+        - seeders: address -> Seeder
+        - replicas: fileHash -> set of seeder addresses
+        - files: fileHash -> File (metadata of one of the replicas)
+        - usage: address -> bytes stored on the seeder, plus the bytes reserved for it
+        - reserved: address -> bytes of the transfers queued towards the seeder, so they count in its load before they land
+        - usageHeap: (usage, address) entries used to pick the least loaded seeders.
+          Entries are never updated in place, outdated ones are skipped when popped
+        - shards: fileHash -> {shard index -> set of seeder addresses}, for erasure coded files
+        - layouts: fileHash -> "shard" description of one of its shards (see utils.File)
+        - placement: strategy choosing the seeders of new copies and shards (see placement.py)
+        - weights: address -> capacity weight the seeder advertised, kept when it leaves so a return places the same
+        - listed: fileHash -> name the file is listed under
+        - names: sorted (name, fileHash) entries of the listed files, to page through them in name order (see listPage).
+          New entries wait in pendingNames and are merged in bulk. Entries of files that went away or were renamed
+          are skipped while paging and dropped when the index is rebuilt
+    Shards live in the seeder file tables under the key "fileHash#index", but are indexed apart from whole copies
+    Every public method holds "lock", and so can callers that need several calls to be atomic.
+    Lookups return copies so they can be used after the lock is released
+    """
+    def __init__(self, placement='leastLoaded', vnodes=100):
+        self.lock = threading.RLock()
+
+        self.seeders = {}
+        self.replicas = {}
+        self.files = {}
+        self.usage = {}
+        self.usageHeap = []
+        self.reserved = {}
+
+        self.shards = {}
+        self.layouts = {}
+
+        self.placement = createPlacement(placement, self, vnodes)
+        self.weights = {}
+
+        self.listed = {}
+        self.names = []
+        self.pendingNames = []
+        self.staleNames = 0
+
+    @synchronized
+    def __len__(self):
+        return len(self.seeders)
+
+    @synchronized
+    def __contains__(self, address):
+        return address in self.seeders
+
+    @synchronized
+    def getSeeder(self, address):
+        return self.seeders.get(address)
+
+    @synchronized
+    def listSeeders(self)->list:
+        return list(self.seeders.values())
+
+    @synchronized
+    def addSeeder(self, seeder):
+        self.seeders[seeder.address] = seeder
+        self.usage[seeder.address] = self.reserved.get(seeder.address, 0)
+
+        for fileHash, file in seeder.files.items():
+            self.indexFile(seeder.address, fileHash, file)
+
+        self.pushUsage(seeder.address)
+        self.placement.addSeeder(seeder.address, self.weights.get(seeder.address, 1.0))
+
+    @synchronized
+    def removeSeeder(self, address):
+        seeder = self.seeders.get(address)
+        if not seeder:
+            return None
+
+        for fileHash in seeder.files:
+            self.unindexFile(address, fileHash)
+
+        del self.seeders[address]
+        del self.usage[address]
+        self.placement.removeSeeder(address)
+
+        return seeder
+
+    @synchronized
+    def setWeight(self, address, weight):
+        if self.weights.get(address, 1.0) == weight:
+            return
+
+        self.weights[address] = weight
+        if address in self.seeders:
+            self.placement.addSeeder(address, weight)
+
+    # Replace the whole file table of a seeder
+    @synchronized
+    def setFiles(self, address, files):
+        seeder = self.seeders[address]
+
+        for fileHash in seeder.files:
+            self.unindexFile(address, fileHash)
+
+        seeder.files = files
+        self.usage[address] = self.reserved.get(address, 0)
+
+        for fileHash, file in files.items():
+            self.indexFile(address, fileHash, file)
+
+        self.pushUsage(address)
+
+    @synchronized
+    def addFile(self, address, fileHash, file):
+        seeder = self.seeders[address]
+
+        if fileHash in seeder.files:
+            self.unindexFile(address, fileHash)
+
+        seeder.files[fileHash] = file
+        self.indexFile(address, fileHash, file)
+        self.pushUsage(address)
+
+    @synchronized
+    def removeFile(self, address, fileHash):
+        seeder = self.seeders[address]
+
+        if fileHash not in seeder.files:
+            return
+
+        self.unindexFile(address, fileHash)
+        del seeder.files[fileHash]
+        self.pushUsage(address)
+
+    # Add "amount" bytes (negative to release them) to the reservation of a seeder, registered or not
+    @synchronized
+    def reserve(self, address, amount):
+        self.reserved[address] = self.reserved.get(address, 0) + amount
+        if not self.reserved[address]:
+            del self.reserved[address]
+
+        if address in self.usage:
+            self.usage[address] += amount
+            self.pushUsage(address)
+
+    @synchronized
+    def hasFile(self, fileHash)->bool:
+        return fileHash in self.replicas or fileHash in self.shards
+
+    @synchronized
+    def getFile(self, fileHash):
+        if fileHash in self.files:
+            return self.files[fileHash]
+
+        layout = self.layouts.get(fileHash)
+        return self.layoutFile(layout) if layout else None
+
+    @synchronized
+    def getReplicas(self, fileHash)->set:
+        return set(self.replicas.get(fileHash, ()))
+
+    @synchronized
+    def getShards(self, fileHash)->dict:
+        return {index: set(addresses) for index, addresses in self.shards.get(fileHash, {}).items()}
+
+    @synchronized
+    def getLayout(self, fileHash):
+        return self.layouts.get(fileHash)
+
+    # Every file, whether it has whole copies or only shards
+    @synchronized
+    def listFiles(self)->dict:
+        files = dict(self.files)
+
+        for fileHash, layout in self.layouts.items():
+            if fileHash not in files:
+                files[fileHash] = self.layoutFile(layout)
+
+        return files
+
+    # Page of the listed files in name order (descending with "reverse"): up to "limit" (fileHash, File) coming after
+    # "cursor", among the names starting with "prefix" and matching the "pattern" glob.
+    # Returns (files, cursor) where cursor ([name, fileHash] of the last entry looked at) continues the listing,
+    # None once it is over. At most "scanLimit" entries are looked at, so a pattern matching few names
+    # answers with short pages instead of holding the lock through the whole index
+    @synchronized
+    def listPage(self, cursor=None, limit=1000, prefix='', pattern=None, reverse=False, scanLimit=None):
+        self.mergeNames()
+
+        sources = [self.names, self.pendingNames]
+
+        # Names starting with "prefix" sort from (prefix,) up to the prefix with its last character bumped.
+        # The last code point cannot be bumped: it is dropped and the one before it bumped instead,
+        # and a prefix made only of it has no upper bound
+        stem = prefix.rstrip(chr(sys.maxunicode))
+        prefixEnd = (stem[:-1] + chr(ord(stem[-1]) + 1),) if stem else None
+
+        iterators = []
+        for names in sources:
+            if reverse:
+                start = bisect.bisect_left(names, prefixEnd) if prefixEnd else len(names)
+                if cursor:
+                    start = min(start, bisect.bisect_left(names, tuple(cursor)))
+                iterators.append(map(names.__getitem__, range(start - 1, -1, -1)))
+            else:
+                start = bisect.bisect_left(names, (prefix,))
+                if cursor:
+                    start = max(start, bisect.bisect_right(names, tuple(cursor)))
+                iterators.append(map(names.__getitem__, range(start, len(names))))
+
+        files = []
+        last = None
+        scanned = 0
+
+        for entry in heapq.merge(*iterators, reverse=reverse):
+            name, fileHash = entry
+
+            if not name.startswith(prefix):
+                break
+
+            if len(files) == limit or (scanLimit and scanned == scanLimit):
+                return files, list(last)
+
+            duplicate = entry == last
+            last = entry
+            scanned += 1
+
+            # Entries left behind by renames and removals
+            if duplicate or self.listed.get(fileHash) != name:
+                continue
+
+            if pattern and not fnmatch.fnmatchcase(name, pattern):
+                continue
+
+            files.append((fileHash, self.getFile(fileHash)))
+
+        return files, None
+
+    # The "count" seeders that should hold a new copy of "key", skipping the "exclude" addresses
+    @synchronized
+    def place(self, key, count=1, exclude=())->list:
+        return self.placement.place(key, count, exclude=exclude)
+
+    # The "count" seeders storing the least amount of data, skipping the "exclude" addresses
+    @synchronized
+    def leastLoaded(self, count=1, exclude=())->list:
+        selected = []
+        skipped = []
+
+        while self.usageHeap and len(selected) < count:
+            usage, address = heapq.heappop(self.usageHeap)
+
+            # Outdated entry: the seeder left or its usage changed since it was pushed
+            if self.usage.get(address) != usage or address in selected:
+                continue
+
+            if address in exclude:
+                skipped.append((usage, address))
+                continue
+
+            selected.append(address)
+            skipped.append((usage, address))
+
+        for entry in skipped:
+            heapq.heappush(self.usageHeap, entry)
+
+        return selected
+
+    def indexFile(self, address, fileHash, file):
+        self.usage[address] += file.size
+
+        shard = getattr(file, 'shard', None)
+        if shard:
+            self.shards.setdefault(shard['fileHash'], {}).setdefault(shard['index'], set()).add(address)
+
+            if shard['fileHash'] not in self.layouts:
+                self.layouts[shard['fileHash']] = shard
+                self.indexName(shard['fileHash'])
+            return
+
+        # Only the first copy of a file can change the name it is listed under
+        replicas = self.replicas.get(fileHash)
+        if replicas is None:
+            self.replicas[fileHash] = {address}
+            self.files[fileHash] = file
+            self.indexName(fileHash)
+        else:
+            replicas.add(address)
+
+    def unindexFile(self, address, fileHash):
+        file = self.seeders[address].files[fileHash]
+        self.usage[address] -= file.size
+
+        shard = getattr(file, 'shard', None)
+        if shard:
+            shards = self.shards.get(shard['fileHash'], {})
+
+            holders = shards.get(shard['index'])
+            if holders is not None:
+                holders.discard(address)
+                if not holders:
+                    del shards[shard['index']]
+
+            if not shards:
+                self.shards.pop(shard['fileHash'], None)
+                self.layouts.pop(shard['fileHash'], None)
+                self.indexName(shard['fileHash'])
+            return
+
+        replicas = self.replicas.get(fileHash)
+        if replicas is None:
+            return
+
+        replicas.discard(address)
+        if not replicas:
+            del self.replicas[fileHash]
+            del self.files[fileHash]
+        elif self.files[fileHash] is file:
+            self.files[fileHash] = self.seeders[next(iter(replicas))].files[fileHash]
+
+        self.indexName(fileHash)
+
+    # Keep the name index in step with the name "fileHash" is listed under
+    def indexName(self, fileHash):
+        if fileHash in self.files:
+            name = self.files[fileHash].name
+        elif fileHash in self.layouts:
+            name = self.layouts[fileHash]['fileName']
+        else:
+            name = None
+
+        previous = self.listed.get(fileHash)
+        if name == previous:
+            return
+
+        if previous is not None:
+            self.staleNames += 1
+
+        if name is None:
+            del self.listed[fileHash]
+            return
+
+        self.listed[fileHash] = name
+        self.pendingNames.append((name, fileHash))
+
+    def mergeNames(self):
+        # The pending entries are sorted and paged through next to the index, until they or the entries
+        # left behind are worth a rebuild
+        if len(self.pendingNames) + self.staleNames <= len(self.names) // 8 + 1024:
+            self.pendingNames.sort()
+            return
+
+        # Both lists are sorted runs, which the sort merges in linear time
+        names = sorted(self.names + self.pendingNames)
+        self.names = [entry for i, entry in enumerate(names) if self.listed.get(entry[1]) == entry[0] and (not i or names[i - 1] != entry)]
+        self.pendingNames = []
+        self.staleNames = 0
+
+    def layoutFile(self, layout):
+        return File(name=layout['fileName'], size=layout['fileSize'], lastModified=layout['lastModified'], merkleRoot=layout['merkleRoot'])
+
+    def pushUsage(self, address):
+        heapq.heappush(self.usageHeap, (self.usage[address], address))
+
+        # Outdated entries pile up with every update. Rebuild the heap once they dominate it
+        if len(self.usageHeap) > 4 * len(self.usage) + 64:
+            self.usageHeap = [(usage, address) for address, usage in self.usage.items()]
+            heapq.heapify(self.usageHeap)
@@ -0,0 +1,191 @@
+import os
+import re
+import time
+import zlib
+import struct
+import marshal
+import threading
+from utils import File, atomicWrite
+
+_RECORD = struct.Struct('!II')
+
+class CatalogJournal:
+    """
+    Write-ahead log of the seeders and their file tables, so a restarted tracker serves the catalog
+    it had instead of waiting for every seeder to register again:
+        - <directory>/catalog.snapshot: {"segment", "seeders": address -> [sequence, fileHash -> File attributes]},
+          the whole catalog as it was when segment "segment" was started
+        - <directory>/catalog.<segment>.wal: the changes made since, as records of a length, a CRC32 and the change.
+          A new segment is started with every snapshot, and the older ones are deleted once the snapshot is written
+    Changes are ("seeder", address, sequence, files) for a registration or a resync, ("update", address, sequence,
+    added, removed) for a delta and ("remove", address) for a seeder that left. Both files use marshal, which
+    reads and writes about a million entries per second.
+    Records reach the operating system as they are logged and the disk every "syncInterval" seconds.
+    The last changes of a crashed machine can be lost: the seeders number theirs, so the next delta of a seeder
+    that is behind is refused and answered with a full resync.
+    Callers log changes while holding the catalog lock, so records are in the order the changes were applied
+    """
+    def __init__(self, directory, syncInterval=0.05, snapshotBytes=64 * 1024 * 1024):
+        self.lock = threading.Lock()
+
+        self.directory = directory
+        self.snapshotPath = os.path.join(directory, 'catalog.snapshot')
+        self.syncInterval = syncInterval
+        self.snapshotBytes = snapshotBytes
+
+        # Appends go to the segment after every one already on disk
+        segments = self.listSegments()
+        self.segment = segments[-1] + 1 if segments else 0
+        self.file = open(self.segmentPath(self.segment), 'ab', buffering=0)
+
+        # Bytes logged since the last snapshot, including the segments replayed on restore
+        self.logged = sum(os.path.getsize(self.segmentPath(segment)) for segment in segments)
+        self.dirty = False
+
+    def start(self):
+        threading.Thread(target=self.syncLoop, daemon=True).start()
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, f'catalog.{segment}.wal')
+
+    def listSegments(self)->list:
+        segments = []
+        for filename in os.listdir(self.directory):
+            match = re.search(r'^catalog\.(\d+)\.wal$', filename)
+            if match:
+                segments.append(int(match.group(1)))
+
+        return sorted(segments)
+
+    # address -> (files, sequence) of the seeders as they were last logged
+    def restore(self)->dict:
+        seeders = {}
+        first = 0
+
+        if os.path.exists(self.snapshotPath):
+            # marshal reads a file object a value at a time, a buffer is read several times faster
+            with open(self.snapshotPath, 'rb') as f:
+                snapshot = marshal.loads(f.read())
+
+            first = snapshot['segment']
+            seeders = {address: [sequence, {fileHash: loadFile(attributes) for fileHash, attributes in files.items()}] for address, (sequence, files) in snapshot['seeders'].items()}
+
+        for segment in self.listSegments():
+            if first <= segment < self.segment:
+                for record in self.readSegment(segment):
+                    self.replay(seeders, record)
+
+        return {address: (files, sequence) for address, (sequence, files) in seeders.items()}
+
+    def replay(self, seeders, record):
+        if record[0] == 'seeder':
+            _, address, sequence, files = record
+            seeders[address] = [sequence, {fileHash: loadFile(attributes) for fileHash, attributes in files.items()}]
+        elif record[0] == 'update':
+            _, address, sequence, added, removed = record
+
+            seeder = seeders.get(address)
+            if seeder is None:
+                return
+
+            for fileHash in removed:
+                seeder[1].pop(fileHash, None)
+            for fileHash, attributes in added.items():
+                seeder[1][fileHash] = loadFile(attributes)
+
+            seeder[0] = sequence
+        elif record[0] == 'remove':
+            seeders.pop(record[1], None)
+
+    # Records of a segment, up to the first one that was not completely written
+    def readSegment(self, segment):
+        with open(self.segmentPath(segment), 'rb') as f:
+            data = f.read()
+
+        position = 0
+        while position + _RECORD.size <= len(data):
+            length, checksum = _RECORD.unpack_from(data, position)
+            body = data[position + _RECORD.size:position + _RECORD.size + length]
+
+            if len(body) != length or zlib.crc32(body) != checksum:
+                print(f'Catalog journal: segment {segment} ends with a torn record at {position}', flush=True)
+                return
+
+            yield marshal.loads(body)
+            position += _RECORD.size + length
+
+    def register(self, address, files, sequence):
+        self.append(('seeder', address, sequence, {fileHash: vars(file) for fileHash, file in files.items()}))
+
+    def update(self, address, sequence, added={}, removed=[]):
+        self.append(('update', address, sequence, {fileHash: vars(file) for fileHash, file in added.items()}, list(removed)))
+
+    def remove(self, address):
+        self.append(('remove', address))
+
+    def append(self, record):
+        body = marshal.dumps(record)
+
+        with self.lock:
+            self.file.write(_RECORD.pack(len(body), zlib.crc32(body)) + body)
+            self.logged += _RECORD.size + len(body)
+            self.dirty = True
+
+    # Whether the log grew enough since the last snapshot to be compacted into a new one
+    def due(self)->bool:
+        return self.logged >= self.snapshotBytes
+
+    # Write the whole catalog as a snapshot and drop the segments it covers.
+    # Only the copy of the file tables holds the catalog lock, the encoding and writing happen after
+    def snapshot(self, catalog):
+        with catalog.lock:
+            with self.lock:
+                self.file.close()
+                self.segment += 1
+                self.file = open(self.segmentPath(self.segment), 'ab', buffering=0)
+                self.logged = 0
+                segment = self.segment
+
+            tables = {seeder.address: (seeder.sequence, dict(seeder.files)) for seeder in catalog.listSeeders()}
+
+        start = time.time()
+        snapshot = {"segment": segment, "seeders": {address: [sequence, {fileHash: vars(file) for fileHash, file in files.items()}] for address, (sequence, files) in tables.items()}}
+
+        # The rename reaches the disk before the segments it replaces are deleted
+        atomicWrite(self.snapshotPath, marshal.dumps(snapshot))
+        self.syncDirectory()
+
+        for old in self.listSegments():
+            if old < segment:
+                os.remove(self.segmentPath(old))
+
+        print(f'Catalog snapshot of {sum(len(files) for _, files in tables.values())} files written in {time.time() - start:.2f}s', flush=True)
+
+    # Group commit: every record logged in the last "syncInterval" seconds reaches the disk with one fsync
+    def syncLoop(self):
+        while True:
+            time.sleep(self.syncInterval)
+
+            with self.lock:
+                if not self.dirty:
+                    continue
+
+                self.dirty = False
+                fd = os.dup(self.file.fileno())
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def syncDirectory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def loadFile(attributes)->File:
+    file = File.__new__(File)
+    file.__dict__.update(attributes)
+    return file
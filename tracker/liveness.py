@@ -0,0 +1,48 @@
+import math
+import threading
+
+class TimerWheel:
+    """
+    Hashed timer wheel holding one deadline per key.
+    Time advances in ticks of "tick" seconds and a deadline lives in slot (deadline % slotCount),
+    so scheduling, rescheduling and cancelling are O(1) and each tick only looks at one slot.
+    Deadlines further away than a full turn simply stay in their slot until their tick comes.
+    """
+    def __init__(self, tick, slotCount=64):
+        self.lock = threading.Lock()
+
+        self.tick = tick
+        self.slots = [set() for _ in range(slotCount)]
+
+        # key -> tick number of its deadline
+        self.deadlines = {}
+        self.currentTick = 0
+
+    def schedule(self, key, delay):
+        with self.lock:
+            self.removeLocked(key)
+
+            deadline = self.currentTick + max(math.ceil(delay / self.tick), 1)
+            self.deadlines[key] = deadline
+            self.slots[deadline % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        with self.lock:
+            self.removeLocked(key)
+
+    # Move one tick forward and return the keys whose deadline passed
+    def advance(self)->list:
+        with self.lock:
+            self.currentTick += 1
+            slot = self.slots[self.currentTick % len(self.slots)]
+
+            expired = [key for key in slot if self.deadlines[key] <= self.currentTick]
+            for key in expired:
+                self.removeLocked(key)
+
+            return expired
+
+    def removeLocked(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self.slots[deadline % len(self.slots)].discard(key)
@@ -0,0 +1,150 @@
+import math
+import bisect
+import hashlib
+import heapq
+
+# Placement strategies: which seeders should hold the copies (or shards) of a key.
+# Every strategy is told about the seeders joining and leaving, with their capacity weight, and
+# answers place(key, count, exclude) with "count" distinct seeders, the "exclude" ones left aside.
+# Hashing strategies give every key a stable preference list: when a seeder leaves only the keys it
+# held get a new seeder, and a seeder joining takes only its share of the keys
+
+def hash64(value)->int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+class LeastLoadedPlacement:
+    """
+    The seeders storing the least amount of data (see Catalog.leastLoaded).
+    Keeps seeders balanced by bytes, but the choice depends on the load at the time and not on the key
+    """
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def addSeeder(self, address, weight=1.0):
+        pass
+
+    def removeSeeder(self, address):
+        pass
+
+    def place(self, key, count=1, exclude=())->list:
+        return self.catalog.leastLoaded(count, exclude=exclude)
+
+class HashRingPlacement:
+    """
+    Consistent hash ring. Every seeder is "vnodes" points per unit of weight on a 64 bit ring, and a key
+    goes to the seeders owning the first points clockwise from its hash. Placing a key is a bisection
+    plus a walk over the next points, O(count * log(points)).
+        - points: sorted ring positions, owners: the seeder of every position
+        - pending: (position, seeder) of the seeders added since the ring was last sorted
+        - seeders: address -> weight
+    """
+    def __init__(self, vnodes=100):
+        self.vnodes = vnodes
+
+        self.points = []
+        self.owners = []
+        self.pending = []
+        self.seeders = {}
+
+    def seederPoints(self, address, weight)->list:
+        return [hash64(f'{address}#{i}') for i in range(max(round(self.vnodes * weight), 1))]
+
+    def addSeeder(self, address, weight=1.0):
+        if address in self.seeders:
+            if self.seeders[address] == weight:
+                return
+            self.removeSeeder(address)
+
+        self.seeders[address] = weight
+
+        # Merged into the ring on the next placement, so joining seeders cost one sort however many they are
+        self.pending += [(point, address) for point in self.seederPoints(address, weight)]
+
+    def removeSeeder(self, address):
+        if self.seeders.pop(address, None) is None:
+            return
+
+        self.merge()
+
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != address]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def merge(self):
+        if not self.pending:
+            return
+
+        # The ring is already sorted, so the sort only has to merge in the new points
+        ring = list(zip(self.points, self.owners))
+        ring += sorted(self.pending)
+        ring.sort()
+
+        self.points = [point for point, _ in ring]
+        self.owners = [owner for _, owner in ring]
+        self.pending = []
+
+    def place(self, key, count=1, exclude=())->list:
+        available = len(self.seeders) - sum(1 for address in exclude if address in self.seeders)
+        count = min(count, available)
+
+        selected = []
+        if count <= 0:
+            return selected
+
+        self.merge()
+
+        start = bisect.bisect(self.points, hash64(key))
+
+        for offset in range(len(self.points)):
+            owner = self.owners[(start + offset) % len(self.points)]
+
+            if owner not in selected and owner not in exclude:
+                selected.append(owner)
+                if len(selected) == count:
+                    break
+
+        return selected
+
+class RendezvousPlacement:
+    """
+    Weighted rendezvous (highest random weight) hashing. Every seeder scores every key with
+    weight / -ln(u), u uniform in (0, 1) from the hash of the pair, and a key goes to the best scores.
+    Needs no ring and moves the fewest keys, but scores all the seeders on every placement: O(seeders * log(count))
+        - seeders: address -> (weight, hash of the address)
+    """
+    def __init__(self):
+        self.seeders = {}
+
+    def addSeeder(self, address, weight=1.0):
+        self.seeders[address] = (weight, hash64(address))
+
+    def removeSeeder(self, address):
+        self.seeders.pop(address, None)
+
+    @staticmethod
+    def score(keyHash, seederHash, weight)->float:
+        # splitmix64 finalizer of the combined hashes, much cheaper than hashing every pair
+        mixed = (keyHash ^ seederHash) & 0xFFFFFFFFFFFFFFFF
+        mixed = ((mixed ^ (mixed >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        mixed = ((mixed ^ (mixed >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        mixed ^= mixed >> 31
+
+        return weight / -math.log((mixed + 0.5) / 2**64)
+
+    def place(self, key, count=1, exclude=())->list:
+        keyHash = hash64(key)
+
+        scores = ((self.score(keyHash, seederHash, weight), address) for address, (weight, seederHash) in self.seeders.items() if address not in exclude)
+        return [address for _, address in heapq.nlargest(count, scores)]
+
+PLACEMENTS = {
+    'leastLoaded': lambda catalog, vnodes: LeastLoadedPlacement(catalog),
+    'ring': lambda catalog, vnodes: HashRingPlacement(vnodes),
+    'rendezvous': lambda catalog, vnodes: RendezvousPlacement(),
+}
+
+def createPlacement(strategy, catalog, vnodes=100):
+    if strategy not in PLACEMENTS:
+        raise Exception(f'Unknown placement strategy {strategy}')
+
+    return PLACEMENTS[strategy](catalog, vnodes)
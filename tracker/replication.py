@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import heapq
+import zmq
+import threading
+from utils import OperationRequest, Response, SeederHandler, connectionPool, atomicWrite
+
+# The journal is rewritten with only the queued jobs once it holds more than JOURNAL_COMPACT_MIN records
+# and more than JOURNAL_COMPACT_RATIO times the number of queued jobs
+JOURNAL_COMPACT_MIN = 1024
+JOURNAL_COMPACT_RATIO = 2
+
+JOB_FIELDS = ("id", "operation", "target", "key", "args", "seeders", "bytes", "attempts")
+
+# A running job checks every PROGRESS_INTERVAL seconds whether its seeders are still there and its target progresses
+PROGRESS_INTERVAL = 1
+
+class ReplicationQueue:
+    """
+    Persistent queue of the operations the tracker asks seeders to run on its behalf
+    (REQUEST_GET, REQUEST_SHARD, REQUEST_REMOVE), run by "workers" threads so the routine checks
+    only have to enqueue them.
+        - jobs: id -> {"id", "operation", "target", "key", "args", "seeders", "bytes", "attempts", "notBefore"}
+          "seeders" are all the seeders a job keeps busy (the target and the ones it reads from)
+          and "bytes" what it adds to the target, reserved with reserve(target, bytes) while the job is queued
+        - keys: (operation, target, key) -> job id, and targets: (operation, key) -> targets with a queued job
+        - ready: the jobs that are due, oldest first, and delayed: heap of (notBefore, id) of the jobs waiting for a retry
+        - busy: address -> number of running jobs keeping the seeder busy, at most "seederJobs"
+    Jobs are journaled to "journalPath" as they are added, retried and finished, one JSON record per line, so a
+    restarted tracker resumes them. The records reach the disk every "syncInterval" seconds and the journal is
+    compacted once most of its records are about finished jobs. A damaged record is skipped: the routine checks
+    ask again for whatever a lost job was doing.
+    A job that succeeds calls callbacks[operation](job, response), a failed one is retried
+    "retries" times with a growing delay and then dropped.
+    A job is dropped without running once one of its seeders is no longer online(address), and a running one is
+    given up when they leave or when progress(target), a counter of the bytes the target received, did not move
+    for "timeout" milliseconds. The routine checks ask again, with the seeders that are there.
+    """
+    def __init__(self, context, journalPath, callbacks, reserve=None, online=None, progress=None, workers=4, seederJobs=2, retries=3, backoff=5, timeout=120000, syncInterval=0.05):
+        self.condition = threading.Condition()
+
+        self.pool = connectionPool(context)
+        self.journalPath = journalPath
+        self.callbacks = callbacks
+        self.reserve = reserve or (lambda address, amount: None)
+        self.online = online or (lambda address: True)
+        self.progress = progress or (lambda address: None)
+
+        self.workers = workers
+        self.seederJobs = seederJobs
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.syncInterval = syncInterval
+
+        self.jobs = {}
+        self.keys = {}
+        self.targetsByKey = {}
+        self.ready = {}
+        self.delayed = []
+        self.running = set()
+        self.busy = {}
+        self.nextId = 0
+
+        # Counters
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+        self.journal = None
+        self.restore()
+
+        # Starts over from the restored jobs, which also drops the damaged records
+        with self.condition:
+            self.compactLocked()
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+        threading.Thread(target=self.syncLoop, daemon=True).start()
+
+    def restore(self):
+        try:
+            with open(self.journalPath, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+
+        jobs = {}
+        for number, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+
+                if record[0] == 'add':
+                    jobs[record[1]['id']] = record[1]
+                elif record[0] == 'retry':
+                    jobs[record[1]]['attempts'] = record[2]
+                elif record[0] == 'done':
+                    del jobs[record[1]]
+            except (ValueError, LookupError, TypeError):
+                # e.g. the last line of a crashed tracker, or a file damaged some other way
+                print(f'Replication journal: skipping damaged record {number + 1}', flush=True)
+
+        for job in jobs.values():
+            if type(job) != dict or not all(field in job for field in JOB_FIELDS):
+                print('Replication journal: skipping damaged job', flush=True)
+                continue
+
+            job['notBefore'] = 0
+            self.addLocked(job)
+            self.reserve(job['target'], job['bytes'])
+
+    # Add a job, unless the same operation on the same key is already queued for the target
+    def submit(self, operation, target, key, args, seeders=(), bytes=0)->bool:
+        with self.condition:
+            if (operation, target, key) in self.keys:
+                return False
+
+            job = {"id": self.nextId, "operation": operation, "target": target, "key": key, "args": args,
+                   "seeders": sorted({target, *seeders}), "bytes": bytes, "attempts": 0, "notBefore": 0}
+
+            self.reserve(target, bytes)
+
+            self.addLocked(job)
+            self.logLocked(['add', job])
+            self.condition.notify()
+
+        return True
+
+    # Targets with a queued "operation" on "key", so the routine checks do not ask for it twice
+    def targets(self, operation, key)->set:
+        with self.condition:
+            return set(self.targetsByKey.get((operation, key), ()))
+
+    def stats(self)->dict:
+        with self.condition:
+            return {
+                "queued": len(self.jobs) - len(self.running),
+                "running": len(self.running),
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+            }
+
+    def worker(self):
+        while True:
+            job = self.take()
+
+            try:
+                ok = self.execute(job)
+            except Exception as e:
+                print(f'Replication job {job["id"]} failed: {e}', flush=True)
+                ok = False
+
+            self.finish(job, ok)
+
+    # Wait for the oldest job that is due and whose seeders are not too busy
+    def take(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, jobId = heapq.heappop(self.delayed)
+                    if jobId in self.jobs:
+                        self.ready[jobId] = self.jobs[jobId]
+
+                for job in list(self.ready.values()):
+                    if not all(self.online(address) for address in job['seeders']):
+                        del self.ready[job['id']]
+                        self.dropLocked(job)
+                        self.cancelled += 1
+                        continue
+
+                    if all(self.busy.get(address, 0) < self.seederJobs for address in job['seeders']):
+                        del self.ready[job['id']]
+
+                        self.running.add(job['id'])
+                        for address in job['seeders']:
+                            self.busy[address] = self.busy.get(address, 0) + 1
+                        return job
+
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def execute(self, job)->bool:
+        req = OperationRequest(operation=job['operation'], args=job['args'])
+
+        try:
+            with self.pool.connection(SeederHandler, job['target'], timeout=self.timeout) as seederHandler:
+                seederHandler.send(req.export())
+                self.waitProgress(seederHandler, job)
+                res = Response.load(seederHandler.recv())
+        except zmq.error.Again:
+            print(f'Seeder {job["target"]} timed out on {job["operation"]} {job["key"]}', flush=True)
+            return False
+
+        if res.status != 200:
+            print(f'Seeder {job["target"]} failed {job["operation"]} {job["key"]}: {res.message}', flush=True)
+            return False
+
+        callback = self.callbacks.get(job['operation'])
+        if callback:
+            callback(job, res)
+
+        return True
+
+    # Wait for the answer of the target while it makes progress. Raises zmq.error.Again once it stalled, or an exception once a seeder left
+    def waitProgress(self, seederHandler, job):
+        progress = self.progress(job['target'])
+        lastProgress = time.monotonic()
+
+        while not seederHandler.poll(PROGRESS_INTERVAL * 1000):
+            if not all(self.online(address) for address in job['seeders']):
+                raise Exception('a seeder of the job left')
+
+            current = self.progress(job['target'])
+            if current != progress:
+                progress = current
+                lastProgress = time.monotonic()
+            elif time.monotonic() - lastProgress > self.timeout / 1000:
+                raise zmq.error.Again()
+
+    def finish(self, job, ok):
+        with self.condition:
+            self.running.discard(job['id'])
+            for address in job['seeders']:
+                self.busy[address] -= 1
+                if not self.busy[address]:
+                    del self.busy[address]
+
+            job['attempts'] += 1
+
+            if ok or job['attempts'] > self.retries or not all(self.online(address) for address in job['seeders']):
+                self.dropLocked(job)
+
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            else:
+                job['notBefore'] = time.monotonic() + self.backoff * job['attempts']
+                heapq.heappush(self.delayed, (job['notBefore'], job['id']))
+                self.logLocked(['retry', job['id'], job['attempts']])
+
+            self.condition.notify_all()
+
+    # Remove a job that is not queued nor running any more
+    def dropLocked(self, job):
+        self.removeLocked(job)
+        self.reserve(job['target'], -job['bytes'])
+        self.logLocked(['done', job['id']])
+
+    def addLocked(self, job):
+        self.jobs[job['id']] = job
+        self.keys[(job['operation'], job['target'], job['key'])] = job['id']
+        self.targetsByKey.setdefault((job['operation'], job['key']), set()).add(job['target'])
+        self.ready[job['id']] = job
+        self.nextId = max(self.nextId, job['id'] + 1)
+
+    def removeLocked(self, job):
+        del self.jobs[job['id']]
+        del self.keys[(job['operation'], job['target'], job['key'])]
+
+        targets = self.targetsByKey[(job['operation'], job['key'])]
+        targets.discard(job['target'])
+        if not targets:
+            del self.targetsByKey[(job['operation'], job['key'])]
+
+    def logLocked(self, record):
+        self.journal.write(json.dumps(record) + '\n')
+        self.records += 1
+        self.dirty = True
+
+        if self.records > max(JOURNAL_COMPACT_MIN, JOURNAL_COMPACT_RATIO * len(self.jobs)):
+            self.compactLocked()
+
+    # Rewrite the journal with just the queued jobs. Each compaction follows at least as many
+    # records as there are jobs, so the rewrites cost a constant time per record
+    def compactLocked(self):
+        if self.journal:
+            self.journal.close()
+
+        atomicWrite(self.journalPath, ''.join(json.dumps(['add', job]) + '\n' for job in self.jobs.values()))
+
+        self.journal = open(self.journalPath, 'a', buffering=1)
+        self.records = len(self.jobs)
+        self.dirty = False
+
+    # Group commit: every record logged in the last "syncInterval" seconds reaches the disk with one fsync
+    def syncLoop(self):
+        while True:
+            time.sleep(self.syncInterval)
+
+            with self.condition:
+                if not self.dirty:
+                    continue
+
+                self.dirty = False
+                fd = os.dup(self.journal.fileno())
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
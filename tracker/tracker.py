@@ -1,15 +1,63 @@
 import zmq
-import pickle
 import re
-import heapq
+import os
+import time
+import threading
 from math import *
-from datetime import datetime
-from utils import OperationHandler, Operation, Response, OperationRequest, SeederHandler, SEEDER_OPERATIONS, File
+from catalog import Catalog
+from liveness import TimerWheel
+from replication import ReplicationQueue
+from journal import CatalogJournal
+from utils import ConcurrentOperationHandler, Operation, Response, OperationRequest, ShardMap, TRACKER_OPERATIONS, SEEDER_OPERATIONS, TRACKER_SHARDS, MISDIRECTED_STATUS, File, HEARTBEAT_PORT, HEARTBEAT_TIMEOUT, getIpAddress
+
+TRACKER_WORKERS = int(os.environ.get('TRACKER_WORKERS', 8))
+MAINTENANCE_INTERVAL = 5
+LIVENESS_TICK = 0.5
+# A replication job is given up once its target received nothing for REPLICATION_TIMEOUT milliseconds
+REPLICATION_TIMEOUT = 120000
+
+# Replication jobs run in the background: REPLICATION_WORKERS at a time, at most REPLICATION_SEEDER_JOBS
+# of them involving the same seeder. Every seeder receives copies and shards at REPLICATION_BANDWIDTH bytes
+# per second at most over all its jobs (0 is no cap)
+REPLICATION_WORKERS = int(os.environ.get('REPLICATION_WORKERS', 4))
+REPLICATION_SEEDER_JOBS = int(os.environ.get('REPLICATION_SEEDER_JOBS', 2))
+REPLICATION_BANDWIDTH = int(os.environ.get('REPLICATION_BANDWIDTH', 0))
+
+# "replication" keeps ceil(log(n)) whole copies of every file.
+# "erasure" spreads ERASURE_DATA_SHARDS data and ERASURE_PARITY_SHARDS parity shards of every file over
+# distinct seeders and drops the whole copies once all shards are placed (see erasure.py)
+REDUNDANCY = os.environ.get('REDUNDANCY', 'replication')
+ERASURE_DATA_SHARDS = int(os.environ.get('ERASURE_DATA_SHARDS', 4))
+ERASURE_PARITY_SHARDS = int(os.environ.get('ERASURE_PARITY_SHARDS', 2))
+
+# Strategy choosing the seeders of new copies and shards (see placement.py): "leastLoaded", "ring" or "rendezvous".
+# The ring places every seeder PLACEMENT_VNODES times per unit of the weight it advertises
+PLACEMENT = os.environ.get('PLACEMENT', 'ring')
+PLACEMENT_VNODES = int(os.environ.get('PLACEMENT_VNODES', 100))
+
+# Most files placed by a single UPLOAD_BATCH request
+UPLOAD_BATCH_MAX = int(os.environ.get('UPLOAD_BATCH_MAX', 10000))
+
+# Directory of the catalog journal and of the replication journal
+TRACKER_DIRECTORY = os.environ.get('TRACKER_DIRECTORY', '/disk')
+
+# The catalog is logged to disk and restored on restart (see journal.py). The log reaches the disk every
+# CATALOG_SYNC_INTERVAL seconds and is compacted into a snapshot once it grew by CATALOG_SNAPSHOT_BYTES
+CATALOG_SYNC_INTERVAL = float(os.environ.get('CATALOG_SYNC_INTERVAL', 0.05))
+CATALOG_SNAPSHOT_BYTES = int(os.environ.get('CATALOG_SNAPSHOT_BYTES', 64 * 1024 * 1024))
+
+# Paged LIST answers at most LIST_PAGE_MAX files, looking at no more than LIST_SCAN_MAX names for them
+LIST_PAGE_MAX = int(os.environ.get('LIST_PAGE_MAX', 10000))
+LIST_SCAN_MAX = int(os.environ.get('LIST_SCAN_MAX', 100000))
 
 class Seeder:
-    def __init__(self, address, files):
+    def __init__(self, address, files, sequence=0):
         self.address = self.parseAddress(address)
         self.files = self.parseFiles(files)
+        self.sequence = self.parseSequence(sequence)
+
+        # Load statistics from the last heartbeat
+        self.stats = {}
     
     def parseAddress(self, address)->str:
         if not address:
@@ -21,98 +69,299 @@ class Seeder:
         return address
 
     def parseFiles(self, files)->dict:
-        if not type(files) == dict:
+        if not type(files) == dict or not all(type(file) == File for file in files.values()):
             raise Exception('Invalid files type')
         
         return files
 
+    # Sequence number of the last file table change applied for the seeder. None forces a full resync
+    def parseSequence(self, sequence):
+        if sequence is not None and type(sequence) != int:
+            raise Exception('Invalid sequence type')
+
+        return sequence
+
 class Tracker:
     def __init__(self):
 
         self.context = zmq.Context()
 
-        self.opHandler = OperationHandler(self.context, timeoutProcedure=self.timeoutProcedure)
+        # Requests are served by a pool of workers, and the routine checks run on their own thread
+        self.opHandler = ConcurrentOperationHandler(self.context, workers=TRACKER_WORKERS)
         
-        # That could be a set, ugh?
-        self.seeders = []
+        # Seeders and their files, indexed by address and by file hash
+        self.catalog = Catalog(placement=PLACEMENT, vnodes=PLACEMENT_VNODES)
+
+        # Every seeder registers with every shard, but a shard only keeps the files it owns (see utils.ShardMap)
+        self.shardMap = ShardMap(TRACKER_SHARDS)
+        # A lone tracker owns every file, but one missing from an explicit TRACKER_SHARDS would shadow shard 0
+        if getIpAddress() in self.shardMap.shards:
+            self.shard = self.shardMap.shards.index(getIpAddress())
+        elif 'TRACKER_SHARDS' in os.environ:
+            raise Exception(f'Tracker {getIpAddress()} is not one of TRACKER_SHARDS {",".join(TRACKER_SHARDS)}')
+        else:
+            self.shard = 0
+
+        # Heartbeat deadline of every registered seeder
+        self.liveness = TimerWheel(tick=LIVENESS_TICK)
+
+        self.diskDirectory = TRACKER_DIRECTORY
+        os.makedirs(self.diskDirectory, exist_ok=True)
+
+        # Every change of the catalog is logged, and the catalog of the last run is back before any request is served
+        self.journal = CatalogJournal(self.diskDirectory, syncInterval=CATALOG_SYNC_INTERVAL, snapshotBytes=CATALOG_SNAPSHOT_BYTES)
+        self.restoreCatalog()
+
+        # Replication work asked to the seeders. The catalog is updated as each job completes
+        self.replication = ReplicationQueue(self.context, os.path.join(self.diskDirectory, 'replication.log'),
+                                            callbacks={operation: self.replicationCompleted for operation in (SEEDER_OPERATIONS['REQUEST_GET'], SEEDER_OPERATIONS['REQUEST_SHARD'], SEEDER_OPERATIONS['REQUEST_REMOVE'])},
+                                            reserve=self.catalog.reserve, online=self.catalog.getSeeder, progress=self.replicationProgress,
+                                            workers=REPLICATION_WORKERS, seederJobs=REPLICATION_SEEDER_JOBS, timeout=REPLICATION_TIMEOUT)
 
         self.OPERATIONS = [
             Operation(operation='PING', args=["message"], handler=self.pingHandler),
             Operation(operation='LIST', args=[], handler=self.listHandler),
             Operation(operation='GET', args=["fileHash"], handler=self.getHandler),
             Operation(operation='UPLOAD', args=["fileHash", "fileSize"], handler=self.uploadHandler),
+            Operation(operation='UPLOAD_BATCH', args=["files"], handler=self.uploadBatchHandler),
             Operation(operation='SEEDER_REGISTER', args=["address", "files"], handler=self.seederRegisterHandler),
-            Operation(operation='SEEDER_UPDATE', args=["address", "files"], handler=self.seederUpdateHandler),
-            Operation(operation='SEEDER_SIGNOUT', args=["address"], handler=self.seederSignoutHandlers)
+            Operation(operation='SEEDER_UPDATE', args=["address", "sequence"], handler=self.seederUpdateHandler),
+            Operation(operation='SEEDER_SIGNOUT', args=["address"], handler=self.seederSignoutHandlers),
+            Operation(operation='SHARD_MAP', args=[], handler=self.shardMapHandler)
         ]
 
+    # Seeders of the last run are back with the files and sequence they had. Each one has a heartbeat
+    # timeout to show it is still there, like a seeder that just registered
+    def restoreCatalog(self):
+        start = time.time()
+
+        for address, (files, sequence) in self.journal.restore().items():
+            self.catalog.addSeeder(Seeder(address=address, files=files, sequence=sequence))
+            self.liveness.schedule(address, HEARTBEAT_TIMEOUT)
+
+        if len(self.catalog):
+            print(f'Restored {len(self.catalog)} seeders and {len(self.catalog.listFiles())} files in {time.time() - start:.2f}s', flush=True)
+
     def timeoutProcedure(self):
-        print('Routine Check', flush=True)
-        self.seedersConnectivityCheck()
+        print(f'Routine Check (replication: {self.replication.stats()})', flush=True)
+
+        if self.journal.due():
+            self.journal.snapshot(self.catalog)
+
         self.seedersFileBalancing()
 
-    def run(self)->None:
+    def maintenance(self):
         while True:
-            operation = self.opHandler.getNextOperation(self.OPERATIONS)
-            operation.object.callHandler(operation.args)
+            time.sleep(MAINTENANCE_INTERVAL)
 
-    def seedersConnectivityCheck(self):
-        for seeder in self.seeders:
-            seederHandler = SeederHandler(self.context, seeder.address)
-            seederHandler.setsockopt(zmq.RCVTIMEO, 3000)
+            try:
+                self.timeoutProcedure()
+            except Exception as e:
+                print(f'Routine Check failed: {e}', flush=True)
+
+    def run(self)->None:
+        self.journal.start()
+        self.replication.start()
+
+        threading.Thread(target=self.maintenance, daemon=True).start()
+        threading.Thread(target=self.heartbeatListener, daemon=True).start()
+        threading.Thread(target=self.seedersConnectivityCheck, daemon=True).start()
 
-            req = OperationRequest(operation='PING', args={"message": "Just a ping message"})
-            seederHandler.send(req.export())
+        self.opHandler.serve(self.OPERATIONS)
 
+    # Seeders push heartbeats with their load statistics. Each one pushes the seeder deadline forward
+    def heartbeatListener(self):
+        sock = self.context.socket(zmq.SUB)
+        sock.setsockopt(zmq.SUBSCRIBE, b'')
+        sock.bind(f"tcp://{getIpAddress()}:{HEARTBEAT_PORT}")
+
+        while True:
             try:
-                res = seederHandler.recv()
-                res = Response(**pickle.loads(res))
-            except zmq.error.Again:
-                self.seeders.remove(seeder)
-                print(f'Seeder {seeder.address} is offline', flush=True)
+                heartbeat = OperationRequest.load(sock.recv_multipart(copy=False))
+                if heartbeat.operation != TRACKER_OPERATIONS['HEARTBEAT']:
+                    continue
+
+                address = heartbeat.args.get('address')
+                stats = heartbeat.args.get('stats')
+            except Exception as e:
+                print(f'Invalid heartbeat: {e}', flush=True)
                 continue
 
+            seeder = self.catalog.getSeeder(address) or self.readmitSeeder(address)
+            if not seeder:
+                continue
+
+            seeder.stats = stats if type(stats) == dict else {}
+            self.liveness.schedule(address, HEARTBEAT_TIMEOUT)
+
+            weight = seeder.stats.get('weight', 1.0)
+            if type(weight) in (int, float) and weight > 0:
+                self.catalog.setWeight(address, float(weight))
+
+    # A seeder heard from after it was dropped (e.g. it missed heartbeats during a pause) is placed on again.
+    # Its file table is unknown: the None sequence turns its next SEEDER_UPDATE into a full resync
+    def readmitSeeder(self, address):
+        try:
+            seeder = Seeder(address=address, files={}, sequence=None)
+        except Exception as e:
+            print(f'Invalid heartbeat: {e}', flush=True)
+            return None
+
+        with self.catalog.lock:
+            if self.catalog.getSeeder(address):
+                return self.catalog.getSeeder(address)
+
+            self.catalog.addSeeder(seeder)
+            self.journal.register(address, {}, None)
+
+        print(f'Seeder {address} is back online', flush=True)
+        return seeder
+
+    # Seeders whose heartbeat deadline passed are considered offline
+    def seedersConnectivityCheck(self):
+        while True:
+            time.sleep(LIVENESS_TICK)
+
+            for address in self.liveness.advance():
+                if self.removeSeeder(address):
+                    print(f'Seeder {address} is offline', flush=True)
+
+    def removeSeeder(self, address):
+        with self.catalog.lock:
+            seeder = self.catalog.removeSeeder(address)
+            if seeder:
+                self.journal.remove(address)
+
+        return seeder
+
     def seedersFileBalancing(self):
-        filesStats = {}
-        for seeder in self.seeders:
-            for fileHash in seeder.files:
-                if fileHash not in filesStats:
-                    filesStats[fileHash] = {
-                        "seeders": set(),
-                        "fileName": seeder.files[fileHash].name,
-                        "size": seeder.files[fileHash].size
-                    }
-                filesStats[fileHash]["seeders"].add(seeder)
+        if not len(self.catalog):
+            return
+
+        # Erasure coding needs a distinct seeder for every shard. Smaller deployments keep whole copies
+        erasure = REDUNDANCY == 'erasure' and len(self.catalog) >= ERASURE_DATA_SHARDS + ERASURE_PARITY_SHARDS
 
         # For each file if less than ceil(log(n)) seeders have it, distribute the file to a seeders that don't have it
-        for fileHash, fileInformation in filesStats.items():
-            requiredSeedersAmount = ceil(log(len(self.seeders)))
-            currentSeedersAmount = len(fileInformation["seeders"])
+        requiredSeedersAmount = ceil(log(len(self.catalog)))
+
+        for fileHash, file in self.catalog.listFiles().items():
+            if erasure and file.size > 0:
+                self.shardsBalancing(fileHash, file)
+                continue
+
+            fileSeeders = self.catalog.getReplicas(fileHash)
+
+            # Copies being made count as copies, so they are not asked for again
+            pendingSeeders = self.replication.targets(SEEDER_OPERATIONS['REQUEST_GET'], fileHash)
+            currentSeedersAmount = len(fileSeeders | pendingSeeders)
             
-            if currentSeedersAmount >= requiredSeedersAmount:
+            if currentSeedersAmount >= requiredSeedersAmount or not fileSeeders:
                 continue
 
-            # Find the Seeders that contains less stored data based on the file.size and that doesn't have the file
-            distributionSeeders = heapq.nsmallest(requiredSeedersAmount - currentSeedersAmount, self.seeders, key=lambda seeder: sum([file.size for file in seeder.files.values()]) if fileHash not in seeder.files else float('inf'))
+            # Find the Seeders that should hold the file and that don't have it
+            distributionSeeders = self.catalog.place(fileHash, requiredSeedersAmount - currentSeedersAmount, exclude=fileSeeders | pendingSeeders)
 
-            for seeder in distributionSeeders:
-                seederHandler = SeederHandler(self.context, seeder.address)
-                req = OperationRequest(operation=SEEDER_OPERATIONS['REQUEST_GET'], args={"fileHash": fileHash, "fileName": fileInformation["fileName"], "size": fileInformation["size"], "seeders": [seeder.address for seeder in fileInformation["seeders"]]})
-                seederHandler.send(req.export())
+            for address in distributionSeeders:
+                args = {"fileHash": fileHash, "fileName": file.name, "size": file.size, "seeders": list(fileSeeders), "merkleRoot": getattr(file, 'merkleRoot', None), "rateLimit": REPLICATION_BANDWIDTH or None}
+                self.replication.submit(SEEDER_OPERATIONS['REQUEST_GET'], address, fileHash, args, seeders=fileSeeders, bytes=file.size)
 
-                res = seederHandler.recv()
-                res = Response(**pickle.loads(res))
+    # Place the missing shards of a file, built from its whole copies or from the other shards.
+    # Once every shard is placed the whole copies are removed
+    def shardsBalancing(self, fileHash, file):
+        layout = self.catalog.getLayout(fileHash)
 
-                if res.status != 200:
-                    print(res.message)
-                    continue
+        # Files keep the layout they were encoded with
+        dataShards = layout['dataShards'] if layout else ERASURE_DATA_SHARDS
+        parityShards = layout['parityShards'] if layout else ERASURE_PARITY_SHARDS
+        shardSize = ceil(file.size / dataShards)
+
+        shards = self.catalog.getShards(fileHash)
+        replicas = self.catalog.getReplicas(fileHash)
+
+        # Shards being built are neither missing nor free to receive another shard of the file
+        pending = {index: self.replication.targets(SEEDER_OPERATIONS['REQUEST_SHARD'], f'{fileHash}#{index}') for index in range(dataShards + parityShards)}
+        missing = [index for index in range(dataShards + parityShards) if index not in shards and not pending[index]]
+
+        if not missing:
+            if len(shards) == dataShards + parityShards:
+                for address in replicas:
+                    self.replication.submit(SEEDER_OPERATIONS['REQUEST_REMOVE'], address, fileHash, {"fileHash": fileHash})
+            return
 
-                seeder.files[fileHash] = File(name=fileInformation["fileName"], size=fileInformation["size"], lastModified=datetime.now().timestamp())
+        # Sources: [index, address, key, offset, length]
+        sources = [[index, address, f'{fileHash}#{index}', 0, shardSize] for index, addresses in shards.items() for address in addresses]
+        for address in replicas:
+            sources += [[index, address, fileHash, index * shardSize, max(min(shardSize, file.size - index * shardSize), 0)] for index in range(dataShards)]
+
+        if len({source[0] for source in sources}) < dataShards:
+            print(f'File {fileHash} has only {len(shards)} of {dataShards} shards left', flush=True)
+            return
+
+        holders = set().union(*shards.values(), *pending.values())
+        targets = self.catalog.place(f'{fileHash}#shards', len(missing), exclude=holders)
+
+        for index, address in zip(missing, targets):
+            args = {"fileHash": fileHash, "index": index, "dataShards": dataShards, "parityShards": parityShards, "fileName": file.name, "size": file.size, "merkleRoot": getattr(file, 'merkleRoot', None), "sources": sources, "rateLimit": REPLICATION_BANDWIDTH or None}
+            self.replication.submit(SEEDER_OPERATIONS['REQUEST_SHARD'], address, f'{fileHash}#{index}', args, seeders={source[1] for source in sources}, bytes=shardSize)
+
+    # Completion callback of the replication jobs
+    def replicationCompleted(self, job, res):
+        if job['operation'] == SEEDER_OPERATIONS['REQUEST_REMOVE']:
+            self.applySeederChange(job['target'], res.message["sequence"], job['key'])
+        else:
+            self.applySeederChange(job['target'], res.message["sequence"], job['key'], res.message["file"])
+
+    # Bytes a seeder received for replication jobs, as of its last heartbeat
+    def replicationProgress(self, address):
+        seeder = self.catalog.getSeeder(address)
+        return seeder.stats.get('replicatedBytes') if seeder else None
+
+    # Apply a change a seeder made on request of the tracker: "key" added as "file", or removed when "file" is None
+    def applySeederChange(self, address, sequence, key, file=None):
+        with self.catalog.lock:
+            # The seeder may have left while it was working
+            seeder = self.catalog.getSeeder(address)
+            if not seeder:
+                return
+
+            if file:
+                self.catalog.addFile(address, key, file)
+            else:
+                self.catalog.removeFile(address, key)
+
+            # The change is part of the seeder file table. If it does not directly follow
+            # the last change the tracker knows about, ask for a full resync on the next update
+            seeder.sequence = sequence if seeder.sequence is not None and sequence == seeder.sequence + 1 else None
+
+            self.journal.update(address, seeder.sequence, added={key: file} if file else {}, removed=[] if file else [key])
 
     def pingHandler(self, args):
         res = Response(status=200, message=f'Received message: {args.get("message")}')
         self.opHandler.send(res.export())
 
+    def shardMapHandler(self, args):
+        res = Response(status=200, message=self.shardMap.export())
+        self.opHandler.send(res.export())
+
+    def owns(self, key)->bool:
+        return self.shardMap.shardOf(key) == self.shard
+
+    # The files of "files" this shard owns. Seeders send every shard its own part, this only guards against a stale map
+    def ownedFiles(self, files)->dict:
+        if len(self.shardMap) == 1:
+            return files
+
+        return {key: file for key, file in files.items() if self.owns(key)}
+
+    # Send the shard map back when another shard owns "key", so the client asks the right one. Returns whether it did
+    def misdirected(self, key)->bool:
+        if self.owns(key):
+            return False
+
+        res = Response(status=MISDIRECTED_STATUS, message=self.shardMap.export())
+        self.opHandler.send(res.export())
+        return True
+
     # Receive a message from a seeder to register it to the tracker
     def seederRegisterHandler(self, args):
         try:
@@ -121,37 +370,79 @@ class Tracker:
             res = Response(status=400, message=f'Invalid arguments')
             self.opHandler.send(res.export())
             return
+
+        seeder.files = self.ownedFiles(seeder.files)
         
-        # Check if the seeder is already registered
-        for registeredSeeder in self.seeders:
-            if registeredSeeder.address == seeder.address:
-                res = Response(status=400, message=f'Seeder already registered')
-                self.opHandler.send(res.export())
-                return
+        # A seeder registering again restarted while the tracker kept it (e.g. restored it from the journal).
+        # Its file table and sequence start over from the ones it sends
+        with self.catalog.lock:
+            registeredSeeder = self.catalog.getSeeder(seeder.address)
+
+            if registeredSeeder:
+                self.catalog.setFiles(seeder.address, seeder.files)
+                registeredSeeder.sequence = seeder.sequence
+                res = Response(status=200, message=f'Registered seeder {seeder.address} again')
+            else:
+                self.catalog.addSeeder(seeder)
+                res = Response(status=200, message=f'Registered seeder {seeder.address}:{seeder}')
+
+            self.liveness.schedule(seeder.address, HEARTBEAT_TIMEOUT)
+            self.journal.register(seeder.address, seeder.files, seeder.sequence)
 
-        self.seeders.append(seeder)
-        res = Response(status=200, message=f'Registered seeder {seeder.address}:{seeder}')
         self.opHandler.send(res.export())
 
+    # Seeders send the changes to their file table as deltas ("added", "removed") numbered by "sequence".
+    # A delta that does not follow the last applied one is refused with 409, and the seeder answers it
+    # with a full resync carrying its whole table in "files"
     def seederUpdateHandler(self, args):
+        address = args.get('address')
+        sequence = args.get('sequence')
+        added = args.get('added', {})
+        removed = args.get('removed', [])
+
         try:
-            seeder = Seeder(**args)
+            seeder = Seeder(address=address, files=args.get('files', added), sequence=sequence)
+
+            if type(removed) != list:
+                raise Exception('Invalid removed type')
         except Exception as e:
             res = Response(status=400, message=f'Invalid arguments')
             self.opHandler.send(res.export())
             return
+
+        seeder.files = self.ownedFiles(seeder.files)
         
-        # Check if the seeder is already registered
-        for registeredSeeder in self.seeders:
-            if registeredSeeder.address == seeder.address:
-                registeredSeeder.files = seeder.files
-                res = Response(status=200, message=f'Updated seeder {seeder.address}:{seeder}')
-                self.opHandler.send(res.export())
-                return
+        # The sequence check and the changes are applied atomically, since updates are served concurrently
+        with self.catalog.lock:
+            res = self.applySeederUpdate(seeder, removed, 'files' in args)
 
-        res = Response(status=400, message=f'Seeder not registered')
         self.opHandler.send(res.export())
 
+    def applySeederUpdate(self, seeder, removed, resync)->Response:
+        # Check if the seeder is already registered
+        registeredSeeder = self.catalog.getSeeder(seeder.address)
+        if not registeredSeeder:
+            return Response(status=404, message=f'Seeder not registered')
+
+        if resync:
+            self.catalog.setFiles(seeder.address, seeder.files)
+            registeredSeeder.sequence = seeder.sequence
+            self.journal.register(seeder.address, seeder.files, seeder.sequence)
+            return Response(status=200, message=f'Resynchronized seeder {seeder.address}')
+
+        if registeredSeeder.sequence is None or seeder.sequence != registeredSeeder.sequence + 1:
+            return Response(status=409, message={"sequence": registeredSeeder.sequence})
+
+        for fileHash in removed:
+            self.catalog.removeFile(seeder.address, fileHash)
+
+        for fileHash, file in seeder.files.items():
+            self.catalog.addFile(seeder.address, fileHash, file)
+
+        registeredSeeder.sequence = seeder.sequence
+        self.journal.update(seeder.address, seeder.sequence, added=seeder.files, removed=removed)
+        return Response(status=200, message=f'Updated seeder {seeder.address}')
+
     def seederSignoutHandlers(self, args):
         address = args.get('address')
 
@@ -162,79 +453,182 @@ class Tracker:
             self.opHandler.send(res.export())
             return
         
-        for seeder in self.seeders:
-            if seeder.address == address:
-                self.seeders.remove(seeder)
-                res = Response(status=200, message=f'Seeder {address} signed out')
-                self.opHandler.send(res.export())
-                return
+        if self.removeSeeder(address):
+            self.liveness.cancel(address)
+            res = Response(status=200, message=f'Seeder {address} signed out')
+            self.opHandler.send(res.export())
+            return
         
         res = Response(status=400, message=f'Seeder {address} not registered')
         self.opHandler.send(res.export())
 
+    # Without a "limit" every file is listed at once. With one, files are listed in pages in name order:
+    # {"files": fileHash -> File, "next": cursor asking for the next page, None after the last one}.
+    # "prefix" and "pattern" (a glob) filter the names, "reverse" lists them in descending order
     def listHandler(self, args):
-        files = {}
-        for seeder in self.seeders:
-            for fileHash, file in seeder.files.items():
-                if fileHash not in files:
-                    files[fileHash] = file
-        
-        res = Response(status=200, message=files)
+        limit = args.get('limit')
+
+        if limit is None:
+            files = self.catalog.listFiles()
+
+            res = Response(status=200, message=files)
+            self.opHandler.send(res.export())
+            return
+
+        cursor = args.get('cursor')
+        prefix = args.get('prefix', '')
+        pattern = args.get('pattern')
+        reverse = args.get('reverse', False)
+
+        if type(limit) != int or limit <= 0 or type(prefix) != str or type(reverse) != bool or (pattern is not None and type(pattern) != str):
+            res = Response(status=400, message=f'Invalid limit, prefix, pattern or order')
+            self.opHandler.send(res.export())
+            return
+
+        if cursor is not None and (type(cursor) != list or len(cursor) != 2 or not all(type(key) == str for key in cursor)):
+            res = Response(status=400, message=f'Invalid cursor')
+            self.opHandler.send(res.export())
+            return
+
+        files, cursor = self.catalog.listPage(cursor, min(limit, LIST_PAGE_MAX), prefix, pattern, reverse, scanLimit=LIST_SCAN_MAX)
+
+        res = Response(status=200, message={"files": dict(files), "next": cursor})
         self.opHandler.send(res.export())
 
     def getHandler(self, args):
         fileHash = args.get('fileHash')
+
+        if type(fileHash) == str and self.misdirected(fileHash):
+            return
         
+        file = self.catalog.getFile(fileHash)
+
+        if not file:
+            res = Response(status=404, message=f'File not found')
+            self.opHandler.send(res.export())
+            return
+
         fileInformation = {
             'fileHash': fileHash,
-            'fileName': None,
-            'size': None,
-            'seeders': []
+            'fileName': file.name,
+            'size': file.size,
+            'seeders': list(self.catalog.getReplicas(fileHash)),
+            'merkleRoot': getattr(file, 'merkleRoot', None)
         }
 
-        for seeder in self.seeders:
-            if fileHash in seeder.files:
-                fileInformation['seeders'].append(seeder.address)
-                
-                if not fileInformation['fileName']:
-                    fileInformation['fileName'] = seeder.files[fileHash].name
+        # Files without whole copies are rebuilt by the client from any dataShards of their shards
+        layout = self.catalog.getLayout(fileHash)
+        if not fileInformation['seeders'] and layout:
+            shardSize = ceil(file.size / layout['dataShards'])
 
-                if not fileInformation['size']:
-                    fileInformation['size'] = seeder.files[fileHash].size
-        
-        if len(fileInformation['seeders']) == 0:
-            res = Response(status=404, message=f'File not found')
-            self.opHandler.send(res.export())
-            return
+            fileInformation['dataShards'] = layout['dataShards']
+            fileInformation['parityShards'] = layout['parityShards']
+            fileInformation['sources'] = [[index, address, f'{fileHash}#{index}', 0, shardSize] for index, addresses in self.catalog.getShards(fileHash).items() for address in addresses]
         
         res = Response(status=200, message=fileInformation)
         self.opHandler.send(res.export())
 
+    # Pick the seeder receiving an upload. With "chain" the upload is replicated as it is sent:
+    # the answer also holds the seeders it is forwarded to, one after the other (see seeder/chain.py)
     def uploadHandler(self, args):
         fileHash = args.get('fileHash')
         fileSize = args.get('fileSize')
+        chain = args.get('chain', False)
 
         if type(fileHash) != str or type(fileSize) != int:
             res = Response(status=400, message=f'Invalid file hash or file size')
             self.opHandler.send(res.export())
             return
+
+        if self.misdirected(fileHash):
+            return
         
-        for seeder in self.seeders:
-            if fileHash in seeder.files:
-                res = Response(status=400, message=f'File already exists')
-                self.opHandler.send(res.export())
-                return
-            
-        # Find the Seeder that contains less stored data based on the file.size
-        seeder = min(self.seeders, key=lambda seeder: sum([file.size for file in seeder.files.values()]))
+        if self.catalog.hasFile(fileHash):
+            res = Response(status=400, message=f'File already exists')
+            self.opHandler.send(res.export())
+            return
+
+        replicas = self.placeUpload(fileHash, chain)
+
+        if not replicas:
+            res = Response(status=503, message=f'No seeders available')
+            self.opHandler.send(res.export())
+            return
 
         # Answer back to the client with the seeder address
         res = Response(status=200, message={
-            "address": seeder.address
+            "address": replicas[0],
+            "chain": replicas[1:]
         })
 
         self.opHandler.send(res.export())
 
+    # Placement of many new files in one round trip: "files" is a list of {"fileHash", "fileSize"}.
+    # Answers {"placements": fileHash -> {"address", "chain"}, "rejected": fileHash -> reason}
+    def uploadBatchHandler(self, args):
+        files = args.get('files')
+        chain = args.get('chain', False)
+
+        if type(files) != list or not all(type(file) == dict and type(file.get('fileHash')) == str and type(file.get('fileSize')) == int for file in files):
+            res = Response(status=400, message=f'Invalid files')
+            self.opHandler.send(res.export())
+            return
+
+        if len(files) > UPLOAD_BATCH_MAX:
+            res = Response(status=400, message=f'Too many files, {UPLOAD_BATCH_MAX} at most')
+            self.opHandler.send(res.export())
+            return
+
+        placements = {}
+        rejected = {}
+
+        # The files of the batch count in the load of their seeders while the rest is placed,
+        # so least loaded placement spreads the batch instead of sending all of it to one seeder
+        reserved = []
+
+        try:
+            for file in files:
+                fileHash = file['fileHash']
+
+                if fileHash in placements or fileHash in rejected:
+                    continue
+
+                if not self.owns(fileHash):
+                    rejected[fileHash] = 'Owned by another tracker shard'
+                    continue
+
+                if self.catalog.hasFile(fileHash):
+                    rejected[fileHash] = 'File already exists'
+                    continue
+
+                replicas = self.placeUpload(fileHash, chain)
+
+                if not replicas:
+                    rejected[fileHash] = 'No seeders available'
+                    continue
+
+                for address in replicas:
+                    self.catalog.reserve(address, file['fileSize'])
+                    reserved.append((address, file['fileSize']))
+
+                placements[fileHash] = {"address": replicas[0], "chain": replicas[1:]}
+        finally:
+            for address, size in reserved:
+                self.catalog.reserve(address, -size)
+
+        res = Response(status=200, message={"placements": placements, "rejected": rejected})
+        self.opHandler.send(res.export())
+
+    # Seeders a new file is uploaded to, the first one receiving it from the client. Empty when there are none
+    def placeUpload(self, fileHash, chain)->list:
+        # As many copies as the routine checks keep, none beyond the first in erasure mode where the shards are made from it
+        copies = 1
+        if chain and REDUNDANCY != 'erasure':
+            copies = max(ceil(log(len(self.catalog))), 1) if len(self.catalog) else 1
+
+        # Find the Seeders that should hold the file, in the order the placement strategy prefers them
+        return self.catalog.place(fileHash, copies)
+
 
 
 def main():
@@ -1,33 +1,97 @@
 import zmq
-import pickle
+import struct
 import netifaces
 import hashlib
 from datetime import datetime
 import os
 import math
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 TRACKER_OPERATIONS = {
     'PING': 'PING',
     'LIST': 'LIST',
     'GET': 'GET',
     'UPLOAD': 'UPLOAD',
+    'UPLOAD_BATCH': 'UPLOAD_BATCH',
     'SEEDER_REGISTER': 'SEEDER_REGISTER',
     'SEEDER_UPDATE': 'SEEDER_UPDATE',
     'SEEDER_SIGNOUT': 'SEEDER_SIGNOUT',
+    'HEARTBEAT': 'HEARTBEAT',
+    'SHARD_MAP': 'SHARD_MAP',
 }
 
+# Ranges are streamed from the seeders in frames of STREAM_CHUNK_SIZE bytes over a separate socket,
+# with at most STREAM_WINDOW frames in flight per connection (credit based flow control)
+STREAM_PORT = 5556
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_WINDOW = 8
+STREAM_TIMEOUT = 10000
+
+# Downloads hand out chunks on demand. A chunk that has been in flight for HEDGE_FACTOR times
+# the time its seeder should need for it (and at least HEDGE_MIN_DELAY seconds) is re-issued to an idle seeder
+HEDGE_FACTOR = 3
+HEDGE_MIN_DELAY = 0.5
+# Every seeder keeps enough frames in flight to cover WINDOW_TARGET_DELAY seconds of its measured throughput
+WINDOW_TARGET_DELAY = 0.05
+
+# Uploads are sent as numbered chunks of UPLOAD_CHUNK_SIZE bytes inside an upload session
+UPLOAD_CHUNK_SIZE = STREAM_CHUNK_SIZE
+UPLOAD_TIMEOUT = 10000
+UPLOAD_RETRIES = 3
+# A chained upload is acknowledged once its first seeder committed it. The client then asks for
+# the UPLOAD_STATUS of the chain every UPLOAD_STATUS_INTERVAL seconds until every seeder of it is done
+UPLOAD_STATUS_INTERVAL = 0.2
+
+TRACKER_ADDRESS = os.environ.get('TRACKER_ADDRESS', '11.56.1.21')
+
+# Trackers sharing the catalog, each owning the files of a range of hash prefixes (see ShardMap).
+# Only the trackers read it: seeders and clients ask the tracker at TRACKER_ADDRESS for the map.
+# A request for a file owned by another shard is answered with MISDIRECTED_STATUS and the map
+TRACKER_SHARDS = [address for address in os.environ.get('TRACKER_SHARDS', TRACKER_ADDRESS).split(',') if address]
+SHARD_PREFIX_SIZE = 2
+MISDIRECTED_STATUS = 421
+SHARD_MAP_TIMEOUT = 10000
+
+# Seeders publish a HEARTBEAT to the tracker every HEARTBEAT_INTERVAL seconds.
+# A seeder is considered offline once nothing was heard from it for HEARTBEAT_TIMEOUT seconds
+HEARTBEAT_PORT = 5557
+HEARTBEAT_INTERVAL = 1
+HEARTBEAT_TIMEOUT = 5
+
 SEEDER_OPERATIONS = {
     'PING': 'PING',
     'GET': 'GET',
-    'UPLOAD': 'UPLOAD',
+    'UPLOAD_OPEN': 'UPLOAD_OPEN',
+    'UPLOAD_CHUNK': 'UPLOAD_CHUNK',
+    'UPLOAD_COMMIT': 'UPLOAD_COMMIT',
+    'UPLOAD_STATUS': 'UPLOAD_STATUS',
     'REQUEST_GET': 'REQUEST_GET',
+    'CHUNK_HASHES': 'CHUNK_HASHES',
+    'GET_RECIPE': 'GET_RECIPE',
+    'REQUEST_SHARD': 'REQUEST_SHARD',
+    'REQUEST_REMOVE': 'REQUEST_REMOVE',
 }
 
+# Every file carries a Merkle tree over its chunks of MERKLE_CHUNK_SIZE bytes (SHA-256 leaves).
+# The leaves match the stream chunks, so every chunk can be verified on its own as it arrives.
+# A seeder sending more than MERKLE_MAX_BAD_CHUNKS chunks that do not match is dropped from the download
+MERKLE_CHUNK_SIZE = STREAM_CHUNK_SIZE
+MERKLE_DIGEST_SIZE = 32
+MERKLE_MAX_BAD_CHUNKS = 2
+
 class File:
-    def __init__(self, name, size, lastModified):
+    # "shard" is only set on erasure coded shards (see erasure.py):
+    # {"fileHash", "index", "dataShards", "parityShards", "fileName", "fileSize", "lastModified", "merkleRoot"}
+    def __init__(self, name, size, lastModified, merkleRoot=None, shard=None):
         self.name = name
         self.size = size
         self.lastModified = datetime.fromtimestamp(lastModified).strftime('%H:%M')
+        self.merkleRoot = merkleRoot
+        self.shard = shard
 
     def setName(self, name):
         self.name = name
@@ -38,17 +102,329 @@ class File:
     def setLastModified(self, lastModified):
         self.lastModified = datetime.fromtimestamp(lastModified).strftime('%H:%M')
 
+# Wire protocol. Every message is a multipart ZeroMQ message:
+#   [header, args, *payload]
+# "header" is a fixed HEADER struct (magic, version, kind, operation code or status),
+# "args" is the typed encoding of the request args or the response message, and
+# binary values of at least PAYLOAD_THRESHOLD bytes travel as raw payload frames
+# referenced from "args", so file data is never copied into the args frame.
+# Only plain values and File objects can be decoded, so a peer can never run code on the receiver.
+# Maps of at least FILE_TABLE_MIN Files (LIST answers, seeder tables) are sent column by column instead of
+# File by File, which keeps them as cheap to encode and decode as the pickled messages they replaced.
+PROTOCOL_MAGIC = b'OF'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!2sBBH')
+PAYLOAD_THRESHOLD = 1024
+FILE_TABLE_MIN = 16
+
+# Lists, maps and Files nest at most MAX_NESTING levels deep
+MAX_NESTING = 32
+
+MESSAGE_REQUEST = 0
+MESSAGE_RESPONSE = 1
+
+OPERATION_CODES = {
+    'PING': 1,
+    'LIST': 2,
+    'GET': 3,
+    'UPLOAD': 4,
+    'SEEDER_REGISTER': 5,
+    'SEEDER_UPDATE': 6,
+    'SEEDER_SIGNOUT': 7,
+    'UPLOAD_OPEN': 8,
+    'UPLOAD_CHUNK': 9,
+    'UPLOAD_COMMIT': 10,
+    'REQUEST_GET': 11,
+    'HEARTBEAT': 12,
+    'CHUNK_HASHES': 13,
+    'GET_RECIPE': 14,
+    'REQUEST_SHARD': 15,
+    'REQUEST_REMOVE': 16,
+    'UPLOAD_BATCH': 17,
+    'SHARD_MAP': 18,
+    'UPLOAD_STATUS': 19,
+}
+
+OPERATION_NAMES = {code: operation for operation, code in OPERATION_CODES.items()}
+
+_INT = struct.Struct('!q')
+_FLOAT = struct.Struct('!d')
+_LENGTH = struct.Struct('!I')
+
+_TAG_NONE, _TAG_TRUE, _TAG_FALSE, _TAG_INT, _TAG_FLOAT, _TAG_STR, _TAG_BYTES, _TAG_PAYLOAD, _TAG_LIST, _TAG_MAP, _TAG_FILE, _TAG_FILE_TABLE = b'NTFidsbplmoO'
+
+# Attributes a File is sent with and their types. A File is checked as it is decoded,
+# so a handler never applies half of a message before tripping over a bad value
+_FILE_ATTRIBUTES = {"name": str, "size": int, "lastModified": str, "merkleRoot": (str, type(None)), "shard": (dict, type(None))}
+_SHARD_INTEGERS = ("index", "dataShards", "parityShards", "fileSize")
+
+# Text columns of a File table are joined with a separator no file name or hash contains
+_COLUMN_SEPARATOR = '\0'
+
+class InvalidMessage(Exception):
+    """
+    Message that does not follow the wire protocol. Operation handlers answer it with status 400
+    """
+
+def encodeValue(value, out, payload):
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif type(value) == int:
+        out += b'i'
+        out += _INT.pack(value)
+    elif type(value) == float:
+        out += b'd'
+        out += _FLOAT.pack(value)
+    elif type(value) == str:
+        encoded = value.encode()
+        out += b's'
+        out += _LENGTH.pack(len(encoded))
+        out += encoded
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = memoryview(value).cast('B')
+        if len(value) >= PAYLOAD_THRESHOLD:
+            out += b'p'
+            out += _LENGTH.pack(len(payload))
+            payload.append(value)
+        else:
+            out += b'b'
+            out += _LENGTH.pack(len(value))
+            out += value
+    elif isinstance(value, (list, tuple, set)):
+        out += b'l'
+        out += _LENGTH.pack(len(value))
+        for item in value:
+            encodeValue(item, out, payload)
+    elif isinstance(value, dict) and len(value) >= FILE_TABLE_MIN and encodeFileTable(value, out, payload):
+        pass
+    elif isinstance(value, dict):
+        out += b'm'
+        out += _LENGTH.pack(len(value))
+        for key, item in value.items():
+            encodeValue(key, out, payload)
+            encodeValue(item, out, payload)
+    elif isinstance(value, File):
+        out += b'o'
+        encodeValue(vars(value), out, payload)
+    else:
+        raise Exception(f'Unsupported type {type(value).__name__}')
+
+# Encode a map of fileHash -> File as a File table: the keys, names, lastModified and merkleRoot
+# columns as separated strings, the sizes as packed integers and the shards as a list.
+# Returns False, with nothing written, for maps it cannot hold, which are sent as plain maps
+def encodeFileTable(files, out, payload)->bool:
+    if not all(type(file) == File and vars(file).keys() == _FILE_ATTRIBUTES.keys() for file in files.values()):
+        return False
+
+    keys = list(files)
+    values = list(files.values())
+    roots = [file.merkleRoot for file in values]
+
+    # An empty root would read back as no root
+    if '' in roots:
+        return False
+
+    columns = [keys, [file.name for file in values], [file.lastModified for file in values], [root or '' for root in roots]]
+    texts = []
+    for column in columns:
+        if not all(type(text) == str for text in column):
+            return False
+
+        text = _COLUMN_SEPARATOR.join(column)
+        if text.count(_COLUMN_SEPARATOR) != len(column) - 1:
+            return False
+        texts.append(text.encode())
+
+    try:
+        sizes = struct.pack(f'!{len(values)}q', *(file.size for file in values))
+    except struct.error:
+        return False
+
+    out += b'O'
+    out += _LENGTH.pack(len(values))
+    for text in texts:
+        out += _LENGTH.pack(len(text))
+        out += text
+    out += sizes
+    encodeValue([file.shard for file in values], out, payload)
+
+    return True
+
+# Check that "length" bytes are left in "data" after "pos"
+def checkRemaining(data, pos, length):
+    if length > len(data) - pos:
+        raise InvalidMessage('Truncated message')
+
+def decodeValue(data, pos, payload, depth=0):
+    if depth > MAX_NESTING:
+        raise InvalidMessage('Message nested too deeply')
+
+    tag = data[pos]
+    pos += 1
+
+    if tag == _TAG_STR:
+        (length,) = _LENGTH.unpack_from(data, pos)
+        pos += _LENGTH.size
+        checkRemaining(data, pos, length)
+        return data[pos:pos + length].decode(), pos + length
+    if tag == _TAG_INT:
+        return _INT.unpack_from(data, pos)[0], pos + _INT.size
+    if tag == _TAG_NONE:
+        return None, pos
+    if tag == _TAG_TRUE:
+        return True, pos
+    if tag == _TAG_FALSE:
+        return False, pos
+    if tag == _TAG_FLOAT:
+        return _FLOAT.unpack_from(data, pos)[0], pos + _FLOAT.size
+
+    if tag == _TAG_FILE:
+        attributes, pos = decodeValue(data, pos, payload, depth + 1)
+        checkFileAttributes(attributes)
+
+        file = File.__new__(File)
+        file.__dict__.update(attributes)
+        return file, pos
+
+    (length,) = _LENGTH.unpack_from(data, pos)
+    pos += _LENGTH.size
+
+    # Every item takes at least a byte, so a count bigger than what is left is a truncated message
+    checkRemaining(data, pos, length)
+
+    if tag == _TAG_MAP:
+        items = {}
+        for _ in range(length):
+            key, pos = decodeValue(data, pos, payload, depth + 1)
+            items[key], pos = decodeValue(data, pos, payload, depth + 1)
+        return items, pos
+    if tag == _TAG_LIST:
+        items = []
+        for _ in range(length):
+            item, pos = decodeValue(data, pos, payload, depth + 1)
+            items.append(item)
+        return items, pos
+    if tag == _TAG_BYTES:
+        return data[pos:pos + length], pos + length
+    if tag == _TAG_FILE_TABLE:
+        return decodeFileTable(data, pos, payload, length, depth)
+    if tag == _TAG_PAYLOAD:
+        return payload[length], pos
+
+    raise InvalidMessage(f'Invalid value tag {tag}')
+
+def decodeFileTable(data, pos, payload, count, depth):
+    columns = []
+    for _ in range(4):
+        (length,) = _LENGTH.unpack_from(data, pos)
+        pos += _LENGTH.size
+        checkRemaining(data, pos, length)
+
+        column = data[pos:pos + length].decode().split(_COLUMN_SEPARATOR) if count else []
+        if len(column) != count:
+            raise InvalidMessage('Invalid File table')
+
+        columns.append(column)
+        pos += length
+
+    checkRemaining(data, pos, _INT.size * count)
+    sizes = struct.unpack_from(f'!{count}q', data, pos)
+    pos += _INT.size * count
+
+    shards, pos = decodeValue(data, pos, payload, depth + 1)
+    if type(shards) != list or len(shards) != count or (sizes and min(sizes) < 0):
+        raise InvalidMessage('Invalid File table')
+
+    for shard in shards:
+        if shard is not None:
+            checkShard(shard)
+
+    files = {}
+    for key, name, lastModified, root, size, shard in zip(*columns, sizes, shards):
+        file = File.__new__(File)
+        file.__dict__.update(name=name, size=size, lastModified=lastModified, merkleRoot=root or None, shard=shard)
+        files[key] = file
+
+    return files, pos
+
+def checkShard(shard):
+    if type(shard) != dict or type(shard.get('fileHash')) != str or not all(type(shard.get(key)) == int for key in _SHARD_INTEGERS):
+        raise InvalidMessage('Invalid File shard')
+
+def checkFileAttributes(attributes):
+    if type(attributes) != dict or attributes.keys() != _FILE_ATTRIBUTES.keys():
+        raise InvalidMessage('Invalid File encoding')
+
+    for key, value in attributes.items():
+        # bool is an int subclass, it is not a valid size
+        if key == 'size' and (type(value) != int or value < 0):
+            raise InvalidMessage('Invalid File size')
+        if not isinstance(value, _FILE_ATTRIBUTES[key]):
+            raise InvalidMessage(f'Invalid File {key}')
+
+    if attributes['shard'] is not None:
+        checkShard(attributes['shard'])
+
+def frameBuffer(frame)->memoryview:
+    if isinstance(frame, zmq.Frame):
+        return frame.buffer
+
+    return memoryview(frame)
+
+def exportMessage(kind, code, value)->list:
+    payload = []
+    out = bytearray(HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, kind, code))
+    header = bytes(out)
+
+    out.clear()
+    encodeValue(value, out, payload)
+
+    return [header, bytes(out), *payload]
+
+def loadMessage(frames):
+    if len(frames) < 2:
+        raise InvalidMessage('Invalid message')
+
+    try:
+        magic, version, kind, code = HEADER.unpack(frameBuffer(frames[0]))
+    except struct.error:
+        raise InvalidMessage('Invalid message header')
+
+    if magic != PROTOCOL_MAGIC or version != PROTOCOL_VERSION:
+        raise InvalidMessage('Invalid message header')
+
+    # The args frame only holds metadata, so it is cheaper to decode from a bytes copy.
+    # Payload frames are handed out as memoryviews over the received frames
+    payload = [frameBuffer(frame) for frame in frames[2:]]
+
+    try:
+        value, _ = decodeValue(frameBuffer(frames[1]).tobytes(), 0, payload)
+    except (struct.error, IndexError, TypeError, UnicodeDecodeError):
+        # Truncated values, payload references past the frames or unhashable map keys
+        raise InvalidMessage('Invalid message encoding')
+
+    return kind, code, value
+
 class Response:
 
     def __init__(self, status, message):
         self.status = status
         self.message = message
 
-    def export(self)->bytes:
-        return pickle.dumps({
-            "status": self.status,
-            "message": self.message
-        })
+    def export(self)->list:
+        return exportMessage(MESSAGE_RESPONSE, self.status, self.message)
+
+    @staticmethod
+    def load(frames):
+        kind, status, message = loadMessage(frames)
+        if kind != MESSAGE_RESPONSE:
+            raise Exception('Invalid response message')
+
+        return Response(status=status, message=message)
 
 class OperationRequest:
     def __init__(self, operation, args):
@@ -67,11 +443,16 @@ class OperationRequest:
         
         return args
     
-    def export(self)->bytes:
-        return pickle.dumps({
-            "operation": self.operation,
-            "args": self.args
-        })
+    def export(self)->list:
+        return exportMessage(MESSAGE_REQUEST, OPERATION_CODES[self.operation], self.args)
+
+    @staticmethod
+    def load(frames):
+        kind, code, args = loadMessage(frames)
+        if kind != MESSAGE_REQUEST or code not in OPERATION_NAMES or type(args) != dict:
+            raise InvalidMessage('Invalid operation message')
+
+        return OperationRequest(operation=OPERATION_NAMES[code], args=args)
 
 class OperationRequestHandler:
     def __init__(self, object, args):
@@ -89,16 +470,13 @@ class OperationHandler:
         self.sock.setsockopt(zmq.RCVTIMEO, 5000)
 
     def send(self, payload):
-        return self.sock.send(payload)
+        return self.sock.send_multipart(payload, copy=False)
     
     def recv(self):
-        return self.sock.recv()
+        return self.sock.recv_multipart(copy=False)
 
     def parseOperation(self, operationMessage, availableOperations)->OperationRequestHandler:
-        operationDict = pickle.loads(operationMessage)
-        
-        # That command is so cool. Used to validate a Operation Message
-        operationRequest = OperationRequest(**operationDict)
+        operationRequest = OperationRequest.load(operationMessage)
 
         for availableOperation in availableOperations:
             if availableOperation.operation == operationRequest.operation:
@@ -122,13 +500,137 @@ class OperationHandler:
                 if self.timeoutProcedure:
                     self.timeoutProcedure()
                 continue
+            except InvalidMessage as e:
+                res = Response(status=400, message=str(e))
+                self.send(res.export())
+                continue
             except Exception as e:
-                res = Response(status=500, message=e.args[0])
+                res = Response(status=500, message=str(e))
                 self.send(res.export())
+                continue
 
             print(f"{operationReqHandler.object.operation}: {operationReqHandler.args}", flush=True)
 
             return operationReqHandler
+
+class DeferredOperationHandler(OperationHandler):
+    """
+    OperationHandler whose handlers can answer after they returned, from another thread.
+    Requests arrive on a ROUTER socket and "send" answers the request being handled, like on a REP socket.
+    A handler that calls "defer" gets a function answering its request later instead, so a long operation runs
+    on its own thread while the next requests are served. Its answer goes through an inproc socket to the thread
+    serving requests, which sends it on: a ZeroMQ socket is only ever used by one thread.
+        - envelope: routing frames of the request being handled, None once it was answered or deferred
+    """
+    def __init__(self, context, timeoutProcedure=None):
+        self.context = context
+        self.timeoutProcedure = timeoutProcedure
+
+        self.sock = self.context.socket(zmq.ROUTER)
+        self.sock.bind(f"tcp://{getIpAddress()}:5555")
+
+        self.answersAddress = f"inproc://answers-{id(self)}"
+        self.answers = self.context.socket(zmq.PULL)
+        self.answers.bind(self.answersAddress)
+
+        # Shared by the threads answering deferred requests
+        self.deferred = self.context.socket(zmq.PUSH)
+        self.deferred.connect(self.answersAddress)
+        self.deferredLock = threading.Lock()
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.sock, zmq.POLLIN)
+        self.poller.register(self.answers, zmq.POLLIN)
+
+        self.envelope = None
+
+    def send(self, payload):
+        if self.envelope is None:
+            raise zmq.error.ZMQError(zmq.EFSM)
+
+        envelope, self.envelope = self.envelope, None
+        return self.sock.send_multipart([*envelope, *payload], copy=False)
+
+    # Next request, sending on the deferred answers in the meantime. Raises zmq.error.Again after 5 seconds without any
+    def recv(self):
+        while True:
+            events = dict(self.poller.poll(5000))
+            if not events:
+                raise zmq.error.Again()
+
+            if self.answers in events:
+                self.sock.send_multipart(self.answers.recv_multipart(copy=False), copy=False)
+
+            if self.sock in events:
+                frames = self.sock.recv_multipart(copy=False)
+
+                # Routing frames, up to the empty delimiter a REQ socket puts before its message
+                delimiter = next((index for index, frame in enumerate(frames) if not len(frame)), None)
+                if delimiter is None:
+                    continue
+
+                self.envelope = frames[:delimiter + 1]
+                return frames[delimiter + 1:]
+
+    # Leave the request being handled unanswered. Returns a function sending its answer, callable from any thread
+    def defer(self):
+        envelope, self.envelope = self.envelope, None
+
+        def answer(payload):
+            with self.deferredLock:
+                self.deferred.send_multipart([*envelope, *payload], copy=False)
+
+        return answer
+
+class ConcurrentOperationHandler(OperationHandler):
+    """
+    OperationHandler that serves requests from several worker threads.
+    A ROUTER socket accepts the requests and a proxy spreads them over the workers through an
+    inproc DEALER socket. Each worker answers on its own REP socket: "send" and "recv" use the
+    socket of the calling thread, so operation handlers do not change.
+    """
+    def __init__(self, context, workers):
+        self.context = context
+        self.timeoutProcedure = None
+        self.workers = workers
+
+        self.local = threading.local()
+        self.backendAddress = f"inproc://operations-{id(self)}"
+
+        self.frontend = self.context.socket(zmq.ROUTER)
+        self.frontend.bind(f"tcp://{getIpAddress()}:5555")
+
+        self.backend = self.context.socket(zmq.DEALER)
+        self.backend.bind(self.backendAddress)
+
+    @property
+    def sock(self):
+        return self.local.sock
+
+    def worker(self, operations):
+        self.local.sock = self.context.socket(zmq.REP)
+        self.local.sock.connect(self.backendAddress)
+
+        while True:
+            operation = self.getNextOperation(operations)
+
+            try:
+                operation.object.callHandler(operation.args)
+            except Exception as e:
+                print(f"{operation.object.operation} failed: {e}", flush=True)
+
+                # The handler may have failed before answering. Answer it, or the REP socket stays stuck
+                try:
+                    self.send(Response(status=500, message=str(e)).export())
+                except zmq.error.ZMQError:
+                    pass
+
+    # Start the workers and forward requests to them. Never returns
+    def serve(self, operations):
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, args=(operations,), daemon=True).start()
+
+        zmq.proxy(self.frontend, self.backend)
         
 class Operation:
 
@@ -141,21 +643,79 @@ class Operation:
         return self.handler(args) 
     
 class TrackerHandler:
-    def __init__(self, context):
+    def __init__(self, context, address=None):
         self.context = context
 
         self.sock = self.context.socket(zmq.REQ)
-        self.sock.connect(f"tcp://11.56.1.21:5555")
+        self.sock.connect(f"tcp://{address or TRACKER_ADDRESS}:5555")
 
     def setsockopt(self, opt, value):
         return self.sock.setsockopt(opt, value)
 
     def send(self, payload):
-        return self.sock.send(payload)
+        return self.sock.send_multipart(payload, copy=False)
     
     def recv(self):
-        return self.sock.recv()
+        return self.sock.recv_multipart(copy=False)
+
+    def close(self, linger=None):
+        return self.sock.close(linger)
     
+class ShardMap:
+    """
+    Partition of the files over the tracker shards. The first SHARD_PREFIX_SIZE hex digits of a file hash
+    pick its shard, shard i owning the i-th of len(shards) equal ranges of prefixes.
+    Shards of erasure coded files ("fileHash#index") go with their file.
+        - shards: tracker addresses, in shard order
+    """
+    def __init__(self, shards):
+        self.shards = list(shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def shardOf(self, key)->int:
+        try:
+            prefix = int(key[:SHARD_PREFIX_SIZE], 16)
+        except ValueError:
+            # Not a file hash: no shard has it, the first one answers
+            return 0
+
+        return prefix * len(self.shards) // 16 ** SHARD_PREFIX_SIZE
+
+    def owner(self, key)->str:
+        return self.shards[self.shardOf(key)]
+
+    # shard index -> {key: value} of the entries of "items" it owns
+    def split(self, items)->dict:
+        parts = {}
+        for key, value in items.items():
+            parts.setdefault(self.shardOf(key), {})[key] = value
+
+        return parts
+
+    def export(self)->dict:
+        return {"shards": self.shards}
+
+    @staticmethod
+    def load(message):
+        return ShardMap(message['shards'])
+
+# Ask the tracker at "address" for the shard map. Trackers answering anything else are not sharded
+def getShardMap(context, address=None, timeout=SHARD_MAP_TIMEOUT)->ShardMap:
+    address = address or TRACKER_ADDRESS
+    trackerHandler = TrackerHandler(context, address)
+    trackerHandler.setsockopt(zmq.RCVTIMEO, timeout)
+
+    try:
+        req = OperationRequest(operation=TRACKER_OPERATIONS['SHARD_MAP'], args={})
+        trackerHandler.send(req.export())
+
+        res = Response.load(trackerHandler.recv())
+        return ShardMap.load(res.message) if res.status == 200 else ShardMap([address])
+    finally:
+        trackerHandler.close(0)
+
 class SeederHandler:
     def __init__(self, context, address):
         self.context = context
@@ -166,11 +726,192 @@ class SeederHandler:
     def setsockopt(self, opt, value):
         return self.sock.setsockopt(opt, value)
 
+    def poll(self, timeout):
+        return self.sock.poll(timeout, zmq.POLLIN)
+
     def send(self, payload):
-        return self.sock.send(payload)
+        return self.sock.send_multipart(payload, copy=False)
     
     def recv(self):
-        return self.sock.recv()
+        return self.sock.recv_multipart(copy=False)
+
+    def close(self, linger=None):
+        return self.sock.close(linger)
+
+class SeederStreamHandler:
+    def __init__(self, context, address):
+        self.context = context
+
+        self.sock = self.context.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.RCVTIMEO, STREAM_TIMEOUT)
+        self.sock.connect(f"tcp://{address}:{STREAM_PORT}")
+
+    def setsockopt(self, opt, value):
+        return self.sock.setsockopt(opt, value)
+
+    def send(self, payload):
+        return self.sock.send_multipart(payload, copy=False)
+
+    def recv(self):
+        return self.sock.recv_multipart(copy=False)
+
+    def close(self, linger=None):
+        return self.sock.close(linger)
+
+    def poll(self, timeout):
+        return self.sock.poll(timeout, zmq.POLLIN)
+
+    def requestRange(self, fileHash, offset, count):
+        req = OperationRequest(operation=SEEDER_OPERATIONS['GET'], args={"fileHash": fileHash, "offset": offset, "count": count})
+        return self.send(req.export())
+
+    # Generator of (offset, data) frames covering [offset, offset + count).
+    # Only STREAM_WINDOW frames are requested ahead of the ones already received,
+    # so memory on both ends stays bounded regardless of the range size
+    def streamRange(self, fileHash, offset, count, chunkSize=STREAM_CHUNK_SIZE, window=STREAM_WINDOW):
+        end = offset + count
+        nextOffset = offset
+        inFlight = 0
+
+        while nextOffset < end or inFlight > 0:
+            while inFlight < window and nextOffset < end:
+                frameCount = min(chunkSize, end - nextOffset)
+                self.requestRange(fileHash, nextOffset, frameCount)
+                nextOffset += frameCount
+                inFlight += 1
+
+            res = Response.load(self.recv())
+            inFlight -= 1
+
+            if res.status != 200:
+                raise Exception(res.message)
+
+            yield res.message["offset"], res.message["data"]
+
+class ConnectionPool:
+    """
+    Bounded pool of connections shared by every thread of a process.
+    Connections are kept per (handler class, address) and reused instead of paying a new
+    TCP and ZMTP handshake for every request. A connection that failed (e.g. a REQ socket
+    left waiting for a reply after a timeout) is closed instead of being returned, idle
+    connections are closed after "idleTimeout" seconds, and at most "maxIdlePerAddress"
+    and "maxIdle" idle connections are kept at any time.
+    """
+    def __init__(self, context, maxIdlePerAddress=4, maxIdle=256, idleTimeout=60):
+        self.context = context
+        self.maxIdlePerAddress = maxIdlePerAddress
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+
+        self.lock = threading.Lock()
+
+        # (handler class, address) -> [(handler, releaseTime)], most recently released last
+        self.idle = {}
+        self.idleCount = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resets = 0
+
+    def acquire(self, handlerClass, address, timeout=-1):
+        key = (handlerClass, address)
+        handler = None
+
+        with self.lock:
+            self.evictIdleLocked()
+
+            if self.idle.get(key):
+                handler, _ = self.idle[key].pop()
+                self.idleCount -= 1
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if not handler:
+            handler = handlerClass(self.context, address)
+            handler.key = key
+
+        handler.setsockopt(zmq.RCVTIMEO, timeout)
+        return handler
+
+    # Give a connection back. Connections that are not "healthy" are closed right away
+    def release(self, handler, healthy=True):
+        if not healthy:
+            handler.close(linger=0)
+            with self.lock:
+                self.resets += 1
+            return
+
+        closing = []
+        with self.lock:
+            idle = self.idle.setdefault(handler.key, [])
+            idle.append((handler, time.monotonic()))
+            self.idleCount += 1
+
+            if len(idle) > self.maxIdlePerAddress:
+                closing.append(idle.pop(0)[0])
+                self.idleCount -= 1
+
+            if self.idleCount > self.maxIdle:
+                closing.append(self.popOldestLocked())
+
+            self.evictions += len(closing)
+
+        for connection in closing:
+            connection.close(linger=0)
+
+    # Connection for the duration of a "with" block. Any exception raised inside it resets the connection
+    @contextmanager
+    def connection(self, handlerClass, address, timeout=-1):
+        handler = self.acquire(handlerClass, address, timeout)
+
+        try:
+            yield handler
+        except BaseException:
+            self.release(handler, healthy=False)
+            raise
+
+        self.release(handler)
+
+    def stats(self)->dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resets": self.resets,
+                "idle": self.idleCount,
+            }
+
+    def evictIdleLocked(self):
+        expiration = time.monotonic() - self.idleTimeout
+
+        for key, idle in list(self.idle.items()):
+            while idle and idle[0][1] < expiration:
+                idle.pop(0)[0].close(linger=0)
+                self.idleCount -= 1
+                self.evictions += 1
+
+            if not idle:
+                del self.idle[key]
+
+    def popOldestLocked(self):
+        key = min((key for key in self.idle if self.idle[key]), key=lambda key: self.idle[key][0][1])
+        handler, _ = self.idle[key].pop(0)
+        self.idleCount -= 1
+        return handler
+
+_connectionPools = {}
+_connectionPoolsLock = threading.Lock()
+
+# The ConnectionPool shared by everything using "context"
+def connectionPool(context)->ConnectionPool:
+    with _connectionPoolsLock:
+        if context not in _connectionPools:
+            _connectionPools[context] = ConnectionPool(context)
+
+        return _connectionPools[context]
 
 def getIpAddress():
     """
@@ -190,11 +931,78 @@ def hash(fpath):
     hasher = hashlib.md5()
 
     with open(fpath, 'rb') as f:
-        hasher.update(f.read())
+        for block in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            hasher.update(block)
 
     file_hash = hasher.hexdigest()
     return file_hash
 
+def chunkDigest(data)->bytes:
+    return hashlib.sha256(data).digest()
+
+# Root of the Merkle tree over "leaves" (concatenated chunk digests), as hex.
+# Odd nodes are paired with themselves. An empty file has the digest of no data as root
+def merkleRoot(leaves)->str:
+    level = [bytes(leaves[i:i + MERKLE_DIGEST_SIZE]) for i in range(0, len(leaves), MERKLE_DIGEST_SIZE)]
+    if not level:
+        return chunkDigest(b'').hex()
+
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [chunkDigest(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+
+    return level[0].hex()
+
+# Whole file MD5 and Merkle leaves of "fpath" in a single pass. Returns (hash, leaves)
+def hashChunks(fpath):
+    hasher = hashlib.md5()
+    leaves = bytearray()
+
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(MERKLE_CHUNK_SIZE), b''):
+            hasher.update(block)
+            leaves += chunkDigest(block)
+
+    return hasher.hexdigest(), bytes(leaves)
+
+# Ask the seeders of a file for its chunk digests until one sends leaves that match "root"
+def getChunkHashes(context, fileHash, root, seeders):
+    pool = connectionPool(context)
+    req = OperationRequest(operation=SEEDER_OPERATIONS['CHUNK_HASHES'], args={"fileHash": fileHash})
+
+    for seeder in seeders:
+        try:
+            with pool.connection(SeederHandler, seeder, timeout=STREAM_TIMEOUT) as seederHandler:
+                seederHandler.send(req.export())
+                res = Response.load(seederHandler.recv())
+        except zmq.error.Again:
+            print(f'Seeder {seeder}: timed out', flush=True)
+            continue
+
+        if res.status != 200:
+            continue
+
+        leaves = bytes(res.message['leaves'])
+        if merkleRoot(leaves) == root:
+            return leaves
+
+        print(f'Seeder {seeder}: chunk hashes do not match the file', flush=True)
+
+    return None
+
+# Replace the file at "path" with "data" (str or bytes). It is written to a temporary file, flushed to the disk
+# and renamed over "path", so a crash leaves either the old or the new content behind, never a half written file
+def atomicWrite(path, data):
+    temporaryPath = f'{path}.{threading.get_ident()}.tmp'
+
+    with open(temporaryPath, 'w' if isinstance(data, str) else 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporaryPath, path)
+
 def getOutputFilepath(proposedFilename, outputDirectory):
     if not os.path.exists(os.path.join(outputDirectory, proposedFilename)):
         return os.path.join(outputDirectory, proposedFilename)
@@ -208,53 +1016,388 @@ def getOutputFilepath(proposedFilename, outputDirectory):
             return os.path.join(outputDirectory, outputFilename + extension)
         i += 1
 
-# fileInformation = {'fileHash', 'fileName', 'size', 'seeders'}
-def getFileDistributedly(context, fileInformation, outputDirectory='./'):
-    
-    # Download the file distributedly between all the seeders that contain it
-    chunkSize = 4096
+# Upload "filePath" to a seeder through an upload session: open, send the numbered chunks, then commit.
+# A timed out connection is reopened and the upload resumes from the last chunk the seeder acknowledged.
+# The seeder forwards the upload down the seeders of "chain" as it receives it (see seeder/chain.py).
+# Returns the seeders holding the file durably once the whole chain is done
+def uploadFile(context, address, filePath, fileHash, file, chain=None, retries=UPLOAD_RETRIES)->list:
+    pool = connectionPool(context)
+    chain = chain or []
 
-    chunkCountTotal = fileInformation['size'] / chunkSize
+    for attempt in range(retries + 1):
+        try:
+            with pool.connection(SeederHandler, address, timeout=UPLOAD_TIMEOUT) as seederHandler:
+                req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD_OPEN'], args={"fileHash": fileHash, "file": file, "chain": chain})
+                seederHandler.send(req.export())
 
-    chunkCountPerSeeder = int(chunkCountTotal // len(fileInformation['seeders']))
+                res = Response.load(seederHandler.recv())
+                if res.status != 200:
+                    raise Exception(res.message)
 
-    seederRequestInformation = [{
-        "seeder": seeder,
-        "offset": None,
-        "count": chunkCountPerSeeder * chunkSize
-    } for seeder in fileInformation['seeders']]
+                # The seeder already has the file, maybe committed by a previous attempt whose answer was lost
+                if res.message['nextChunk'] is None:
+                    return waitUploadStatus(seederHandler, fileHash)
 
+                index = res.message['nextChunk']
+                chunkSize = res.message['chunkSize']
 
-    for i in range(math.ceil(chunkCountTotal % len(fileInformation['seeders']))):
-        seederRequestInformation[len(fileInformation['seeders']) - i - 1]['count'] += chunkSize
+                with open(filePath, 'rb') as f:
+                    f.seek(index * chunkSize)
 
-    # Update the offset
-    offset = 0
-    for seeder in seederRequestInformation:
-        seeder['offset'] = offset
-        offset += seeder['count']
+                    while index * chunkSize < file.size:
+                        req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD_CHUNK'], args={"fileHash": fileHash, "index": index, "data": f.read(chunkSize)})
+                        seederHandler.send(req.export())
 
-    proposedFilename = fileInformation['fileName']
-    outputFilepath = getOutputFilepath(proposedFilename, outputDirectory)
+                        res = Response.load(seederHandler.recv())
 
-    # Send the requests to the seeders
-    for seeder in seederRequestInformation:
-        seederHandler = SeederHandler(context, seeder['seeder'])
-        req = OperationRequest(operation=SEEDER_OPERATIONS['GET'], args={"fileHash": fileInformation['fileHash'], "offset": seeder['offset'], "count": seeder['count']})
-        seederHandler.send(req.export())
+                        # The seeder is behind (e.g. it restarted), continue from where it is
+                        if res.status == 409:
+                            index = res.message['nextChunk']
+                            f.seek(index * chunkSize)
+                            continue
+
+                        if res.status != 200:
+                            raise Exception(res.message)
+
+                        index += 1
+
+                req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD_COMMIT'], args={"fileHash": fileHash})
+                seederHandler.send(req.export())
+
+                res = Response.load(seederHandler.recv())
+                if res.status != 200:
+                    raise Exception(res.message)
 
-        res = seederHandler.recv()
-        res = Response(**pickle.loads(res))
+                if res.message['done']:
+                    return res.message['replicas']
 
+                return waitUploadStatus(seederHandler, fileHash)
+        except zmq.error.Again:
+            if attempt == retries:
+                raise Exception(f'Seeder {address}: timed out')
+
+# Ask a seeder for the UPLOAD_STATUS of a committed file until its chain is done.
+# Returns the seeders holding the file durably: the seeder and the part of its chain that committed it
+def waitUploadStatus(seederHandler, fileHash)->list:
+    req = OperationRequest(operation=SEEDER_OPERATIONS['UPLOAD_STATUS'], args={"fileHash": fileHash})
+
+    while True:
+        seederHandler.send(req.export())
+
+        res = Response.load(seederHandler.recv())
         if res.status != 200:
-            print(res.message)
+            raise Exception(res.message)
+
+        if res.message['done']:
+            return res.message['replicas']
+
+        time.sleep(UPLOAD_STATUS_INTERVAL)
+
+class TokenBucket:
+    """
+    Rate limiter: "rate" bytes per second on average (no limit when None), with bursts of up to "burst" bytes.
+    Consuming more than is available blocks until the bucket refilled, and can be shared by threads.
+    "consumed" counts every byte that went through it, e.g. to report the progress of transfers
+    """
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.lastRefill = time.monotonic()
+        self.consumed = 0
+
+    def consume(self, amount):
+        with self.lock:
+            self.consumed += amount
+            if not self.rate:
+                return
+
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+            self.lastRefill = now
+
+            # Go into debt and wait for it to be paid back, so amounts bigger than the burst still pass
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+class ChunkScheduler:
+    """
+    Work-stealing scheduler for multi-source downloads.
+    Chunks are handed out one at a time to whichever seeder asks for work, so faster seeders
+    naturally take more of them. Per seeder throughput is measured as replies arrive and sizes
+    the number of frames each seeder keeps in flight. Once nothing is left to hand out, chunks
+    that are late on a slow seeder are re-issued to idle ones (hedged requests) and the first copy wins.
+    When the Merkle "leaves" of the file are known, every chunk is checked against its leaf and
+    chunks that do not match are handed out again.
+    """
+    def __init__(self, size, chunkSize, seeders, leaves=None):
+        self.size = size
+        self.chunkSize = chunkSize
+        self.chunkCount = math.ceil(size / chunkSize)
+        self.leaves = leaves
+
+        self.condition = threading.Condition()
+
+        self.pending = deque(range(self.chunkCount))
+        self.done = set()
+
+        # index -> {seeder: requestTime}
+        self.inFlight = {}
+
+        # seeder -> bytes per second (exponentially weighted)
+        self.throughput = {seeder: None for seeder in seeders}
+
+        # seeder -> number of chunks it sent that did not match their leaf
+        self.badChunks = {seeder: 0 for seeder in seeders}
+
+    def chunkRange(self, index):
+        offset = index * self.chunkSize
+        return offset, min(self.chunkSize, self.size - offset)
+
+    def finished(self):
+        with self.condition:
+            return len(self.done) == self.chunkCount
+
+    def isDone(self, index):
+        with self.condition:
+            return index in self.done
+
+    # Mark chunks that are already in place (e.g. the intact part of a file being repaired)
+    def markDone(self, indexes):
+        with self.condition:
+            self.done.update(indexes)
+            self.condition.notify_all()
+
+    def verify(self, index, data)->bool:
+        if self.leaves is None:
+            return True
+
+        leaf = self.leaves[index * MERKLE_DIGEST_SIZE:(index + 1) * MERKLE_DIGEST_SIZE]
+        return chunkDigest(data) == leaf
+
+    def window(self, seeder):
+        with self.condition:
+            throughput = self.throughput.get(seeder)
+
+        if not throughput:
+            return max(STREAM_WINDOW // 2, 1)
+
+        return min(max(math.ceil(throughput * WINDOW_TARGET_DELAY / self.chunkSize), 2), STREAM_WINDOW)
+
+    # Next chunk index for "seeder", or None if there is nothing to do right now
+    def claim(self, seeder):
+        with self.condition:
+            now = time.monotonic()
+
+            while self.pending:
+                index = self.pending.popleft()
+                if index not in self.done:
+                    self.inFlight.setdefault(index, {})[seeder] = now
+                    return index
+
+            # Hedge the chunk that is the most overdue on another seeder
+            hedgeIndex, hedgeLateness = None, 0
+            for index, requests in self.inFlight.items():
+                if seeder in requests or len(requests) > 1:
+                    continue
+
+                owner, requestTime = next(iter(requests.items()))
+                expected = self.chunkSize / self.throughput[owner] if self.throughput.get(owner) else 0
+                lateness = (now - requestTime) - max(HEDGE_FACTOR * expected, HEDGE_MIN_DELAY)
+
+                if lateness > hedgeLateness:
+                    hedgeIndex, hedgeLateness = index, lateness
+
+            if hedgeIndex is not None:
+                self.inFlight[hedgeIndex][seeder] = now
+
+            return hedgeIndex
+
+    # Record a chunk received by "seeder". Returns False when another seeder already delivered it
+    def complete(self, seeder, index, count, elapsed):
+        with self.condition:
+            if elapsed > 0:
+                rate = count / elapsed
+                previous = self.throughput.get(seeder)
+                self.throughput[seeder] = rate if not previous else 0.7 * previous + 0.3 * rate
+
+            self.inFlight.get(index, {}).pop(seeder, None)
+
+            if index in self.done:
+                return False
+
+            self.done.add(index)
+            self.inFlight.pop(index, None)
+            self.condition.notify_all()
+            return True
+
+    # Give back the chunks "seeder" was fetching
+    def fail(self, seeder, indexes):
+        with self.condition:
+            for index in indexes:
+                requests = self.inFlight.get(index, {})
+                requests.pop(seeder, None)
+
+                if index not in self.done and not requests:
+                    self.inFlight.pop(index, None)
+                    self.pending.appendleft(index)
+
+            self.condition.notify_all()
+
+    # Give back a chunk "seeder" sent with the wrong content. It goes to the end of the queue so
+    # another seeder is likely to pick it up. Returns how many bad chunks the seeder sent so far
+    def reject(self, seeder, index):
+        with self.condition:
+            requests = self.inFlight.get(index, {})
+            requests.pop(seeder, None)
+
+            if index not in self.done and not requests:
+                self.inFlight.pop(index, None)
+                self.pending.append(index)
+
+            self.badChunks[seeder] = self.badChunks.get(seeder, 0) + 1
+            self.condition.notify_all()
+            return self.badChunks[seeder]
+
+    def wait(self, timeout):
+        with self.condition:
+            self.condition.wait(timeout)
+
+# Fetch chunks handed out by "scheduler" from a single seeder and write them in place
+def getChunksFromSeeder(context, scheduler, fileHash, seeder, fd, bucket=None):
+    pool = connectionPool(context)
+    streamHandler = pool.acquire(SeederStreamHandler, seeder, timeout=STREAM_TIMEOUT)
+
+    # index -> time the request was sent
+    inFlight = {}
+    lastReply = None
+
+    try:
+        while not scheduler.finished():
+            while len(inFlight) < scheduler.window(seeder):
+                index = scheduler.claim(seeder)
+                if index is None:
+                    break
+
+                offset, count = scheduler.chunkRange(index)
+                if bucket:
+                    bucket.consume(count)
+
+                streamHandler.requestRange(fileHash, offset, count)
+                inFlight[index] = time.monotonic()
+
+            if not inFlight:
+                # Nothing to hand out now. Wait for other seeders to make progress and look for late chunks again
+                scheduler.wait(HEDGE_MIN_DELAY / 2)
+                continue
+
+            # Poll in short steps so the worker stops as soon as other seeders finished the download
+            if not streamHandler.poll(int(HEDGE_MIN_DELAY * 1000 / 2)):
+                if time.monotonic() - max(min(inFlight.values()), lastReply or 0) > STREAM_TIMEOUT / 1000:
+                    raise zmq.error.Again()
+                continue
+
+            res = Response.load(streamHandler.recv())
+            if res.status != 200:
+                raise Exception(res.message)
+
+            offset = res.message["offset"]
+            data = res.message["data"]
+            index = offset // scheduler.chunkSize
+            expectedOffset, expectedCount = scheduler.chunkRange(index)
+
+            if index not in inFlight or offset != expectedOffset or len(data) != expectedCount:
+                raise Exception(f'unexpected reply at offset {offset}')
+
+            # Throughput is measured between consecutive replies, since requests are pipelined
+            now = time.monotonic()
+            elapsed = now - max(inFlight.pop(index), lastReply or 0)
+            lastReply = now
+
+            if not scheduler.verify(index, data):
+                print(f'Seeder {seeder}: chunk {index} is corrupted', flush=True)
+                if scheduler.reject(seeder, index) > MERKLE_MAX_BAD_CHUNKS:
+                    raise Exception('too many corrupted chunks')
+                continue
+
+            if not scheduler.isDone(index):
+                os.pwrite(fd, data, offset)
+
+            scheduler.complete(seeder, index, len(data), elapsed)
+    except zmq.error.Again:
+        scheduler.fail(seeder, list(inFlight))
+        print(f'Seeder {seeder}: timed out', flush=True)
+    except Exception as e:
+        scheduler.fail(seeder, list(inFlight))
+        print(f'Seeder {seeder}: {e.args[0] if e.args else e}', flush=True)
+    finally:
+        # Replies to requests still in flight would reach the next user of the connection
+        pool.release(streamHandler, healthy=not inFlight)
+
+# fileInformation = {'fileHash', 'fileName', 'size', 'seeders', 'merkleRoot'}
+# When "repairFilepath" is given, that file is fixed in place: only the chunks that do not match the Merkle tree are fetched.
+# "rateLimit" caps the download at that many bytes per second over all the seeders, or "bucket" (a TokenBucket) shared with other transfers
+def getFileDistributedly(context, fileInformation, outputDirectory='./', repairFilepath=None, rateLimit=None, bucket=None):
+
+    # Download the file distributedly between all the seeders that contain it.
+    # Every seeder has its own socket and pulls chunks from a shared scheduler, so all of them are kept busy
+    # and faster ones end up serving more of the file
+    size = fileInformation['size']
+    seeders = fileInformation['seeders']
+    proposedFilename = fileInformation['fileName']
+
+    leaves = None
+    root = fileInformation.get('merkleRoot')
+    if root:
+        leaves = getChunkHashes(context, fileInformation['fileHash'], root, seeders)
+        if leaves is None:
+            print(f'Unable to download {proposedFilename}: no seeder sent valid chunk hashes')
             return
 
-        data = res.message["data"]
-        count = res.message["count"]
-        
-        with open(outputFilepath, 'ab') as f:
-            f.write(data)
-            f.close()
+    if repairFilepath and leaves is None:
+        print(f'Unable to repair {repairFilepath}: the file has no chunk hashes')
+        return
+
+    scheduler = ChunkScheduler(size, STREAM_CHUNK_SIZE, seeders, leaves=leaves)
+    if not bucket and rateLimit:
+        bucket = TokenBucket(rateLimit, burst=STREAM_CHUNK_SIZE * STREAM_WINDOW)
+
+    outputFilepath = repairFilepath or getOutputFilepath(proposedFilename, outputDirectory)
+
+    # Preallocate the output file so every chunk can be written directly at its offset
+    fd = os.open(outputFilepath, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if repairFilepath:
+            intact = []
+            for index in range(scheduler.chunkCount):
+                offset, count = scheduler.chunkRange(index)
+                if scheduler.verify(index, os.pread(fd, count, offset)):
+                    intact.append(index)
+
+            scheduler.markDone(intact)
+            print(f'Repairing {scheduler.chunkCount - len(intact)} of {scheduler.chunkCount} chunks of {repairFilepath}')
+
+        os.ftruncate(fd, size)
+
+        if not scheduler.finished():
+            with ThreadPoolExecutor(max_workers=max(len(seeders), 1)) as executor:
+                futures = [executor.submit(getChunksFromSeeder, context, scheduler, fileInformation['fileHash'], seeder, fd, bucket) for seeder in seeders]
+
+                for future in as_completed(futures):
+                    future.result()
+    finally:
+        os.close(fd)
+
+    if not scheduler.finished():
+        print(f'Unable to download {proposedFilename}: no seeder left')
+        # A file being repaired is left as it is, the chunks fixed so far are kept
+        if not repairFilepath:
+            os.remove(outputFilepath)
+        return
 
     return outputFilepath